@@ -1,3 +1,9 @@
-from .api import expression_imputation
+__all__ = ["expression_imputation"]
 
-__all__ = ["expression_imputation"]
\ No newline at end of file
+
+def __getattr__(name):
+    # the pipeline and its dependencies are only imported once they are used
+    if name == "expression_imputation":
+        from .api import expression_imputation
+        return expression_imputation
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
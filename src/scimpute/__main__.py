@@ -0,0 +1,3 @@
+from scimpute.cli import main
+
+main()
@@ -1,8 +1,13 @@
 from scimpute.similarity import similarity_matrix
-from scimpute.imputation import impute_expression
-from scimpute.merge import merge_imputation_chunks
-from scimpute.io import read_inputs
+from scimpute.imputation import impute_expression, selected_genes
+from scimpute.merge import merge_imputation_chunks, clear_chunk_files
+from scimpute.incremental import update_neighbors, update_imputation, write_reference_cells, read_reference_cells, REFERENCE_CELLS_FILE
+from scimpute.io import read_inputs, read_neighbors, write_neighbors, output_extension, read_gene_list, write_imputed_matrix
 from scimpute.validation import validate_results
+from scimpute.reference import load_reference_index
+from scimpute.checkpoint import input_fingerprint, stage_key, stage_is_complete, record_stage, clear_stage, RESUMABLE_STAGES
+from scimpute.telemetry import new_report, stage_telemetry, skip_stage, write_report
+from scimpute.utils import checkformat, check_n_jobs
 import os
 from pathlib import Path
 
@@ -17,25 +22,37 @@ def expression_imputation(
     k_neighbors = 25,
     consider_clusters = True,
     save_chunks = True,
-    chunk_size = 1000
+    chunk_size = 1000,
+    max_block_memory = None,
+    reference_index = None,
+    output_format = "tsv",
+    n_jobs = 1,
+    resume = False,
+    plot = True,
+    dtype = None,
+    progress_callback = None,
+    genes = None,
+    in_memory = False,
+    incremental = False,
+    write_queue_size = None
 ):
     """
     This tool will perform gene expression imputation for a dataset with only limited gene expression information (such as from a spatial dataset) based on a dataset with comprehensive gene expression information (such as from single cell/nucleus RNA sequencing).
 
     Parameters
     ----------
-    matrix_to_impute_for : str or pathlib.Path, required
-        tab-separated gene expression matrix to perform gene expression imputation for (e.g. from a spatial experiment); genes as rows, cells/spots as columns
-    matrix_to_impute_from : str or pathlib.Path, required
-        tab-separated comprehensive gene expression matrix to perform gene expression imputation from (e.g. from a single cell/nucleus RNA sequencing experiment); genes as rows, cells/spots as columns
+    matrix_to_impute_for : str or pathlib.Path or pandas.DataFrame or tuple, required
+        tab-separated gene expression matrix to perform gene expression imputation for (e.g. from a spatial experiment); genes as rows, cells/spots as columns; also a Matrix Market or 10x Genomics HDF5 file, a pandas.DataFrame with cells/spots as rows, or a tuple (matrix, cells, genes) of a scipy.sparse CSR or CSC matrix with cells/spots as rows and its cell and gene names
+    matrix_to_impute_from : str or pathlib.Path or pandas.DataFrame or tuple, required
+        tab-separated comprehensive gene expression matrix to perform gene expression imputation from (e.g. from a single cell/nucleus RNA sequencing experiment); genes as rows, cells/spots as columns; also in the same formats as matrix_to_impute_for
     cell_identities : str or pathlib.Path, required
         tab-separated table containing identities for all cells from both datasets
     cell_name_column_idx : int, required
         index of the column containing the cell names (not the cell type clusters)
-    outdir : str or pathlib.Path, optional
-        location of output directory
-    metric : {"cosine_similarity"}, optional
-        similarity metric (currently only supporting 'cosine_similarity')
+    outdir : str or pathlib.Path or None, optional
+        location of output directory; with in_memory=True, None skips writing any files
+    metric : {"cosine_similarity", "approximate_cosine_similarity"}, optional
+        similarity metric; 'approximate_cosine_similarity' uses an approximate nearest neighbor search over the reference cells and reports its recall against the exact search
     k_neighbors : int, optional
         number of k nearest neighbors to find between datasets
     consider_clusters : bool, optional
@@ -44,43 +61,262 @@ def expression_imputation(
         flag indicating whether to write intermediate results to the disk
     chunk_size : int, optional
         number of cells per chunk to impute at a time
+    max_block_memory : int or float, optional
+        maximum memory in megabytes for the blocks of the similarity search; if set, similarities are computed tile by tile instead of per full cluster
+    reference_index : str or pathlib.Path, optional
+        directory of a persistent index of matrix_to_impute_from; it is built on the first run and memory-mapped by later runs instead of parsing the matrix again, and rebuilt if the matrix file changes
+    output_format : {"tsv", "npz", "parquet"}, optional
+        file format of the similarity table, the imputed chunks and the final imputed gene expression matrix; "parquet" requires pyarrow
+    n_jobs : int, optional
+        number of clusters and chunks to process in parallel threads, which share the input matrices without copying them; -1 uses all CPU cores
+    resume : bool, optional
+        flag indicating whether to continue a previous run in outdir; completed stages and imputation chunks are recorded in a manifest together with a fingerprint of the inputs and parameters, and are skipped if these still match
+    plot : bool, optional
+        flag indicating whether to plot a histogram of the validation scores; requires matplotlib, without which the plot is skipped with a warning
+    dtype : str or numpy.dtype, optional
+        floating point type used for the expression values, similarities and imputed values throughout the pipeline; "float32" halves the memory use and speeds up the similarity and imputation steps at the cost of precision; default keeps the types of the inputs (float64 for sparse files)
+    progress_callback : callable, optional
+        function that is called with a dict describing every event of the run: the start and end of every stage and the end of every cluster and chunk, including their metrics and the number of completed and total tasks of the stage; the same metrics are written to "run_report.json" in outdir
+    genes : list-like or str or pathlib.Path, optional
+        genes to impute, or path to a text file with one gene name per line; only these genes are aggregated and written to the imputation chunks and the final imputed gene expression matrix, and validated if they were measured; default imputes all genes of matrix_to_impute_from
+    in_memory : bool, optional
+        flag indicating whether to pass the results between the steps in memory instead of writing and reading back the similarity table and the imputation chunks, and to return them; the final outputs are still written to outdir unless it is None; cannot be combined with resume
+    write_queue_size : int, optional
+        number of imputed chunks that may wait to be written by a background thread while the next chunks are imputed; overlaps the imputation with writing the chunk files, at the cost of holding the waiting chunks in memory; default writes every chunk right after it is imputed
+    incremental : bool, optional
+        flag indicating whether to update the results of a previous incremental run in outdir with the same parameters instead of computing them again: only cells to impute for without stored neighbors are searched against all cells to impute from, the other cells are only compared against added cells to impute from, and only the cells whose neighbors changed are imputed again; cells that are part of both runs are assumed to be unchanged; without such a previous run, all cells are imputed and stored for later incremental runs; cannot be combined with resume or in_memory
+
+    Returns
+    -------
+    imputed_mtx : pandas.DataFrame
+        only if in_memory is True: imputed gene expression matrix indexed by cell name; genes as columns, cells/spots as rows
+    neighbors : dict
+        only if in_memory is True: compact table of the most similar cells with one row of neighbor positions ("indices") into "reference_cells" and "distances" per cell of "cells"; scimpute.neighbors.neighbor_table converts it into a table with the columns "cluster", "x", "y" and "distance"
+    scores : pandas.Series
+        only if in_memory is True: cosine similarity between the measured and imputed gene expression of every cell
+    gene_correlations : pandas.DataFrame
+        only if in_memory is True: Pearson and Spearman correlation between the measured and imputed gene expression of every measured gene
     """
 
-    x, y, clusters, save_location = read_inputs(
-        matrix_to_impute_for=matrix_to_impute_for,
-        matrix_to_impute_from=matrix_to_impute_from,
-        cell_identities=cell_identities,
-        cell_name_column_idx=cell_name_column_idx,
-        outdir=outdir
-    )
+    if in_memory and resume:
+        raise ValueError("resume cannot be combined with in_memory, because the intermediate results of an in-memory run are not written to the disk.")
+    if incremental and (resume or in_memory):
+        raise ValueError("incremental cannot be combined with resume or in_memory.")
+    if outdir is None and not in_memory:
+        raise ValueError("outdir can only be None if in_memory is True.")
+    check_n_jobs(n_jobs)
+
+    if isinstance(genes, (str, Path)):
+        genes = read_gene_list(genes)
 
-    similarity_output = similarity_matrix(
-        x,
-        y,
-        clusters = clusters,
-        cell_name_column_idx = cell_name_column_idx,
+    report = new_report(
+        callback = progress_callback,
         metric = metric,
         k_neighbors = k_neighbors,
         consider_clusters = consider_clusters,
-        outdir = save_location
-    )
-
-    imputed_results = impute_expression(
-        x,
-        y,
-        similarity_matrix=similarity_output,
         chunk_size = chunk_size,
-        outdir = save_location
+        max_block_memory = max_block_memory,
+        output_format = output_format,
+        n_jobs = n_jobs,
+        resume = resume,
+        dtype = None if dtype is None else str(dtype),
+        n_genes = None if genes is None else len(genes),
+        incremental = incremental,
+        write_queue_size = write_queue_size
     )
 
-    final_df = merge_imputation_chunks(
-        imputations_dir = save_location,
-        outdir = save_location,
-        save_chunks = save_chunks
-    )
+    if resume:
+        inputs_key = stage_key(
+            matrix_to_impute_for = input_fingerprint(matrix_to_impute_for),
+            matrix_to_impute_from = input_fingerprint(matrix_to_impute_from),
+            cell_identities = input_fingerprint(cell_identities),
+            cell_name_column_idx = cell_name_column_idx
+        )
+
+    with stage_telemetry(report, "read_inputs") as stage:
+        if reference_index is not None:
+            if checkformat(matrix_to_impute_from) != "path":
+                raise ValueError("A reference index can only be used if matrix_to_impute_from is given as a path.")
+            matrix_to_impute_from = load_reference_index(matrix_to_impute_from, reference_index, dtype=dtype)
+
+        x, y, clusters, save_location = read_inputs(
+            matrix_to_impute_for=matrix_to_impute_for,
+            matrix_to_impute_from=matrix_to_impute_from,
+            cell_identities=cell_identities,
+            cell_name_column_idx=cell_name_column_idx,
+            outdir=outdir,
+            dtype=dtype
+        )
+        report["_outdir"] = save_location
+        if genes is not None:
+            genes = list(selected_genes(y.columns, genes))
+        stage.update(cells=len(x.index), genes=len(x.columns), reference_cells=len(y.index), reference_genes=len(y.columns))
+
+    extension = output_extension(output_format)
+    if resume:
+        similarity_key = stage_key(inputs = inputs_key, metric = metric, k_neighbors = k_neighbors, consider_clusters = consider_clusters, max_block_memory = max_block_memory, output_format = output_format, dtype = None if dtype is None else str(dtype))
+        imputation_key = stage_key(similarity = similarity_key, chunk_size = chunk_size, genes = None if genes is None else list(genes))
+        merge_key = stage_key(imputation = imputation_key)
+        validation_key = stage_key(merge = merge_key, plot = plot)
+    if incremental:
+        incremental_key = stage_key(cell_name_column_idx = cell_name_column_idx, metric = metric, k_neighbors = k_neighbors, consider_clusters = consider_clusters, output_format = output_format, dtype = None if dtype is None else str(dtype), genes = None if genes is None else list(genes))
+        update = stage_is_complete(save_location, "incremental", incremental_key)
+        if not update:
+            print("No previous incremental run with the same parameters found, imputing all cells")
+    if save_location is not None:
+        # the stored results of an incremental run are only valid again once this run has completed
+        clear_stage(save_location, "incremental")
+        if not resume:
+            # this run overwrites the outputs of the recorded stages, which a later resumed run must not take for its own
+            clear_stage(save_location, *RESUMABLE_STAGES)
+
+    if incremental and update:
+        with stage_telemetry(report, "similarity"):
+            similarity_output, updated_cells = update_neighbors(
+                x,
+                y,
+                clusters = clusters,
+                cell_name_column_idx = cell_name_column_idx,
+                previous_neighbors = read_neighbors(os.path.join(save_location, f"sim_matrix{extension}")),
+                previous_reference_cells = read_reference_cells(save_location),
+                metric = metric,
+                k_neighbors = k_neighbors,
+                consider_clusters = consider_clusters,
+                max_block_memory = max_block_memory,
+                n_jobs = n_jobs,
+                telemetry = report
+            )
+            write_neighbors(similarity_output, os.path.join(save_location, "sim_matrix"), output_format)
+    elif resume and stage_is_complete(save_location, "similarity", similarity_key):
+        print("Similarity matrix already completed")
+        skip_stage(report, "similarity")
+        similarity_output = read_neighbors(os.path.join(save_location, f"sim_matrix{extension}"))
+    else:
+        with stage_telemetry(report, "similarity"):
+            similarity_output = similarity_matrix(
+                x,
+                y,
+                clusters = clusters,
+                cell_name_column_idx = cell_name_column_idx,
+                metric = metric,
+                k_neighbors = k_neighbors,
+                consider_clusters = consider_clusters,
+                max_block_memory = max_block_memory,
+                output_format = output_format,
+                n_jobs = n_jobs,
+                outdir = save_location,
+                telemetry = report,
+                compact = True
+            )
+        if resume:
+            record_stage(save_location, "similarity", similarity_key, [f"sim_matrix{extension}"])
+
+    if in_memory:
+        with stage_telemetry(report, "imputation"):
+            imputed_mtx = impute_expression(
+                x,
+                y,
+                similarity_matrix=similarity_output,
+                chunk_size = chunk_size,
+                n_jobs = n_jobs,
+                outdir = None,
+                telemetry = report,
+                genes = genes
+            )
+            if save_location is not None:
+                write_imputed_matrix(imputed_mtx, os.path.join(save_location, "imputation"), output_format)
+
+        with stage_telemetry(report, "validation"):
+            scores, gene_correlations = validate_results(
+                x = x,
+                imputed_mtx = imputed_mtx,
+                outdir = save_location,
+                plot = plot,
+                telemetry = report
+            )
+
+        report["completed"] = True
+        write_report(report)
+        return (imputed_mtx, similarity_output, scores, gene_correlations)
+
+    if incremental and update:
+        with stage_telemetry(report, "imputation"):
+            final_df = update_imputation(
+                x,
+                y,
+                neighbors = similarity_output,
+                updated_cells = updated_cells,
+                outdir = save_location,
+                chunk_size = chunk_size,
+                output_format = output_format,
+                n_jobs = n_jobs,
+                telemetry = report,
+                genes = genes
+            )
+    elif not (resume and stage_is_complete(save_location, "merge", merge_key)):
+        # imputation files of a previous run with other inputs or parameters must not be merged
+        resume_chunks = resume and stage_is_complete(save_location, "imputation", imputation_key)
+        if not resume_chunks:
+            clear_chunk_files(os.path.join(save_location, "imputations"))
+            if resume:
+                record_stage(save_location, "imputation", imputation_key, [])
+
+        with stage_telemetry(report, "imputation"):
+            imputed_results = impute_expression(
+                x,
+                y,
+                similarity_matrix=similarity_output,
+                chunk_size = chunk_size,
+                output_format = output_format,
+                n_jobs = n_jobs,
+                resume = resume_chunks,
+                outdir = save_location,
+                telemetry = report,
+                genes = genes,
+                write_queue_size = write_queue_size
+            )
+
+        with stage_telemetry(report, "merge"):
+            final_df = merge_imputation_chunks(
+                imputations_dir = save_location,
+                outdir = save_location,
+                save_chunks = save_chunks,
+                output_format = output_format,
+                return_matrix = False,
+                n_cells = len(x.index),
+                telemetry = report
+            )
+        if resume:
+            clear_stage(save_location, "imputation")
+            record_stage(save_location, "merge", merge_key, [f"imputation{extension}"])
+    else:
+        print("Imputation already completed")
+        skip_stage(report, "imputation")
+        skip_stage(report, "merge")
+        final_df = os.path.join(save_location, f"imputation{extension}")
+
+    if resume and stage_is_complete(save_location, "validation", validation_key):
+        print("Validation already completed")
+        skip_stage(report, "validation")
+    else:
+        with stage_telemetry(report, "validation"):
+            validate_results(
+                x = x,
+                imputed_mtx = final_df,
+                outdir = save_location,
+                plot = plot,
+                telemetry = report
+            )
+        if resume:
+            validation_files = ["stats.txt", "scores.txt", "gene_correlations.tsv"]
+            # the plot is skipped if matplotlib is not installed
+            if plot and os.path.exists(os.path.join(save_location, "cosine_similarities.png")):
+                validation_files.append("cosine_similarities.png")
+            record_stage(save_location, "validation", validation_key, validation_files)
+
+    if incremental:
+        write_reference_cells(y.index, save_location)
+        record_stage(save_location, "incremental", incremental_key, [f"sim_matrix{extension}", f"imputation{extension}", REFERENCE_CELLS_FILE])
 
-    validate_results(
-        x = x,
-        imputed_mtx = final_df,
-        outdir = save_location
-    )
\ No newline at end of file
+    report["completed"] = True
+    write_report(report)
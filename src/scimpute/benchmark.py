@@ -0,0 +1,459 @@
+import argparse
+import ast
+import itertools
+import json
+import os
+import shutil
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from scimpute.synthetic import synthetic_dataset
+from scimpute.similarity import similarity_matrix
+from scimpute.imputation import impute_expression
+from scimpute.merge import merge_imputation_chunks
+from scimpute.validation import validate_results
+from scimpute.neighbors import shared_neighbors
+from scimpute.telemetry import run_environment
+
+BENCHMARK_VERSION = 1
+
+DATASET_PARAMETERS = {
+    "n_cells": 1000,
+    "n_reference_cells": 5000,
+    "n_genes": 2000,
+    "n_measured_genes": 100,
+    "n_clusters": 10,
+    "sparsity": 0.9,
+    "sparse_output": False
+}
+
+PIPELINE_PARAMETERS = {
+    "metric": "cosine_similarity",
+    "k_neighbors": 25,
+    "consider_clusters": True,
+    "chunk_size": 1000,
+    "max_block_memory": None,
+    "output_format": "tsv",
+    "n_jobs": 1,
+    "dtype": None,
+    "write_queue_size": None
+}
+
+DEFAULT_GRID = {
+    "n_cells": [1000, 2000, 4000],
+    "n_reference_cells": [5000, 20000]
+}
+
+
+def run_benchmarks(
+    outdir,
+    grid = None,
+    repeats = 1,
+    random_state = 0,
+    keep_outputs = False,
+    **parameters
+):
+    """
+    Times and memory-profiles the steps of the gene expression imputation on synthetic datasets for every combination of parameters in a grid, and writes the results as a machine-readable baseline.
+
+    Every step is first run on a small dataset to import lazily loaded dependencies. Then it is run repeats times without profiling to measure its wall time, and once more while tracing memory allocations with tracemalloc to measure its peak memory, so that the profiling overhead does not distort the timings.
+
+    Parameters
+    ----------
+    outdir : str or pathlib.Path, required
+        location of output directory; the results are written to benchmark.json and benchmark.tsv
+    grid : dict, optional
+        lists of values for any of the parameters of synthetic_dataset and of the steps (metric, k_neighbors, consider_clusters, chunk_size, max_block_memory, output_format, n_jobs, dtype, write_queue_size); every combination is benchmarked; default is DEFAULT_GRID
+    repeats : int, optional
+        number of timed runs per step; the fastest one is reported
+    random_state : int, optional
+        seed of the synthetic datasets
+    keep_outputs : bool, optional
+        flag indicating whether to keep the output files of the steps in outdir/runs
+    **parameters
+        fixed values of parameters not varied in the grid
+
+    Returns
+    -------
+    results : pandas.DataFrame
+        one row per grid point and step with its parameters, the fastest wall time in seconds and the peak traced memory in megabytes
+    """
+
+    grid = DEFAULT_GRID if grid is None else grid
+    unknown = set(grid) | set(parameters)
+    unknown -= set(DATASET_PARAMETERS) | set(PIPELINE_PARAMETERS)
+    if unknown:
+        raise ValueError(f"Unknown benchmark parameters: {', '.join(sorted(unknown))}.")
+    if repeats < 1:
+        raise ValueError(f"repeats must be at least 1, not {repeats}.")
+
+    Path(outdir).mkdir(parents=True, exist_ok=True)
+    names = list(grid)
+    records = []
+    for run_idx, values in enumerate(itertools.product(*(grid[name] for name in names))):
+        point = {**DATASET_PARAMETERS, **PIPELINE_PARAMETERS, **parameters, **dict(zip(names, values))}
+        print(f"Benchmark {run_idx + 1}: " + ", ".join(f"{name}={point[name]}" for name in names))
+        run_dir = os.path.join(outdir, "runs", str(run_idx))
+        # a run on a small dataset first imports the lazily loaded dependencies, so that they are not timed
+        benchmark_pipeline({**point, "n_cells": 50, "n_reference_cells": 200}, os.path.join(run_dir, "warm_up"), random_state=random_state)
+        for stage, seconds, peak_memory in benchmark_pipeline(point, run_dir, repeats=repeats, random_state=random_state):
+            records.append({**point, "stage": stage, "seconds": min(seconds), "all_seconds": seconds, "peak_memory_mb": peak_memory})
+        if not keep_outputs:
+            shutil.rmtree(run_dir, ignore_errors=True)
+    if not keep_outputs:
+        shutil.rmtree(os.path.join(outdir, "runs"), ignore_errors=True)
+
+    with open(os.path.join(outdir, "benchmark.json"), "w") as f:
+        json.dump({"version": BENCHMARK_VERSION, "environment": benchmark_environment(), "repeats": repeats, "random_state": random_state, "results": records}, f, indent=2, default=str)
+    results = pd.DataFrame(records).drop(columns="all_seconds")
+    results.to_csv(os.path.join(outdir, "benchmark.tsv"), sep="\t", index=False)
+
+    return results
+
+def benchmark_pipeline(
+    parameters,
+    outdir,
+    repeats = 1,
+    random_state = 0
+):
+    """
+    Generates a synthetic dataset and profiles every step of the gene expression imputation on it.
+
+    Parameters
+    ----------
+    parameters : dict, required
+        values of all parameters of synthetic_dataset and of the steps
+    outdir : str or pathlib.Path, required
+        location of output directory of the steps
+    repeats : int, optional
+        number of timed runs per step
+    random_state : int, optional
+        seed of the synthetic dataset
+
+    Returns
+    -------
+    stages : list of tuple
+        name, list of wall times in seconds and peak traced memory in megabytes of every step
+    """
+
+    x, y, clusters, cell_name_column_idx = synthetic_dataset(
+        random_state = random_state,
+        **{name: parameters[name] for name in DATASET_PARAMETERS}
+    )
+    Path(outdir).mkdir(parents=True, exist_ok=True)
+    output_format = parameters["output_format"]
+
+    similarity_output, *stage = profile_call(
+        similarity_matrix,
+        repeats,
+        x,
+        y,
+        clusters = clusters,
+        cell_name_column_idx = cell_name_column_idx,
+        outdir = outdir,
+        metric = parameters["metric"],
+        k_neighbors = parameters["k_neighbors"],
+        consider_clusters = parameters["consider_clusters"],
+        max_block_memory = parameters["max_block_memory"],
+        output_format = output_format,
+        n_jobs = parameters["n_jobs"],
+        dtype = parameters["dtype"],
+        compact = True
+    )
+    stages = [("similarity_matrix", *stage)]
+
+    _, *stage = profile_call(
+        impute_expression,
+        repeats,
+        x,
+        y,
+        similarity_matrix = similarity_output,
+        outdir = outdir,
+        chunk_size = parameters["chunk_size"],
+        output_format = output_format,
+        n_jobs = parameters["n_jobs"],
+        dtype = parameters["dtype"],
+        write_queue_size = parameters["write_queue_size"]
+    )
+    stages.append(("impute_expression", *stage))
+
+    # the chunks are kept so that the merge can be repeated
+    imputed_mtx, *stage = profile_call(
+        merge_imputation_chunks,
+        repeats,
+        imputations_dir = outdir,
+        outdir = outdir,
+        save_chunks = True,
+        output_format = output_format,
+        return_matrix = False,
+        n_cells = len(x.index)
+    )
+    stages.append(("merge_imputation_chunks", *stage))
+
+    _, *stage = profile_call(
+        validate_results,
+        repeats,
+        x = x,
+        imputed_mtx = imputed_mtx,
+        outdir = outdir,
+        plot = False
+    )
+    stages.append(("validate_results", *stage))
+
+    return stages
+
+def compare_precision(
+    dtype = "float32",
+    random_state = 0,
+    **parameters
+):
+    """
+    Measures how much the results of the gene expression imputation in a lower floating point precision differ from those in double precision on a synthetic dataset.
+
+    The similarity search, imputation and validation are run in memory on the same synthetic dataset once with dtype and once with float64.
+
+    Parameters
+    ----------
+    dtype : str or numpy.dtype, optional
+        floating point type to compare to float64; default is 'float32'
+    random_state : int, optional
+        seed of the synthetic dataset
+    **parameters
+        values of the parameters of synthetic_dataset and of the steps (metric, k_neighbors, consider_clusters, chunk_size, max_block_memory, n_jobs) that differ from their defaults
+
+    Returns
+    -------
+    comparison : dict
+        the parameters and, in "results", the fraction of the neighbors of the float64 run that were also selected with dtype ("shared_neighbors"), the fraction of imputed values that are equal after rounding to two decimals ("equal_values"), the mean and largest absolute difference of the imputed values ("mean_absolute_difference", "max_absolute_difference") and the absolute difference of the mean cosine similarity of the validation ("mean_score_difference") and the largest absolute difference of the cosine similarity of a cell and of the Pearson correlation of a gene ("max_score_difference", "max_pearson_difference")
+    """
+
+    # the outputs are compared in memory, so that the output format and writing are not varied
+    unknown = set(parameters) - (set(DATASET_PARAMETERS) | (set(PIPELINE_PARAMETERS) - {"output_format", "dtype", "write_queue_size"}))
+    if unknown:
+        raise ValueError(f"Unknown precision comparison parameters: {', '.join(sorted(unknown))}.")
+
+    parameters = {**DATASET_PARAMETERS, **PIPELINE_PARAMETERS, **parameters, "dtype": str(dtype)}
+    x, y, clusters, cell_name_column_idx = synthetic_dataset(
+        random_state = random_state,
+        **{name: parameters[name] for name in DATASET_PARAMETERS}
+    )
+
+    runs = []
+    for run_dtype in ("float64", dtype):
+        print(f"Imputation in {run_dtype}")
+        neighbors = similarity_matrix(
+            x,
+            y,
+            clusters = clusters,
+            cell_name_column_idx = cell_name_column_idx,
+            outdir = None,
+            metric = parameters["metric"],
+            k_neighbors = parameters["k_neighbors"],
+            consider_clusters = parameters["consider_clusters"],
+            max_block_memory = parameters["max_block_memory"],
+            n_jobs = parameters["n_jobs"],
+            dtype = run_dtype,
+            compact = True
+        )
+        imputed_mtx = impute_expression(
+            x,
+            y,
+            similarity_matrix = neighbors,
+            outdir = None,
+            chunk_size = parameters["chunk_size"],
+            n_jobs = parameters["n_jobs"],
+            dtype = run_dtype
+        )
+        scores, gene_correlations = validate_results(x, imputed_mtx, outdir=None, plot=False)
+        runs.append((neighbors, imputed_mtx, scores, gene_correlations))
+
+    (neighbors, imputed_mtx, scores, gene_correlations), (other_neighbors, other_imputed_mtx, other_scores, other_gene_correlations) = runs
+    differences = np.abs(other_imputed_mtx.reindex(index=imputed_mtx.index, columns=imputed_mtx.columns).to_numpy(dtype=np.float64) - imputed_mtx.to_numpy(dtype=np.float64))
+    results = {
+        "shared_neighbors": shared_neighbors(neighbors, other_neighbors),
+        # values rounded to two decimals in either precision differ by less than half a decimal step if they are equal
+        "equal_values": float(np.mean(differences < 0.005)),
+        "mean_absolute_difference": float(np.mean(differences)),
+        "max_absolute_difference": float(np.max(differences, initial=0)),
+        "mean_score_difference": float(abs(other_scores.mean() - scores.mean())),
+        "max_score_difference": float(np.max(np.abs(other_scores.reindex(scores.index) - scores).to_numpy(), initial=0)),
+        "max_pearson_difference": float(np.nanmax(np.abs(other_gene_correlations["pearson"].reindex(gene_correlations.index) - gene_correlations["pearson"]).to_numpy(), initial=0))
+    }
+
+    return {"parameters": parameters, "random_state": random_state, "results": results}
+
+def profile_call(
+    function,
+    repeats,
+    *args,
+    **kwargs
+):
+    """
+    Measures the wall time and the peak traced memory of a function call.
+
+    Parameters
+    ----------
+    function : callable, required
+        function to profile
+    repeats : int, required
+        number of timed calls
+    *args, **kwargs
+        arguments of the function
+
+    Returns
+    -------
+    result
+        return value of the last call
+    seconds : list of float
+        wall time of every timed call
+    peak_memory_mb : float
+        peak memory in megabytes allocated during an additional traced call, as reported by tracemalloc; this includes the allocations of NumPy, pandas and SciPy
+    """
+
+    seconds = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function(*args, **kwargs)
+        seconds.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        result = function(*args, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return (result, seconds, peak / 1024 ** 2)
+
+def benchmark_environment():
+    """
+    Describes the software and hardware a benchmark was run on.
+    """
+
+    return {
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        **run_environment()
+    }
+
+def compare_benchmarks(
+    baseline,
+    current,
+    tolerance = 0.2
+):
+    """
+    Compares the results of two benchmark runs and flags the steps that became slower or needed more memory.
+
+    Parameters
+    ----------
+    baseline : str or pathlib.Path, required
+        path to the benchmark.json file of the reference run
+    current : str or pathlib.Path, required
+        path to the benchmark.json file of the new run
+    tolerance : float, optional
+        relative increase of the wall time or peak memory that is still accepted; default is 0.2
+
+    Returns
+    -------
+    comparison : pandas.DataFrame
+        one row per grid point and step that is contained in both runs, with the wall times, peak memories, their ratios (current/baseline) and a flag indicating a regression
+    """
+
+    frames = []
+    for filepath in (baseline, current):
+        with open(filepath) as f:
+            frames.append(pd.DataFrame(json.load(f)["results"]).drop(columns="all_seconds"))
+
+    keys = [column for column in frames[0].columns if column in frames[1].columns and column not in ("seconds", "peak_memory_mb")]
+    comparison = frames[0].merge(frames[1], on=keys, suffixes=("_baseline", "_current"))
+    comparison["time_ratio"] = comparison["seconds_current"] / comparison["seconds_baseline"]
+    comparison["memory_ratio"] = comparison["peak_memory_mb_current"] / comparison["peak_memory_mb_baseline"]
+    comparison["regression"] = (comparison["time_ratio"] > 1 + tolerance) | (comparison["memory_ratio"] > 1 + tolerance)
+
+    return comparison
+
+def parse_grid(
+    arguments
+):
+    """
+    Parses parameter values given as name=value1,value2 strings.
+
+    Parameters
+    ----------
+    arguments : list of str, required
+        parameter values; values are read as Python literals where possible and as strings otherwise
+    """
+
+    def literal(value):
+        try:
+            return ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            return value
+
+    grid = {}
+    for argument in arguments:
+        name, sep, values = argument.partition("=")
+        if not sep:
+            raise ValueError(f"Invalid grid parameter {argument}; expected name=value1,value2.")
+        grid[name.strip()] = [literal(value.strip()) for value in values.split(",")]
+
+    return grid
+
+def main(
+    argv = None
+):
+    """
+    Runs the benchmarks from the command line and optionally compares them to a baseline.
+
+    Parameters
+    ----------
+    argv : list of str, optional
+        command line arguments; default is sys.argv[1:]
+    """
+
+    parser = argparse.ArgumentParser(
+        prog="python -m scimpute.benchmark",
+        description="Time and memory-profile the steps of the gene expression imputation on synthetic datasets."
+    )
+    parser.add_argument("grid", nargs="*", help="parameter values to benchmark as name=value1,value2, e.g. n_cells=1000,4000 n_jobs=1,4; default is n_cells=1000,2000,4000 n_reference_cells=5000,20000")
+    parser.add_argument("-o", "--outdir", default="benchmark_output", help="location of output directory; default is 'benchmark_output'")
+    parser.add_argument("-r", "--repeats", type=int, default=1, help="number of timed runs per step; default is 1")
+    parser.add_argument("--baseline", default=None, help="benchmark.json file of an earlier run to compare the results to")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="relative increase of wall time or peak memory that is reported as a regression; default is 0.2")
+    parser.add_argument("--keep-outputs", action="store_true", help="keep the output files of the steps")
+    parser.add_argument("--precision", default=None, help="instead of benchmarking, compare the results in this floating point type, e.g. float32, to those in float64 on the dataset given by the parameter values, which take a single value each; the results are written to precision.json")
+    arguments = parser.parse_args(argv)
+
+    if arguments.precision is not None:
+        grid = parse_grid(arguments.grid)
+        several = [name for name, values in grid.items() if len(values) != 1]
+        if several:
+            raise ValueError(f"The precision comparison takes a single value per parameter, not several for: {', '.join(several)}.")
+        comparison = compare_precision(arguments.precision, **{name: values[0] for name, values in grid.items()})
+        Path(arguments.outdir).mkdir(parents=True, exist_ok=True)
+        with open(os.path.join(arguments.outdir, "precision.json"), "w") as f:
+            json.dump({"version": BENCHMARK_VERSION, "environment": benchmark_environment(), **comparison}, f, indent=2, default=str)
+        for name, value in comparison["results"].items():
+            print(f"{name}: {value}")
+        return
+
+    run_benchmarks(
+        outdir = arguments.outdir,
+        grid = parse_grid(arguments.grid) if arguments.grid else None,
+        repeats = arguments.repeats,
+        keep_outputs = arguments.keep_outputs
+    )
+    if arguments.baseline is not None:
+        comparison = compare_benchmarks(arguments.baseline, os.path.join(arguments.outdir, "benchmark.json"), tolerance=arguments.tolerance)
+        comparison.to_csv(os.path.join(arguments.outdir, "comparison.tsv"), sep="\t", index=False)
+        regressions = comparison[comparison["regression"]]
+        print(f"{len(regressions)} of {len(comparison)} benchmarked steps regressed by more than {arguments.tolerance:.0%}")
+        if len(regressions) > 0:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+import hashlib
+import json
+import os
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from scipy import sparse
+from scimpute.utils import checkformat, expression_values
+
+MANIFEST_FILE = "manifest.json"
+# stages that a run with resume=True can skip; every other run overwrites their files
+RESUMABLE_STAGES = ("similarity", "imputation", "merge", "validation")
+
+
+def input_fingerprint(
+    data
+):
+    """
+    Computes a fingerprint of an input of the gene expression imputation.
+
+    Files are described by their resolved path, size and modification time, directories by those of all files they contain; pandas.DataFrames and scipy.sparse matrices by a hash of their cell names, column names and values.
+
+    Parameters
+    ----------
+    data : str or pathlib.Path or pandas.DataFrame or tuple, required
+        path to an input file or directory, or the loaded input; a tuple (matrix, cells, genes) of a scipy.sparse matrix and its cell and gene names
+    """
+
+    digest = hashlib.sha256()
+    if checkformat(data) == "path":
+        path = Path(data).resolve()
+        files = sorted(file for file in path.iterdir() if file.is_file()) if path.is_dir() else [path]
+        for file in files:
+            stat = os.stat(file)
+            digest.update(f"{file}\t{stat.st_size}\t{stat.st_mtime_ns}\n".encode("utf-8"))
+    elif checkformat(data) == "sparse":
+        values, cells, genes = data
+        values = sparse.csr_matrix(values)
+        values.sort_indices()
+        for names in (cells, genes):
+            digest.update(pd.util.hash_pandas_object(pd.Series(names), index=False).to_numpy().tobytes())
+        for part in (values.data, values.indices, values.indptr):
+            digest.update(np.ascontiguousarray(part).tobytes())
+    else:
+        digest.update(pd.util.hash_pandas_object(data.index.to_series(), index=False).to_numpy().tobytes())
+        digest.update(pd.util.hash_pandas_object(data.columns.to_series(), index=False).to_numpy().tobytes())
+        if all(pd.api.types.is_numeric_dtype(dtype) for dtype in data.dtypes):
+            values = expression_values(data)
+            if sparse.issparse(values):
+                for part in (values.data, values.indices, values.indptr):
+                    digest.update(np.ascontiguousarray(part).tobytes())
+            else:
+                digest.update(np.ascontiguousarray(values).tobytes())
+        else:
+            digest.update(pd.util.hash_pandas_object(data, index=False).to_numpy().tobytes())
+
+    return digest.hexdigest()
+
+def stage_key(
+    **parts
+):
+    """
+    Combines input fingerprints and parameters into the key of a pipeline stage.
+
+    Parameters
+    ----------
+    **parts : JSON-serializable values
+        fingerprints of the stage inputs, keys of previous stages and parameters of the stage
+    """
+
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+def read_manifest(
+    outdir
+):
+    """
+    Reads the manifest of completed pipeline stages from an output directory.
+
+    Parameters
+    ----------
+    outdir : str or pathlib.Path, required
+        location of the output directory
+    """
+
+    manifest_file = os.path.join(outdir, MANIFEST_FILE)
+    if not os.path.exists(manifest_file):
+        return {}
+    with open(manifest_file) as f:
+        return json.load(f)
+
+def stage_is_complete(
+    outdir,
+    stage,
+    key
+):
+    """
+    Checks whether a pipeline stage was completed with the same key and all of its recorded output files still exist.
+
+    Parameters
+    ----------
+    outdir : str or pathlib.Path, required
+        location of the output directory
+    stage : str, required
+        name of the pipeline stage
+    key : str, required
+        key of the stage computed by stage_key
+    """
+
+    entry = read_manifest(outdir).get(stage)
+    if entry is None or entry["key"] != key:
+        return False
+    return all(os.path.exists(os.path.join(outdir, file)) for file in entry["files"])
+
+def record_stage(
+    outdir,
+    stage,
+    key,
+    files
+):
+    """
+    Records a completed pipeline stage in the manifest of an output directory.
+
+    Parameters
+    ----------
+    outdir : str or pathlib.Path, required
+        location of the output directory
+    stage : str, required
+        name of the pipeline stage
+    key : str, required
+        key of the stage computed by stage_key
+    files : list of str, required
+        output files of the stage relative to outdir
+    """
+
+    manifest = read_manifest(outdir)
+    manifest[stage] = {"key": key, "files": [str(file) for file in files]}
+    write_manifest(outdir, manifest)
+
+def clear_stage(
+    outdir,
+    *stages
+):
+    """
+    Removes pipeline stages from the manifest of an output directory, marking them as not completed.
+
+    Parameters
+    ----------
+    outdir : str or pathlib.Path, required
+        location of the output directory
+    *stages : str
+        names of the pipeline stages
+    """
+
+    manifest = read_manifest(outdir)
+    if any(stage in manifest for stage in stages):
+        for stage in stages:
+            manifest.pop(stage, None)
+        write_manifest(outdir, manifest)
+
+def write_manifest(
+    outdir,
+    manifest
+):
+    """
+    Writes the manifest of completed pipeline stages to an output directory.
+
+    The manifest is replaced atomically, so an interrupted run never leaves a partially written manifest behind.
+
+    Parameters
+    ----------
+    outdir : str or pathlib.Path, required
+        location of the output directory
+    manifest : dict, required
+        completed pipeline stages with their keys and output files
+    """
+
+    manifest_file = os.path.join(outdir, MANIFEST_FILE)
+    with open(f"{manifest_file}.tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(f"{manifest_file}.tmp", manifest_file)
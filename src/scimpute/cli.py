@@ -0,0 +1,79 @@
+import argparse
+
+
+def parse_arguments(argv=None):
+    """
+    Parses the command line arguments of the scimpute command.
+
+    Parameters
+    ----------
+    argv : list of str, optional
+        command line arguments; default is the arguments of the current process
+    """
+
+    parser = argparse.ArgumentParser(
+        prog="scimpute",
+        description="Gene expression imputation for a dataset with limited gene expression information (such as from a spatial dataset) based on a dataset with comprehensive gene expression information (such as from single cell/nucleus RNA sequencing)."
+    )
+    parser.add_argument("matrix_to_impute_for", help="gene expression matrix to perform gene expression imputation for; tab-separated text, Matrix Market or 10x Genomics HDF5 file")
+    parser.add_argument("matrix_to_impute_from", help="comprehensive gene expression matrix to perform gene expression imputation from; tab-separated text, Matrix Market or 10x Genomics HDF5 file")
+    parser.add_argument("cell_identities", help="tab-separated table containing identities for all cells from both datasets")
+    parser.add_argument("cell_name_column_idx", type=int, help="index of the column containing the cell names (not the cell type clusters)")
+    parser.add_argument("-o", "--outdir", default="imputation_output", help="location of output directory; default is 'imputation_output'")
+    parser.add_argument("--metric", default="cosine_similarity", choices=["cosine_similarity", "approximate_cosine_similarity"], help="similarity metric; default is 'cosine_similarity'")
+    parser.add_argument("-k", "--k-neighbors", type=int, default=25, help="number of k nearest neighbors to find between datasets; default is 25")
+    parser.add_argument("--ignore-clusters", action="store_true", help="identify similar cells within the entire dataset instead of within the same annotated cluster")
+    parser.add_argument("--remove-chunks", action="store_true", help="remove the intermediate imputation chunks after merging")
+    parser.add_argument("--chunk-size", type=int, default=1000, help="number of cells per chunk to impute at a time; default is 1000")
+    parser.add_argument("--write-queue-size", type=int, default=None, help="number of imputed chunks that may wait to be written by a background thread while the next chunks are imputed")
+    parser.add_argument("--max-block-memory", type=float, default=None, help="maximum memory in megabytes for the blocks of the similarity search")
+    parser.add_argument("--reference-index", default=None, help="directory of a persistent index of matrix_to_impute_from")
+    parser.add_argument("--output-format", default="tsv", choices=["tsv", "npz", "parquet"], help="file format of the similarity table and the imputed matrices; default is 'tsv'")
+    parser.add_argument("-j", "--n-jobs", type=int, default=1, help="number of clusters and chunks to process in parallel; -1 uses all CPU cores; default is 1")
+    parser.add_argument("--resume", action="store_true", help="continue a previous run in outdir, skipping completed steps")
+    parser.add_argument("--no-plot", action="store_true", help="do not plot a histogram of the validation scores, which is otherwise skipped with a warning if matplotlib is not installed")
+    parser.add_argument("--in-memory", action="store_true", help="pass the results between the steps in memory instead of writing and reading back intermediate files")
+    parser.add_argument("--incremental", action="store_true", help="update the results of a previous incremental run in outdir for added cells instead of computing everything again")
+    parser.add_argument("--genes", default=None, help="text file with one gene name per line; only these genes are imputed")
+    parser.add_argument("--dtype", default=None, choices=["float32", "float64"], help="floating point precision of the computation; default keeps the precision of the inputs")
+
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    """
+    Runs the gene expression imputation from the command line.
+
+    Parameters
+    ----------
+    argv : list of str, optional
+        command line arguments; default is the arguments of the current process
+    """
+
+    arguments = parse_arguments(argv)
+
+    # the pipeline is only imported after the arguments were parsed, so that e.g. --help returns immediately
+    from scimpute.api import expression_imputation
+
+    expression_imputation(
+        matrix_to_impute_for = arguments.matrix_to_impute_for,
+        matrix_to_impute_from = arguments.matrix_to_impute_from,
+        cell_identities = arguments.cell_identities,
+        cell_name_column_idx = arguments.cell_name_column_idx,
+        outdir = arguments.outdir,
+        metric = arguments.metric,
+        k_neighbors = arguments.k_neighbors,
+        consider_clusters = not arguments.ignore_clusters,
+        save_chunks = not arguments.remove_chunks,
+        chunk_size = arguments.chunk_size,
+        max_block_memory = arguments.max_block_memory,
+        reference_index = arguments.reference_index,
+        output_format = arguments.output_format,
+        n_jobs = arguments.n_jobs,
+        resume = arguments.resume,
+        plot = not arguments.no_plot,
+        dtype = arguments.dtype,
+        genes = arguments.genes,
+        in_memory = arguments.in_memory,
+        incremental = arguments.incremental,
+        write_queue_size = arguments.write_queue_size
+    )
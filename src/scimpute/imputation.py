@@ -1,9 +1,14 @@
+import numpy as np
 import pandas as pd
 import os
+import time
 from pathlib import Path
 from math import ceil
-from scimpute.utils import intersection, checkformat
-from scimpute.io import read_matrix, read_matrix_basic
+from scipy import sparse
+from functools import partial
+from scimpute.utils import checkformat, expression_values, parallel_map, dense_dot, memory_mapped_values, is_memory_mapped, gathered_dot, background_writer
+from scimpute.io import read_matrix, read_neighbors, write_imputed_matrix, read_imputed_matrix, output_extension, cast_matrix, read_gene_list, sparse_expression_matrix
+from scimpute.telemetry import stage_metrics, task_telemetry, file_size
 
 
 def impute_expression(
@@ -12,6 +17,14 @@ def impute_expression(
     similarity_matrix,
     outdir,
     chunk_size = 1000,
+    output_format = "tsv",
+    n_jobs = 1,
+    resume = False,
+    dtype = None,
+    telemetry = None,
+    genes = None,
+    write_queue_size = None,
+    cell_offset = 0
 ):
     """
     Runs gene expression imputation chunk-wise.
@@ -22,61 +35,391 @@ def impute_expression(
         pandas.DataFrame or path to file containing the gene expression matrix to perform gene expression imputation for (e.g. from a spatial experiment); genes as rows, cells/spots as columns
     y : str or pathlib.Path or pandas.DataFrame, required
         pandas.DataFrame or path to file containing the comprehensive gene expression matrix to perform gene expression imputation from (e.g. from a single cell/nucleus RNA sequencing experiment); genes as rows, cells/spots as columns
-    similarity_matrix : str or pathlib.Path or pandas.DataFrame, required
-        pandas.DataFrame or path to file containing cluster identity table, cell names from the dataset to impute gene expression for, cell names from the dataset to impute gene expression from, cell similarity/distance value
-    outdir : str or pathlib.Path, required
-        location of output directory
+    similarity_matrix : str or pathlib.Path or dict or pandas.DataFrame, required
+        compact table of most similar cells as returned by scimpute.similarity.similarity_matrix with compact=True, long-form pandas.DataFrame or path to file containing cluster identity table, cell names from the dataset to impute gene expression for, cell names from the dataset to impute gene expression from, cell similarity/distance value
+    outdir : str or pathlib.Path or None, required
+        location of output directory; if None, no imputation files are written and the imputed gene expression matrix of all cells is returned instead
     chunk_size : int, optional
         number of cells per chunk
+    output_format : {"tsv", "npz", "parquet"}, optional
+        file format of the imputed chunks
+    n_jobs : int, optional
+        number of chunks to impute in parallel; -1 uses all CPU cores
+    resume : bool, optional
+        flag indicating whether to skip chunks whose imputation files already exist in outdir; the files are only created once a chunk is completely written
+    dtype : str or numpy.dtype, optional
+        floating point type of the expression values, weights and imputed chunks, e.g. "float32" to halve memory; default keeps the type of y
+    telemetry : dict, optional
+        report created by scimpute.telemetry.new_report with a running "imputation" stage; the cells and genes of the stage and the wall and CPU time and written bytes of every chunk are recorded in it
+    genes : list-like or str or pathlib.Path, optional
+        genes to impute, or path to a text file with one gene name per line; only the expression of these genes is aggregated and written, in the given order; default imputes all genes of y
+    write_queue_size : int, optional
+        number of imputed chunks that may wait to be written by a background thread while the next chunks are imputed, which overlaps the computation with the serialization and writing of the files; every waiting chunk is held in memory; default writes every chunk right after it is imputed
+    cell_offset : int, optional
+        position of the first cell of x in a larger matrix whose chunks are written to the same "imputations" folder, e.g. by the shards of a sharded run; the chunk files are named by the positions of their cells in the larger matrix, so that merge_imputation_chunks can combine them
+
+    Returns
+    -------
+    imputed_results_df : pandas.DataFrame or None
+        if outdir is None, the imputed gene expression of all cells, indexed by cell name; otherwise the imputed gene expression of the last chunk with the cell names in the column "cell", or None if x has no cells
     """
 
     xformat = checkformat(x)
     yformat = checkformat(y)
-    similarity_matrixformat = checkformat(similarity_matrix)
+    similarity_matrixformat = "neighbors" if isinstance(similarity_matrix, dict) else checkformat(similarity_matrix)
 
     if xformat == "path":
-        x = read_matrix(x)
+        x = read_matrix(x, dtype=dtype)
+    elif xformat == "sparse":
+        x = sparse_expression_matrix(*x)
     if yformat == "path":
-        y = read_matrix(y)
+        y = read_matrix(y, dtype=dtype)
+    elif yformat == "sparse":
+        y = sparse_expression_matrix(*y)
     if similarity_matrixformat == "path":
-        similarity_matrix = read_matrix_basic(similarity_matrix)
+        similarity_matrix = read_neighbors(similarity_matrix)
 
-    Path(os.path.join(outdir, "imputations")).mkdir(parents=True, exist_ok=True)
+    y_genes = selected_genes(y.columns, genes)
+    y_columns = None
+    if memory_mapped_values(y) is not None:
+        # only the rows of the neighbors of every chunk are read from a memory-mapped reference
+        y_values = memory_mapped_values(y)
+        if not y_genes.equals(y.columns):
+            y_columns = y.columns.get_indexer(y_genes)
+    else:
+        if not y_genes.equals(y.columns):
+            y = y[y_genes]
+        y_values = expression_values(cast_matrix(y, dtype))
+    weights_dtype = y_values.dtype if np.issubdtype(y_values.dtype, np.floating) else np.float64
+    if isinstance(similarity_matrix, dict):
+        weights = neighbor_weights(similarity_matrix, x.index, y.index, dtype=weights_dtype)
+    else:
+        weights = weight_matrix(similarity_matrix, x.index, y.index, dtype=weights_dtype)
 
-    imputation_cell_idx_start = 0
-    imputation_cell_idx_stop = imputation_cell_idx_start + chunk_size
     nIterations = ceil(len(x.index) / chunk_size)
+    chunks = [(i, i * chunk_size, min((i + 1) * chunk_size, len(x.index))) for i in range(nIterations)]
+    stage_metrics(telemetry, "imputation", cells=len(x.index), reference_cells=len(y.index), genes=len(y_genes), neighbors=weights.nnz, tasks_total=nIterations)
+
+    if outdir is None:
+        imputed_expression = np.empty((len(x.index), len(y_genes)), dtype=np.result_type(weights.dtype, y_values.dtype))
+        parallel_map(
+            partial(impute_chunk_into, weights=weights, y_values=y_values, imputed_expression=imputed_expression, y_columns=y_columns, telemetry=telemetry),
+            chunks,
+            n_jobs=n_jobs
+        )
+        return pd.DataFrame(imputed_expression, index=pd.Index(x.index, name="cell"), columns=y_genes, copy=False)
+
+    Path(os.path.join(outdir, "imputations")).mkdir(parents=True, exist_ok=True)
+
+    with background_writer(write_queue_size) as writer:
+        imputed_chunks = parallel_map(
+            partial(
+                impute_and_write_chunk,
+                weights=weights,
+                y_values=y_values,
+                y_columns=y_columns,
+                cells=x.index,
+                genes=y_genes,
+                outdir=outdir,
+                output_format=output_format,
+                last_chunk=nIterations - 1,
+                resume=resume,
+                telemetry=telemetry,
+                writer=writer,
+                cell_offset=cell_offset
+            ),
+            chunks,
+            n_jobs=n_jobs
+        )
+
+    return imputed_chunks[-1] if imputed_chunks else None
+
+def impute_and_write_chunk(
+    chunk,
+    weights,
+    y_values,
+    y_columns,
+    cells,
+    genes,
+    outdir,
+    output_format,
+    last_chunk,
+    resume = False,
+    telemetry = None,
+    writer = None,
+    cell_offset = 0
+):
+    """
+    Imputes gene expression for one chunk of cells and writes it to the "imputations" folder.
+
+    Parameters
+    ----------
+    chunk : tuple of int, required
+        chunk number, index of the first cell and index after the last cell of the chunk
+    weights : scipy.sparse.csr_matrix, required
+        sparse weight matrix of all cells to impute for (rows) against all cells to impute from (columns)
+    y_values : numpy.ndarray or scipy.sparse.csr_matrix, required
+        gene expression values of the cells to impute from; cells as rows, genes as columns
+    y_columns : numpy.ndarray or None, required
+        positions of the genes to impute in the columns of y_values; None imputes all columns
+    cells : pandas.Index, required
+        names of all cells to impute for
+    genes : pandas.Index, required
+        names of the imputed genes
+    outdir : str or pathlib.Path, required
+        location of output directory
+    output_format : {"tsv", "npz", "parquet"}, required
+        file format of the imputed chunk
+    last_chunk : int, required
+        number of the last chunk, whose imputed table is returned
+    resume : bool, optional
+        flag indicating whether to skip the chunk if its imputation file already exists
+    telemetry : dict, optional
+        report created by scimpute.telemetry.new_report to record the chunk in
+    writer : callable, optional
+        function that runs the write of the chunk, e.g. queued by scimpute.utils.background_writer; default writes it immediately
+    cell_offset : int, optional
+        position of the first of all cells in a larger matrix, by which the chunk file is named
+
+    Returns
+    -------
+    imputed_results_df : pandas.DataFrame or None
+        imputed gene expression of the chunk with the cell names in the column "cell" if it is the last chunk, None otherwise
+    """
+
+    i, imputation_cell_idx_start, imputation_cell_idx_stop = chunk
+    file_start, file_stop = imputation_cell_idx_start + cell_offset, imputation_cell_idx_stop + cell_offset
+    chunk_file = os.path.join(outdir, "imputations", f"CPM_imputation_{i:03}_{file_start}_{file_stop}")
 
+    with task_telemetry(telemetry, "imputation", f"chunk {i}", cells=imputation_cell_idx_stop - imputation_cell_idx_start) as task:
+        if resume and os.path.exists(f"{chunk_file}{output_extension(output_format)}"):
+            print(f"imputation in range of: {file_start} to {file_stop} already completed")
+            task["skipped"] = True
+            if i == last_chunk:
+                return read_imputed_matrix(f"{chunk_file}{output_extension(output_format)}").reset_index()
+            return None
 
-    for i in range(nIterations):
-        imputed_results = []
-        if imputation_cell_idx_stop > len(x.index):
-            imputation_cell_idx_stop = len(x.index)
+        print(f"imputation in range of: {file_start} to {file_stop}")
+
+        imputed_expression = impute_chunk(weights[imputation_cell_idx_start:imputation_cell_idx_stop], y_values, y_columns=y_columns)
+
+        imputed_results_df = pd.DataFrame(imputed_expression, columns=genes)
+        imputed_results_df.insert(0, "cell", cells[imputation_cell_idx_start:imputation_cell_idx_stop])
+        write = partial(write_chunk, imputed_results_df.set_index("cell"), chunk_file, output_format, task)
+        if writer is None:
+            write()
+        else:
+            writer(write)
+
+    if i == last_chunk:
+        return imputed_results_df
+    return None
+
+def write_chunk(
+    imputed_mtx,
+    chunk_file,
+    output_format,
+    task = None
+):
+    """
+    Writes an imputed chunk under a temporary name and only gives it its final name once it is completely written.
+
+    Parameters
+    ----------
+    imputed_mtx : pandas.DataFrame, required
+        imputed gene expression of the chunk; cell names as index, genes as columns
+    chunk_file : str, required
+        path of the chunk file without extension
+    output_format : {"tsv", "npz", "parquet"}, required
+        file format of the imputed chunk
+    task : dict, optional
+        telemetry entry of the chunk, in which the time spent writing and the written bytes are recorded
+    """
+
+    start = time.perf_counter()
+    partial_file = write_imputed_matrix(imputed_mtx, f"{chunk_file}.partial", output_format)
+    os.replace(partial_file, f"{chunk_file}{output_extension(output_format)}")
+    if task is not None:
+        task["write_seconds"] = time.perf_counter() - start
+        task["bytes_written"] = file_size(f"{chunk_file}{output_extension(output_format)}")
+
+def impute_chunk_into(
+    chunk,
+    weights,
+    y_values,
+    imputed_expression,
+    y_columns = None,
+    telemetry = None
+):
+    """
+    Imputes gene expression for one chunk of cells into its rows of a preallocated matrix of all cells.
+
+    Parameters
+    ----------
+    chunk : tuple of int, required
+        chunk number, index of the first cell and index after the last cell of the chunk
+    weights : scipy.sparse.csr_matrix, required
+        sparse weight matrix of all cells to impute for (rows) against all cells to impute from (columns)
+    y_values : numpy.ndarray or scipy.sparse.csr_matrix, required
+        gene expression values of the cells to impute from; cells as rows, genes as columns
+    imputed_expression : numpy.ndarray, required
+        imputed gene expression of all cells to impute for, filled in place; chunks processed in parallel write to separate rows
+    y_columns : numpy.ndarray, optional
+        positions of the genes to impute in the columns of y_values; default imputes all columns
+    telemetry : dict, optional
+        report created by scimpute.telemetry.new_report to record the chunk in
+    """
+
+    i, imputation_cell_idx_start, imputation_cell_idx_stop = chunk
+    with task_telemetry(telemetry, "imputation", f"chunk {i}", cells=imputation_cell_idx_stop - imputation_cell_idx_start):
         print(f"imputation in range of: {imputation_cell_idx_start} to {imputation_cell_idx_stop}")
+        imputed_expression[imputation_cell_idx_start:imputation_cell_idx_stop] = impute_chunk(weights[imputation_cell_idx_start:imputation_cell_idx_stop], y_values, y_columns=y_columns)
+
+def selected_genes(
+    available_genes,
+    genes
+):
+    """
+    Returns the genes to impute in the order they were requested, without duplicates.
+
+    Parameters
+    ----------
+    available_genes : pandas.Index, required
+        genes of the gene expression matrix to impute from
+    genes : list-like or str or pathlib.Path or None, required
+        genes to impute, or path to a text file with one gene name per line; None selects all available genes
+    """
+
+    if genes is None:
+        return available_genes
+    if isinstance(genes, (str, Path)):
+        genes = read_gene_list(genes)
+    genes = pd.Index(genes).drop_duplicates()
+    missing = genes.difference(available_genes)
+    if len(missing) > 0:
+        raise ValueError(f"Genes not found in the matrix to impute from: {list(missing[:10])}")
+    if len(genes) == 0:
+        raise ValueError("No genes were selected for the imputation.")
+
+    return genes
+
+def weight_matrix(
+    similarity_matrix,
+    x_index,
+    y_index,
+    dtype = np.float64
+):
+    """
+    Converts the long-form similarity table into a sparse weight matrix with one row per cell to impute for and one column per cell to impute from.
+
+    Neighbor pairs that occur more than once (e.g. when every cluster was compared against the full dataset) are only counted once, as in scimpute.neighbors.neighbors_from_table, so that no neighbor gains extra weight.
+
+    Parameters
+    ----------
+    similarity_matrix : pandas.DataFrame, required
+        table with the columns "x", "y" and "distance" as written by scimpute.similarity.similarity_matrix
+    x_index : pandas.Index, required
+        cell names of the dataset to impute gene expression for, in output order
+    y_index : pandas.Index, required
+        cell names of the dataset to impute gene expression from, in the row order of its expression matrix
+    dtype : str or numpy.dtype, optional
+        floating point type of the weights
+    """
+
+    rows = pd.Index(x_index).get_indexer(similarity_matrix["x"])
+    cols = pd.Index(y_index).get_indexer(similarity_matrix["y"])
+    if (cols == -1).any():
+        missing = similarity_matrix["y"][cols == -1].unique()
+        raise KeyError(f"Neighboring cells not found in the matrix to impute from: {list(missing[:10])}")
+
+    # neighbors of cells that are not part of x are not needed for the imputation
+    keep = np.flatnonzero(rows != -1)
+    _, first = np.unique(rows[keep].astype(np.int64) * len(y_index) + cols[keep], return_index=True)
+    keep = keep[first]
+    weights = sparse.coo_matrix(
+        (similarity_matrix["distance"].to_numpy(dtype=dtype)[keep], (rows[keep], cols[keep])),
+        shape=(len(x_index), len(y_index))
+    )
+
+    return weights.tocsr()
+
+def neighbor_weights(
+    neighbors,
+    x_index,
+    y_index,
+    dtype = np.float64
+):
+    """
+    Converts a compact table of most similar cells into a sparse weight matrix with one row per cell to impute for and one column per cell to impute from.
+
+    Cell names are only matched once per cell instead of once per neighbor.
+
+    Parameters
+    ----------
+    neighbors : dict, required
+        compact table created by scimpute.neighbors.compact_neighbors
+    x_index : pandas.Index, required
+        cell names of the dataset to impute gene expression for, in output order
+    y_index : pandas.Index, required
+        cell names of the dataset to impute gene expression from, in the row order of its expression matrix
+    dtype : str or numpy.dtype, optional
+        floating point type of the weights
+    """
+
+    y_index = pd.Index(y_index)
+    if neighbors["reference_cells"].equals(y_index):
+        columns = None
+    else:
+        columns = y_index.get_indexer(neighbors["reference_cells"])
+
+    # neighbors of cells that are not part of x are not needed for the imputation
+    rows = pd.Index(x_index).get_indexer(neighbors["cells"])
+    valid = (neighbors["indices"] != -1) & (rows != -1)[:, None]
+    cols = neighbors["indices"][valid]
+    if columns is not None:
+        cols = columns[cols]
+        if (cols == -1).any():
+            missing = neighbors["reference_cells"][np.unique(neighbors["indices"][valid][cols == -1])]
+            raise KeyError(f"Neighboring cells not found in the matrix to impute from: {list(missing[:10])}")
+
+    weights = sparse.coo_matrix(
+        (neighbors["distances"][valid].astype(dtype, copy=False), (np.repeat(rows, valid.sum(axis=1)), cols)),
+        shape=(len(x_index), len(y_index))
+    )
+
+    return weights.tocsr()
+
+def impute_chunk(
+    weights,
+    y_values,
+    y_columns = None
+):
+    """
+    Imputes gene expression for a block of cells as the weighted average of their neighbors' expression profiles.
+
+    If y_values are memory-mapped, only the rows of the neighbors of the block are read from them.
+
+    Parameters
+    ----------
+    weights : scipy.sparse.csr_matrix, required
+        sparse weight matrix for the block of cells to impute for (rows) against all cells to impute from (columns)
+    y_values : numpy.ndarray or scipy.sparse.csr_matrix, required
+        gene expression values of the cells to impute from; cells as rows, genes as columns
+    y_columns : numpy.ndarray, optional
+        positions of the genes to impute in the columns of y_values; default imputes all columns
+
+    Returns
+    -------
+    imputed_expression : numpy.ndarray
+        imputed gene expression rounded to two decimals; cells as rows, genes as columns; cells without any neighbors are NaN
+    """
+
+    weight_sums = np.asarray(weights.sum(axis=1)).ravel()
+    if is_memory_mapped(y_values):
+        weighted_sums = gathered_dot(weights, y_values, columns=y_columns)
+    else:
+        weighted_sums = dense_dot(weights, y_values if y_columns is None else y_values[:, y_columns])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        imputed_expression = weighted_sums / weight_sums[:, None]
 
-        for target_cell in x.index[imputation_cell_idx_start:imputation_cell_idx_stop]:
-            distances_for_target = similarity_matrix[similarity_matrix["x"] == target_cell]
-            neighboring_cells = distances_for_target["y"]
-            distances = distances_for_target["distance"]
-        
-            weights = distances  # Inverse distance as weights (you may choose a different weighting scheme)
-            weights = weights.reset_index(drop=True)
-        
-        
-            # Get neighboring gene expressions
-            neighboring_gene_expression = y.loc[neighboring_cells]
-            neighboring_gene_expression = neighboring_gene_expression.reset_index(drop=True)
-        
-            # Calculate imputed expression for each gene
-            imputed_expression = round((neighboring_gene_expression.T * weights).sum(axis=1) / weights.sum(), 2)
-        
-            imputed_results.append({"cell": target_cell, **imputed_expression.to_dict()})
-
-        columns = ["cell"] + list(y.columns)
-        imputed_results_df = pd.DataFrame(imputed_results, columns=columns)
-        imputed_results_df.to_csv(os.path.join(outdir, "imputations", f"CPM_imputation_{i:03}_{imputation_cell_idx_start}_{imputation_cell_idx_stop}.tsv"), sep="\t")
-
-        imputation_cell_idx_start = imputation_cell_idx_stop
-        imputation_cell_idx_stop = chunk_size * (i+2)
-    
-    return imputed_results_df
\ No newline at end of file
+    return np.round(imputed_expression, 2)
@@ -0,0 +1,226 @@
+import os
+import numpy as np
+import pandas as pd
+from scimpute.similarity import similarity_matrix
+from scimpute.imputation import impute_expression
+from scimpute.io import read_imputed_cells, read_imputed_genes, read_imputed_matrix_blocks, write_imputed_matrix_chunks, output_extension
+from scimpute.neighbors import concat_neighbors, select_neighbors, merge_neighbors, count_neighbors
+from scimpute.telemetry import stage_metrics
+
+REFERENCE_CELLS_FILE = "reference_cells.tsv"
+
+
+def update_neighbors(
+    x,
+    y,
+    clusters,
+    cell_name_column_idx,
+    previous_neighbors,
+    previous_reference_cells,
+    metric = "cosine_similarity",
+    k_neighbors = 25,
+    consider_clusters = True,
+    max_block_memory = None,
+    n_jobs = 1,
+    telemetry = None
+):
+    """
+    Updates the most similar cells of a previous run for added cells of both datasets instead of searching all pairs again.
+
+    Cells to impute for without stored neighbors are compared against all cells to impute from. The other cells are only compared against the added cells to impute from, and these candidates are merged into their stored top k neighbors. Cells whose stored neighbors include removed cells to impute from are searched again. Cells that are part of both runs are assumed to have unchanged gene expression and cluster identities.
+
+    Parameters
+    ----------
+    x : pandas.DataFrame, required
+        gene expression matrix to perform gene expression imputation for; genes as columns, cells/spots as rows
+    y : pandas.DataFrame, required
+        comprehensive gene expression matrix to perform gene expression imputation from; genes as columns, cells/spots as rows
+    clusters : pandas.DataFrame, required
+        identities for all cells from both datasets in the column "id"
+    cell_name_column_idx : int, required
+        index of the column containing the cell names (not the cell type clusters)
+    previous_neighbors : dict, required
+        compact table of the most similar cells of the previous run
+    previous_reference_cells : pandas.Index, required
+        cells of the matrix to impute from of the previous run
+    metric : {"cosine_similarity", "approximate_cosine_similarity"}, optional
+        similarity metric
+    k_neighbors : int, optional
+        number of k nearest neighbors to find between datasets
+    consider_clusters : bool, optional
+        flag indicating whether to only identify similar cells between datasets within the same annotated cluster
+    max_block_memory : int or float, optional
+        maximum memory in megabytes for the blocks of the similarity search
+    n_jobs : int, optional
+        number of clusters to process in parallel; -1 uses all CPU cores
+    telemetry : dict, optional
+        report created by scimpute.telemetry.new_report with a running "similarity" stage; the added, removed and updated cells are recorded in it
+
+    Returns
+    -------
+    neighbors : dict
+        compact table of the most similar cells of all cells of x, in the order of x and referring to all cells of y
+    updated_cells : pandas.Index
+        cells of x whose neighbors were searched or changed, in the order of x
+    """
+
+    # the stored neighbor positions are moved to the positions of the same cells in y
+    positions = y.index.get_indexer(previous_neighbors["reference_cells"])
+    stored = previous_neighbors["indices"] != -1
+    indices = np.where(stored, positions[np.where(stored, previous_neighbors["indices"], 0)], -1)
+    stale = (stored & (indices == -1)).any(axis=1)
+    previous_neighbors = select_neighbors({**previous_neighbors, "indices": indices, "reference_cells": y.index}, ~stale & previous_neighbors["cells"].isin(x.index))
+    removed_reference_cells = previous_reference_cells.difference(y.index)
+
+    kept_cells = x.index[x.index.isin(previous_neighbors["cells"])]
+    new_cells = x.index[~x.index.isin(kept_cells)]
+    new_reference_rows = np.flatnonzero(~y.index.isin(previous_reference_cells))
+    print(f"Incremental update: {len(new_cells)} cells without neighbors, {len(new_reference_rows)} added and {len(removed_reference_cells)} removed reference cells")
+
+    search = dict(
+        clusters = clusters,
+        cell_name_column_idx = cell_name_column_idx,
+        outdir = None,
+        metric = metric,
+        k_neighbors = k_neighbors,
+        consider_clusters = consider_clusters,
+        max_block_memory = max_block_memory,
+        n_jobs = n_jobs,
+        telemetry = telemetry,
+        compact = True
+    )
+    changed = np.zeros(len(previous_neighbors["cells"]), dtype=bool)
+    if len(kept_cells) > 0 and len(new_reference_rows) > 0:
+        candidates = similarity_matrix(x.loc[kept_cells], y.iloc[new_reference_rows], **search)
+        candidates = {**candidates, "indices": np.where(candidates["indices"] != -1, new_reference_rows[candidates["indices"]], -1), "reference_cells": y.index}
+        previous_neighbors = merge_neighbors(previous_neighbors, candidates, k_neighbors)
+        changed = np.isin(previous_neighbors["indices"], new_reference_rows).any(axis=1)
+    parts = [previous_neighbors]
+    if len(new_cells) > 0:
+        parts.append(similarity_matrix(x.loc[new_cells], y, **search))
+    neighbors = concat_neighbors(parts, y.index)
+    neighbors = select_neighbors(neighbors, np.argsort(x.index.get_indexer(neighbors["cells"]), kind="stable"))
+
+    updated_cells = x.index[x.index.isin(new_cells) | x.index.isin(previous_neighbors["cells"][changed])]
+    stage_metrics(telemetry, "similarity", cells=len(x.index), new_cells=len(new_cells), added_reference_cells=len(new_reference_rows), removed_reference_cells=len(removed_reference_cells), updated_cells=len(updated_cells), neighbors=count_neighbors(neighbors))
+    return (neighbors, updated_cells)
+
+def update_imputation(
+    x,
+    y,
+    neighbors,
+    updated_cells,
+    outdir,
+    chunk_size = 1000,
+    output_format = "tsv",
+    n_jobs = 1,
+    telemetry = None,
+    genes = None
+):
+    """
+    Imputes gene expression for the updated cells only and combines it with the stored imputation of all other cells into a new final imputed gene expression matrix.
+
+    Cells without a stored imputation are imputed as well. The stored imputation is read block by block of cells, and the final matrix is written chunk by chunk next to the previous one and only replaces it once it is complete, so that only the imputation of the updated cells is held in memory as a whole.
+
+    Parameters
+    ----------
+    x : pandas.DataFrame, required
+        gene expression matrix to perform gene expression imputation for; genes as columns, cells/spots as rows
+    y : pandas.DataFrame, required
+        comprehensive gene expression matrix to perform gene expression imputation from; genes as columns, cells/spots as rows
+    neighbors : dict, required
+        compact table of the most similar cells of all cells of x
+    updated_cells : pandas.Index, required
+        cells of x to impute again
+    outdir : str or pathlib.Path, required
+        location of the output directory containing the final imputed gene expression matrix of the previous run
+    chunk_size : int, optional
+        number of cells per chunk
+    output_format : {"tsv", "npz", "parquet"}, optional
+        file format of the final imputed gene expression matrix
+    n_jobs : int, optional
+        number of chunks to impute in parallel; -1 uses all CPU cores
+    telemetry : dict, optional
+        report created by scimpute.telemetry.new_report with a running "imputation" stage
+    genes : list-like, optional
+        genes to impute; default imputes all genes of y
+
+    Returns
+    -------
+    filepath : str
+        path of the final imputed gene expression matrix
+    """
+
+    filepath = os.path.join(outdir, f"imputation{output_extension(output_format)}")
+    updated_cells = x.index[x.index.isin(updated_cells) | ~x.index.isin(read_imputed_cells(filepath))]
+    stage_metrics(telemetry, "imputation", updated_cells=len(updated_cells))
+
+    imputed = impute_expression(
+        x.loc[updated_cells],
+        y,
+        similarity_matrix = neighbors,
+        outdir = None,
+        chunk_size = chunk_size,
+        n_jobs = n_jobs,
+        telemetry = telemetry,
+        genes = genes
+    )
+    if not imputed.columns.equals(read_imputed_genes(filepath)):
+        raise ValueError(f"The stored imputation in {filepath} contains different genes than the updated cells.")
+
+    stored_cells = x.index[~x.index.isin(imputed.index)]
+    def updated_chunks():
+        previous_blocks = read_imputed_matrix_blocks(filepath, chunk_size)
+        # stored rows that were read but are not written yet; if the cells keep their order, these are at most about two chunks
+        pending = imputed.iloc[:0]
+        for start in range(0, len(x.index), chunk_size):
+            cells = x.index[start:start + chunk_size]
+            updated = cells.isin(imputed.index)
+            while not cells[~updated].isin(pending.index).all():
+                block = next(previous_blocks, None)
+                if block is None:
+                    break
+                pending = pd.concat([pending, block[block.index.isin(stored_cells)]])
+            chunk = pending.reindex(cells)
+            chunk.index.name = "cell"
+            chunk.loc[updated] = imputed.loc[cells[updated]].to_numpy()
+            pending = pending[~pending.index.isin(cells)]
+            yield chunk
+        previous_blocks.close()
+
+    partial_file = write_imputed_matrix_chunks(updated_chunks(), os.path.join(outdir, "imputation.partial"), output_format, n_cells=len(x.index))
+    os.replace(partial_file, filepath)
+
+    return filepath
+
+def write_reference_cells(
+    reference_cells,
+    outdir
+):
+    """
+    Writes the cells of the matrix to impute from of a run, so that an incremental run can tell which of its cells were added or removed.
+
+    Parameters
+    ----------
+    reference_cells : pandas.Index, required
+        cells of the matrix to impute from
+    outdir : str or pathlib.Path, required
+        location of the output directory
+    """
+
+    pd.Series(reference_cells).to_csv(os.path.join(outdir, REFERENCE_CELLS_FILE), sep="\t", index=False, header=False)
+
+def read_reference_cells(
+    outdir
+):
+    """
+    Reads the cells of the matrix to impute from of a previous run.
+
+    Parameters
+    ----------
+    outdir : str or pathlib.Path, required
+        location of the output directory
+    """
+
+    cells = pd.read_csv(os.path.join(outdir, REFERENCE_CELLS_FILE), sep="\t", header=None, dtype=str)[0]
+    return pd.Index(cells.to_numpy())
@@ -1,75 +1,275 @@
+import numpy as np
 import pandas as pd
+from scipy import sparse
 from pathlib import Path
 import os
+import shutil
+import struct
+import zipfile
+from scimpute.neighbors import compact_neighbors, neighbor_table, neighbors_from_table
 
 def read_inputs(
     matrix_to_impute_for,
     matrix_to_impute_from,
     cell_identities,
     cell_name_column_idx,
-    outdir
+    outdir,
+    dtype = None
 ):
     """
     Reading all needed input files.
 
     Parameters
     ----------
-    matrix_to_impute_for : str or pathlib.Path, required
-        gene expression matrix to perform gene expression imputation for (e.g. from a spatial experiment)
-    matrix_to_impute_from : str or Path, required
-        comprehensive gene expression matrix to perform gene expression imputation from (e.g. from a single cell/nucleus RNA sequencing experiment)
+    matrix_to_impute_for : str or pathlib.Path or pandas.DataFrame or tuple, required
+        gene expression matrix to perform gene expression imputation for (e.g. from a spatial experiment); tab-separated text, Matrix Market or 10x Genomics HDF5 file, a pandas.DataFrame with dense or sparse columns, or a tuple (matrix, cells, genes) of a scipy.sparse CSR or CSC matrix with cells/spots as rows and its cell and gene names
+    matrix_to_impute_from : str or Path or pandas.DataFrame or tuple, required
+        comprehensive gene expression matrix to perform gene expression imputation from (e.g. from a single cell/nucleus RNA sequencing experiment); in the same formats as matrix_to_impute_for
     cell_identities : str or Path, required
         table containing identities for all cells from both datasets
     cell_name_column_idx : int, required
         index of the column containing the cell names (not the cell type clusters)
-    outdir : str or pathlib.Path, required
-        location of output directory
+    outdir : str or pathlib.Path or None, required
+        location of output directory, which is created if it does not exist; None if no output is written
+    dtype : str or numpy.dtype, optional
+        floating point type to store the gene expression matrices in, e.g. "float32" to halve their memory; default keeps the type they are read in
     """
 
-    if os.path.isabs(outdir):
+    if outdir is None:
+        save_location = None
+    elif os.path.isabs(outdir):
         save_location = outdir
     else:
         save_location = os.path.join(os.getcwd(), outdir)
-    Path(save_location).mkdir(parents=True, exist_ok=True)
+    if save_location is not None:
+        Path(save_location).mkdir(parents=True, exist_ok=True)
 
-    if isinstance(matrix_to_impute_for, pd.DataFrame):
-        x = matrix_to_impute_for
-    else:
-        x = read_matrix(matrix_to_impute_for)
-    if isinstance(matrix_to_impute_from, pd.DataFrame):
-        y = matrix_to_impute_from
-    else:
-        y = read_matrix(matrix_to_impute_from)
+    x = expression_matrix(matrix_to_impute_for, dtype=dtype)
+    y = expression_matrix(matrix_to_impute_from, dtype=dtype)
     if isinstance(cell_identities, pd.DataFrame):
         clusters = cell_identities
     else:
         clusters = read_cell_identities(cell_identities, index_column=cell_name_column_idx)
 
-    return (x, y, clusters, Path(save_location))
+    return (x, y, clusters, None if save_location is None else Path(save_location))
+
+def expression_matrix(
+    data,
+    dtype = None
+):
+    """
+    Returns a gene expression matrix given as a file, a pandas.DataFrame or a scipy.sparse matrix with its cell and gene names as a pandas.DataFrame.
+
+    Parameters
+    ----------
+    data : str or pathlib.Path or pandas.DataFrame or tuple, required
+        path to a file readable by read_matrix, a pandas.DataFrame with dense or sparse columns, or a tuple (matrix, cells, genes) of a scipy.sparse CSR or CSC matrix (cells/spots as rows, genes as columns) and its cell and gene names
+    dtype : str or numpy.dtype, optional
+        floating point type to store the values in; default keeps the type they are read in
+    """
+
+    if isinstance(data, pd.DataFrame):
+        return cast_matrix(data, dtype)
+    if isinstance(data, tuple) and len(data) == 3 and sparse.issparse(data[0]):
+        return cast_matrix(sparse_expression_matrix(*data), dtype)
+    return read_matrix(data, dtype=dtype)
 
 def read_matrix(
     filepath,
-    separator="\t"
+    separator="\t",
+    dtype=None
 ):
     """
     Reads a gene expression matrix.
 
+    Tab-separated text files are read into a dense matrix. Matrix Market files (".mtx" or ".mtx.gz", or a directory containing "matrix.mtx.gz" as written by 10x Genomics Cell Ranger) and 10x Genomics HDF5 files (".h5") are read into a matrix with sparse columns.
+
     Parameters
     ----------
     filepath : str or pathlib.Path, required
         filepath to the gene expression file
     separator : str or RegEx, optional
         field separator of the gene expression file
+    dtype : str or numpy.dtype, optional
+        floating point type of the values; default is the type inferred from text files and float64 for sparse files
     """
 
     mtx = Path(filepath)
     if not mtx.exists():
         raise FileNotFoundError(f"Matrix file not found: {mtx}")
+    if matrix_file_format(mtx) == "mtx":
+        return read_mtx(mtx, dtype=dtype or np.float64)
+    if matrix_file_format(mtx) == "h5":
+        return read_10x_h5(mtx, dtype=dtype or np.float64)
     mtx = pd.read_csv(filepath, sep=separator, index_col=0)
     mtx = mtx.transpose()
+    mtx = cast_matrix(mtx, dtype)
     
     return mtx
 
+def matrix_file_format(
+    filepath
+):
+    """
+    Returns the format of a gene expression matrix file as read by read_matrix: "mtx" for Matrix Market files and directories, "h5" for 10x Genomics HDF5 files and "tsv" for all other (text) files.
+
+    Parameters
+    ----------
+    filepath : str or pathlib.Path, required
+        filepath to the gene expression file
+    """
+
+    filepath = Path(filepath)
+    if filepath.is_dir() or filepath.name.endswith((".mtx", ".mtx.gz")):
+        return "mtx"
+    if filepath.suffix in (".h5", ".hdf5"):
+        return "h5"
+    return "tsv"
+
+def read_mtx(
+    filepath,
+    dtype=np.float64
+):
+    """
+    Reads a sparse gene expression matrix in Matrix Market format with genes as rows and cells as columns, as written by 10x Genomics Cell Ranger.
+
+    The cell names are read from "barcodes.tsv" and the gene names from "features.tsv" (second column) or "genes.tsv" next to the matrix file; all three files may be gzip-compressed.
+
+    Parameters
+    ----------
+    filepath : str or pathlib.Path, required
+        filepath to the Matrix Market file, or to a directory containing "matrix.mtx" or "matrix.mtx.gz"
+    dtype : str or numpy.dtype, optional
+        floating point type of the values
+    """
+
+    mtx = Path(filepath)
+    if mtx.is_dir():
+        mtx = find_file(mtx, ["matrix.mtx.gz", "matrix.mtx"])
+    barcodes = find_file(mtx.parent, ["barcodes.tsv.gz", "barcodes.tsv"])
+    features = find_file(mtx.parent, ["features.tsv.gz", "features.tsv", "genes.tsv.gz", "genes.tsv"])
+
+    cells = pd.read_csv(barcodes, sep="\t", header=None, dtype=str)[0]
+    genes = pd.read_csv(features, sep="\t", header=None, dtype=str)
+    genes = genes[1] if genes.shape[1] > 1 else genes[0]
+
+    from scipy.io import mmread
+
+    values = sparse.csc_matrix(mmread(mtx).T, dtype=dtype)
+
+    return sparse_expression_matrix(values, cells, genes)
+
+def read_10x_h5(
+    filepath,
+    dtype=np.float64
+):
+    """
+    Reads a sparse gene expression matrix from a 10x Genomics HDF5 feature-barcode matrix file. Requires the optional dependency h5py.
+
+    Parameters
+    ----------
+    filepath : str or pathlib.Path, required
+        filepath to the HDF5 file
+    dtype : str or numpy.dtype, optional
+        floating point type of the values
+    """
+
+    try:
+        import h5py
+    except ImportError:
+        raise ImportError("Reading 10x Genomics HDF5 files requires h5py. Install it with 'pip install \"scimpute[hdf5]\"'.")
+
+    with h5py.File(filepath, "r") as f:
+        if "matrix" in f:
+            group = f["matrix"]
+            genes = group["features"]["name"][:]
+        else:
+            # Cell Ranger < 3.0 stores one group per genome
+            group = f[list(f.keys())[0]]
+            genes = group["gene_names"][:]
+        n_genes, n_cells = group["shape"][:]
+        cells = group["barcodes"][:]
+        # the stored genes x cells CSC matrix is the cells x genes CSR matrix
+        values = sparse.csr_matrix(
+            (group["data"][:].astype(dtype), group["indices"][:], group["indptr"][:]),
+            shape=(n_cells, n_genes)
+        )
+
+    return sparse_expression_matrix(values, pd.Index(cells).str.decode("utf-8"), pd.Index(genes).str.decode("utf-8"))
+
+def sparse_expression_matrix(
+    matrix,
+    cells,
+    genes
+):
+    """
+    Wraps a scipy.sparse matrix into a gene expression matrix with sparse columns, which can be used as input for all steps of the gene expression imputation.
+
+    Parameters
+    ----------
+    matrix : scipy.sparse.spmatrix, required
+        gene expression values; cells/spots as rows, genes as columns
+    cells : list-like, required
+        cell names in the row order of matrix
+    genes : list-like, required
+        gene names in the column order of matrix
+    """
+
+    matrix = sparse.csc_matrix(matrix)
+    matrix.sort_indices()
+    # the columns are built one by one with an explicit fill value, because pandas.DataFrame.sparse.from_spmatrix fills the omitted values with NaN in pandas 3
+    dtype = pd.SparseDtype(matrix.dtype, matrix.dtype.type(0))
+    columns = {}
+    for i in range(matrix.shape[1]):
+        column = pd.arrays.SparseArray.from_spmatrix(matrix[:, [i]])
+        columns[i] = column if column.dtype == dtype else column.astype(dtype)
+    mtx = pd.DataFrame(columns, index=pd.Index(cells), copy=False)
+    mtx.columns = pd.Index(genes)
+
+    return mtx
+
+def cast_matrix(
+    mtx,
+    dtype
+):
+    """
+    Converts the values of a dense or sparse gene expression matrix to another type.
+
+    Parameters
+    ----------
+    mtx : pandas.DataFrame, required
+        gene expression matrix; genes as columns, cells/spots as rows
+    dtype : str or numpy.dtype or None, required
+        type to convert the values to; None leaves the matrix unchanged
+    """
+
+    if dtype is None or all(column_dtype == np.dtype(dtype) or getattr(column_dtype, "subtype", None) == np.dtype(dtype) for column_dtype in mtx.dtypes):
+        return mtx
+    if len(mtx.columns) > 0 and all(isinstance(column_dtype, pd.SparseDtype) for column_dtype in mtx.dtypes):
+        return sparse_expression_matrix(mtx.sparse.to_coo().astype(dtype), mtx.index, mtx.columns)
+    return mtx.astype(dtype)
+
+def find_file(
+    directory,
+    filenames
+):
+    """
+    Returns the first of several candidate files that exists in a directory.
+
+    Parameters
+    ----------
+    directory : str or pathlib.Path, required
+        directory to search in
+    filenames : list of str, required
+        candidate file names in order of preference
+    """
+
+    for filename in filenames:
+        candidate = Path(directory) / filename
+        if candidate.exists():
+            return candidate
+    raise FileNotFoundError(f"None of {filenames} found in {directory}")
+
 def read_cell_identities(
     filepath,
     index_column,
@@ -99,6 +299,23 @@ def read_cell_identities(
 
     return clusters
 
+def read_gene_list(
+    filepath
+):
+    """
+    Reads a list of gene names from a text file with one gene name per line; empty lines are ignored.
+
+    Parameters
+    ----------
+    filepath : str or pathlib.Path, required
+        filepath to the gene list
+    """
+
+    if not Path(filepath).exists():
+        raise FileNotFoundError(f"Gene list not found: {filepath}")
+    with open(filepath) as f:
+        return [line.strip() for line in f if line.strip()]
+
 def read_matrix_basic(
     filepath,
     separator="\t"
@@ -115,4 +332,525 @@ def read_matrix_basic(
     """
 
     mtx = pd.read_csv(filepath, sep=separator)
-    return mtx
\ No newline at end of file
+    return mtx
+
+OUTPUT_FORMATS = {
+    "tsv": ".tsv",
+    "npz": ".npz",
+    "parquet": ".parquet"
+}
+
+def output_extension(
+    output_format
+):
+    """
+    Returns the file extension belonging to an output format.
+
+    Parameters
+    ----------
+    output_format : {"tsv", "npz", "parquet"}, required
+        format of the output files
+    """
+
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"The output format {output_format} is not supported. Use one of {list(OUTPUT_FORMATS)}.")
+    return OUTPUT_FORMATS[output_format]
+
+def write_similarity_table(
+    similarity_table,
+    filepath,
+    output_format = "tsv"
+):
+    """
+    Writes the table of most similar cells.
+
+    In the "npz" format, the cell names are stored once in the arrays "x_names" and "y_names", and the columns "x" and "y" hold integer codes into them.
+
+    Parameters
+    ----------
+    similarity_table : pandas.DataFrame, required
+        table with the columns "cluster", "x", "y" and "distance"
+    filepath : str or pathlib.Path, required
+        output file path without extension
+    output_format : {"tsv", "npz", "parquet"}, optional
+        format of the output file
+
+    Returns
+    -------
+    filepath : str
+        path of the written file including its extension
+    """
+
+    filepath = f"{filepath}{output_extension(output_format)}"
+    if output_format == "tsv":
+        similarity_table.to_csv(filepath, sep="\t", index=False)
+    elif output_format == "npz":
+        x_codes, x_names = pd.factorize(similarity_table["x"])
+        y_codes, y_names = pd.factorize(similarity_table["y"])
+        np.savez(
+            filepath,
+            cluster=similarity_table["cluster"].to_numpy() if pd.api.types.is_numeric_dtype(similarity_table["cluster"]) else string_array(similarity_table["cluster"]),
+            x=x_codes,
+            y=y_codes,
+            distance=similarity_table["distance"].to_numpy(dtype=np.float64),
+            x_names=string_array(x_names),
+            y_names=string_array(y_names)
+        )
+    else:
+        similarity_table.to_parquet(filepath, index=False)
+
+    return filepath
+
+def write_neighbors(
+    neighbors,
+    filepath,
+    output_format = "tsv"
+):
+    """
+    Writes a compact table of most similar cells.
+
+    In the "npz" format, the compact table is stored as it is: the cell names once in the arrays "cells" and "reference_cells", the cluster identity of every cell in "cluster", and one row of neighbor positions into "reference_cells" and their distances per cell in the arrays "indices" and "distances", padded with -1 and NaN. The other formats store the long-form table with one row per neighbor.
+
+    Parameters
+    ----------
+    neighbors : dict, required
+        compact table created by scimpute.neighbors.compact_neighbors
+    filepath : str or pathlib.Path, required
+        output file path without extension
+    output_format : {"tsv", "npz", "parquet"}, optional
+        format of the output file
+
+    Returns
+    -------
+    filepath : str
+        path of the written file including its extension
+    """
+
+    if output_format != "npz":
+        return write_similarity_table(neighbor_table(neighbors), filepath, output_format)
+
+    filepath = f"{filepath}{output_extension(output_format)}"
+    clusters = neighbors["clusters"]
+    np.savez(
+        filepath,
+        cells=string_array(neighbors["cells"]),
+        reference_cells=string_array(neighbors["reference_cells"]),
+        cluster=clusters if pd.api.types.is_numeric_dtype(clusters) else string_array(clusters),
+        indices=neighbors["indices"],
+        distances=neighbors["distances"]
+    )
+
+    return filepath
+
+def read_neighbors(
+    filepath,
+    separator="\t"
+):
+    """
+    Reads a table of most similar cells in any of the output formats as a compact table, chosen by the file extension.
+
+    Parameters
+    ----------
+    filepath : str or pathlib.Path, required
+        filepath to the similarity table
+    separator : str or RegEx, optional
+        field separator of tab-separated files
+    """
+
+    filepath = str(filepath)
+    if filepath.endswith(".npz"):
+        with np.load(filepath) as data:
+            if "indices" in data.files:
+                return compact_neighbors(
+                    cells = data["cells"],
+                    reference_cells = data["reference_cells"],
+                    clusters = data["cluster"],
+                    indices = data["indices"],
+                    distances = data["distances"]
+                )
+    return neighbors_from_table(read_similarity_table(filepath, separator=separator))
+
+def read_similarity_table(
+    filepath,
+    separator="\t"
+):
+    """
+    Reads a table of most similar cells in any of the output formats, chosen by the file extension.
+
+    Parameters
+    ----------
+    filepath : str or pathlib.Path, required
+        filepath to the similarity table
+    separator : str or RegEx, optional
+        field separator of tab-separated files
+    """
+
+    filepath = str(filepath)
+    if filepath.endswith(".npz"):
+        with np.load(filepath) as data:
+            if "indices" in data.files:
+                return neighbor_table(read_neighbors(filepath))
+            return pd.DataFrame({
+                "cluster": data["cluster"],
+                "x": data["x_names"][data["x"]],
+                "y": data["y_names"][data["y"]],
+                "distance": data["distance"]
+            })
+    if filepath.endswith(".parquet"):
+        return pd.read_parquet(filepath)
+    # the distances are parsed exactly, so that stored neighbors keep their values when they are merged and written again
+    return pd.read_csv(filepath, sep=separator, float_precision="round_trip")
+
+def write_imputed_matrix(
+    imputed_mtx,
+    filepath,
+    output_format = "tsv"
+):
+    """
+    Writes an imputed gene expression matrix.
+
+    In the "npz" format, the values are stored in the array "values" and the cell and gene names in the arrays "cells" and "genes".
+
+    Parameters
+    ----------
+    imputed_mtx : pandas.DataFrame, required
+        imputed gene expression matrix; cell names as index, genes as columns
+    filepath : str or pathlib.Path, required
+        output file path without extension
+    output_format : {"tsv", "npz", "parquet"}, optional
+        format of the output file
+
+    Returns
+    -------
+    filepath : str
+        path of the written file including its extension
+    """
+
+    filepath = f"{filepath}{output_extension(output_format)}"
+    if output_format == "tsv":
+        imputed_mtx.to_csv(filepath, sep="\t")
+    elif output_format == "npz":
+        np.savez(
+            filepath,
+            values=float_values(imputed_mtx),
+            cells=string_array(imputed_mtx.index),
+            genes=string_array(imputed_mtx.columns)
+        )
+    else:
+        imputed_mtx.to_parquet(filepath, index=True)
+
+    return filepath
+
+def read_imputed_matrix(
+    filepath,
+    separator="\t",
+    genes=None
+):
+    """
+    Reads an imputed gene expression matrix or chunk in any of the output formats, chosen by the file extension.
+
+    If only some genes are requested, only their columns are parsed from text files and Parquet files, and only their values are read from the memory-mapped "npz" archive.
+
+    Parameters
+    ----------
+    filepath : str or pathlib.Path, required
+        filepath to the imputed gene expression matrix
+    separator : str or RegEx, optional
+        field separator of tab-separated files
+    genes : list-like, optional
+        genes to read; default is all genes
+
+    Returns
+    -------
+    imputed_mtx : pandas.DataFrame
+        imputed gene expression matrix; cell names as index named "cell", genes as columns
+    """
+
+    filepath = str(filepath)
+    if filepath.endswith(".npz"):
+        with np.load(filepath) as data:
+            cells = pd.Index(data["cells"], name="cell")
+            all_genes = pd.Index(data["genes"])
+            if genes is None:
+                return pd.DataFrame(data["values"], index=cells, columns=all_genes)
+        values = npz_array(filepath, "values")
+        genes = pd.Index(genes)
+        positions = all_genes.get_indexer(genes)
+        if (positions == -1).any():
+            raise KeyError(f"Genes not found in the imputed gene expression matrix: {list(genes[positions == -1][:10])}")
+        imputed_mtx = pd.DataFrame(np.asarray(values[:, positions]), index=cells, columns=genes)
+    elif filepath.endswith(".parquet"):
+        imputed_mtx = pd.read_parquet(filepath, columns=None if genes is None else list(genes))
+    else:
+        usecols = None
+        if genes is not None:
+            header = pd.read_csv(filepath, sep=separator, nrows=0).columns
+            usecols = [header[0]] + (["cell"] if "cell" in header[1:] else []) + list(genes)
+        imputed_mtx = pd.read_csv(filepath, sep=separator, index_col=0, usecols=usecols)
+        # chunk files carry the cell names as a column next to a positional index
+        if "cell" in imputed_mtx.columns:
+            imputed_mtx = imputed_mtx.set_index("cell")
+        if genes is not None:
+            imputed_mtx = imputed_mtx[list(genes)]
+
+    return imputed_mtx
+
+def read_imputed_genes(
+    filepath,
+    separator="\t"
+):
+    """
+    Reads the gene names of an imputed gene expression matrix or chunk without reading its values.
+
+    Parameters
+    ----------
+    filepath : str or pathlib.Path, required
+        filepath to the imputed gene expression matrix
+    separator : str or RegEx, optional
+        field separator of tab-separated files
+    """
+
+    filepath = str(filepath)
+    if filepath.endswith(".npz"):
+        with np.load(filepath) as data:
+            return pd.Index(data["genes"])
+    if filepath.endswith(".parquet"):
+        import pyarrow.parquet as pq
+        schema = pq.read_schema(filepath)
+        metadata = schema.pandas_metadata or {}
+        index_columns = [column for column in metadata.get("index_columns", []) if isinstance(column, str)]
+        return pd.Index([name for name in schema.names if name not in index_columns])
+    header = pd.read_csv(filepath, sep=separator, nrows=0).columns
+    return pd.Index([gene for gene in header[1:] if gene != "cell"])
+
+def read_imputed_cells(
+    filepath,
+    separator="\t"
+):
+    """
+    Reads the cell names of an imputed gene expression matrix or chunk without reading its values.
+
+    Parameters
+    ----------
+    filepath : str or pathlib.Path, required
+        filepath to the imputed gene expression matrix
+    separator : str or RegEx, optional
+        field separator of tab-separated files
+    """
+
+    filepath = str(filepath)
+    if filepath.endswith(".npz"):
+        with np.load(filepath) as data:
+            return pd.Index(data["cells"], name="cell")
+    if filepath.endswith(".parquet"):
+        return pd.read_parquet(filepath, columns=[]).index
+    header = pd.read_csv(filepath, sep=separator, nrows=0).columns
+    # chunk files carry the cell names as a column next to a positional index
+    column = "cell" if "cell" in header[1:] else header[0]
+    cells = pd.read_csv(filepath, sep=separator, usecols=[column])[column]
+    return pd.Index(cells.to_numpy(), name="cell")
+
+def read_imputed_matrix_blocks(
+    filepath,
+    block_size,
+    separator="\t"
+):
+    """
+    Reads an imputed gene expression matrix or chunk in any of the output formats block by block of consecutive cells, so that only one block is held in memory at a time.
+
+    Parameters
+    ----------
+    filepath : str or pathlib.Path, required
+        filepath to the imputed gene expression matrix
+    block_size : int, required
+        number of cells per block
+    separator : str or RegEx, optional
+        field separator of tab-separated files
+
+    Yields
+    ------
+    block : pandas.DataFrame
+        consecutive cells of the imputed gene expression matrix; cell names as index named "cell", genes as columns
+    """
+
+    filepath = str(filepath)
+    if filepath.endswith(".npz"):
+        with np.load(filepath) as data:
+            cells = pd.Index(data["cells"], name="cell")
+            genes = pd.Index(data["genes"])
+        values = npz_array(filepath, "values")
+        for start in range(0, len(cells), block_size):
+            yield pd.DataFrame(np.array(values[start:start + block_size]), index=cells[start:start + block_size], columns=genes)
+    elif filepath.endswith(".parquet"):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(filepath).iter_batches(batch_size=block_size):
+            yield pa.Table.from_batches([batch]).to_pandas()
+    else:
+        with pd.read_csv(filepath, sep=separator, index_col=0, chunksize=block_size, float_precision="round_trip") as reader:
+            for block in reader:
+                if "cell" in block.columns:
+                    block = block.set_index("cell")
+                yield block
+
+def npz_array(
+    filepath,
+    name
+):
+    """
+    Memory-maps an array of an uncompressed NumPy archive, so that only the parts of it that are accessed are read from the disk. Arrays of compressed archives are read into memory instead.
+
+    Parameters
+    ----------
+    filepath : str or pathlib.Path, required
+        filepath to the NumPy archive
+    name : str, required
+        name of the array in the archive
+    """
+
+    with zipfile.ZipFile(filepath) as archive:
+        info = archive.getinfo(f"{name}.npy")
+    if info.compress_type != zipfile.ZIP_STORED:
+        with np.load(filepath) as data:
+            return data[name]
+
+    with open(filepath, "rb") as f:
+        # the array file starts after the local file header of its archive member
+        f.seek(info.header_offset + 26)
+        name_length, extra_length = struct.unpack("<HH", f.read(4))
+        f.seek(info.header_offset + 30 + name_length + extra_length)
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+
+    if 0 in shape:
+        return np.empty(shape, dtype=dtype)
+    return np.memmap(filepath, dtype=dtype, mode="r", shape=shape, order="F" if fortran_order else "C", offset=offset)
+
+def float_values(
+    mtx
+):
+    """
+    Returns the values of a dense matrix as a floating point array, keeping float32 values in single precision and converting all others to float64.
+
+    Parameters
+    ----------
+    mtx : pandas.DataFrame, required
+        dense matrix
+    """
+
+    values = mtx.to_numpy()
+    if values.dtype != np.float32:
+        values = values.astype(np.float64, copy=False)
+    return values
+
+def string_array(
+    values
+):
+    """
+    Converts names to a numpy unicode array, which can be stored without pickling.
+
+    Parameters
+    ----------
+    values : list-like, required
+        names to convert
+    """
+
+    return np.asarray(pd.Index(values).astype(str), dtype=str)
+
+def write_imputed_matrix_chunks(
+    chunks,
+    filepath,
+    output_format = "tsv",
+    n_cells = None
+):
+    """
+    Writes an imputed gene expression matrix chunk by chunk, so that only one chunk is held in memory at a time.
+
+    Parameters
+    ----------
+    chunks : iterable of pandas.DataFrame, required
+        consecutive chunks of the imputed gene expression matrix with identical columns; cell names as index, genes as columns
+    filepath : str or pathlib.Path, required
+        output file path without extension
+    output_format : {"tsv", "npz", "parquet"}, optional
+        format of the output file
+    n_cells : int, optional
+        total number of cells in all chunks; required for the "npz" format
+
+    Returns
+    -------
+    filepath : str
+        path of the written file including its extension
+    """
+
+    filepath = f"{filepath}{output_extension(output_format)}"
+    if output_format == "tsv":
+        first = True
+        for chunk in chunks:
+            chunk.to_csv(filepath, sep="\t", mode="w" if first else "a", header=first)
+            first = False
+    elif output_format == "npz":
+        write_npz_chunks(chunks, filepath, n_cells)
+    else:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        writer = None
+        try:
+            for chunk in chunks:
+                table = pa.Table.from_pandas(chunk, preserve_index=True)
+                if writer is None:
+                    writer = pq.ParquetWriter(filepath, table.schema)
+                writer.write_table(table)
+        finally:
+            if writer is not None:
+                writer.close()
+
+    return filepath
+
+def write_npz_chunks(
+    chunks,
+    filepath,
+    n_cells
+):
+    """
+    Writes consecutive chunks of an imputed gene expression matrix into a memory-mapped array and packs it into an uncompressed NumPy archive with the same layout as write_imputed_matrix.
+
+    Parameters
+    ----------
+    chunks : iterable of pandas.DataFrame, required
+        consecutive chunks of the imputed gene expression matrix with identical columns; cell names as index, genes as columns
+    filepath : str or pathlib.Path, required
+        output file path including the ".npz" extension
+    n_cells : int, required
+        total number of cells in all chunks
+    """
+
+    parts_dir = Path(f"{filepath}.parts")
+    parts_dir.mkdir(parents=True, exist_ok=True)
+    values = None
+    genes = np.array([], dtype=str)
+    cells = []
+    row = 0
+    for chunk in chunks:
+        chunk_values = float_values(chunk)
+        if values is None:
+            genes = string_array(chunk.columns)
+            values = np.lib.format.open_memmap(parts_dir / "values.npy", mode="w+", dtype=chunk_values.dtype, shape=(n_cells, len(genes)))
+        values[row:row + len(chunk.index)] = chunk_values
+        row += len(chunk.index)
+        cells.append(string_array(chunk.index))
+    if values is None:
+        values = np.lib.format.open_memmap(parts_dir / "values.npy", mode="w+", dtype=np.float64, shape=(0, 0))
+    values.flush()
+    del values
+    np.save(parts_dir / "cells.npy", np.concatenate(cells) if cells else np.array([], dtype=str))
+    np.save(parts_dir / "genes.npy", genes)
+
+    with zipfile.ZipFile(filepath, "w", compression=zipfile.ZIP_STORED, allowZip64=True) as archive:
+        for name in ("values", "cells", "genes"):
+            archive.write(parts_dir / f"{name}.npy", arcname=f"{name}.npy")
+    shutil.rmtree(parts_dir)
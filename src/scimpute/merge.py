@@ -1,16 +1,28 @@
 import os
+import re
 import pandas as pd
 import shutil
 from pathlib import Path
+from scimpute.io import read_imputed_matrix, write_imputed_matrix_chunks
+from scimpute.telemetry import stage_metrics, task_telemetry, file_size
+
+CHUNK_FILE_PATTERN = re.compile(r"^CPM_imputation_(\d+)_(\d+)_(\d+)\.(tsv|npz|parquet)$")
+PARTIAL_CHUNK_FILE_PATTERN = re.compile(r"^CPM_imputation_(\d+)_(\d+)_(\d+)\.partial\.(tsv|npz|parquet)$")
 
 def merge_imputation_chunks(
     imputations_dir,
     outdir,
-    save_chunks = False
+    save_chunks = False,
+    output_format = "tsv",
+    return_matrix = True,
+    n_cells = None,
+    telemetry = None
 ):
     """
     Merges multiple imputed gene expression matrices from within one folder.
 
+    The chunks are streamed into the final imputed gene expression matrix in the order of their cells, so that only one chunk is held in memory at a time. Before merging, the chunks are checked to cover all cells exactly once.
+
     Parameters
     ----------
     imputations_dir : str or pathlib.Path, required
@@ -19,6 +31,19 @@ def merge_imputation_chunks(
         output directory for the final imputed gene expression matrix
     save_chunks : bool, optional
         flag indicating whether to write keep unmerged results on the disk
+    output_format : {"tsv", "npz", "parquet"}, optional
+        file format of the final imputed gene expression matrix; the imputation files may be in any of these formats
+    return_matrix : bool, optional
+        flag indicating whether to return the final imputed gene expression matrix as a pandas.DataFrame, which requires holding it in memory
+    n_cells : int, optional
+        expected total number of imputed cells; if given, missing imputation files after the last one found are detected as well
+    telemetry : dict, optional
+        report created by scimpute.telemetry.new_report with a running "merge" stage; the cells, genes and bytes of the merged files and the wall and CPU time of every file are recorded in it
+
+    Returns
+    -------
+    final_df : pandas.DataFrame or str
+        the final imputed gene expression matrix if return_matrix is True, otherwise the path of the file it was written to
     """
 
     Path(outdir).mkdir(parents=True, exist_ok=True)
@@ -28,20 +53,97 @@ def merge_imputation_chunks(
     else:
         chunkdir = os.path.join(outdir, "imputations")
 
-    files = [os.path.join(chunkdir, file) for file in os.listdir(chunkdir)]
-    files = sorted(files)
+    chunk_files = list_chunk_files(chunkdir)
+    last_stop = chunk_files[-1][2] if chunk_files else 0
+    if n_cells is not None and last_stop != n_cells:
+        raise ValueError(f"Imputation files for the cells {last_stop} to {n_cells} are missing.")
+    n_cells = last_stop
+    stage_metrics(telemetry, "merge", cells=n_cells, tasks_total=len(chunk_files), bytes_read=sum(file_size(file) for file, _, _ in chunk_files))
 
-    final_df = pd.DataFrame()
-    for file in files:
-        print(f"Merging file {file}")
-        df = pd.read_csv(file, sep="\t", index_col=0)
-        final_df = pd.concat([final_df, df])
+    merged_chunks = []
+    def read_chunks():
+        cells = set()
+        genes = None
+        for file, start, stop in chunk_files:
+            print(f"Merging file {file}")
+            # the time of a file includes appending it to the final matrix, which happens before the next file is requested
+            with task_telemetry(telemetry, "merge", os.path.basename(file), cells=stop - start):
+                df = read_imputed_matrix(file)
+                if len(df.index) != stop - start:
+                    raise ValueError(f"Imputation file {file} contains {len(df.index)} cells instead of {stop - start}.")
+                if genes is None:
+                    genes = df.columns
+                elif not df.columns.equals(genes):
+                    raise ValueError(f"Imputation file {file} contains different genes than the previous imputation files.")
+                duplicates = cells.intersection(df.index)
+                if duplicates or df.index.has_duplicates:
+                    raise ValueError(f"Imputation file {file} contains cells that were already imputed: {sorted(duplicates)[:10]}")
+                cells.update(df.index)
+                if return_matrix:
+                    merged_chunks.append(df)
+                yield df
+        stage_metrics(telemetry, "merge", genes=len(genes) if genes is not None else 0)
 
-    final_df.index = final_df["cell"]
-    final_df.drop(columns=["cell"], inplace=True)
-    final_df.to_csv(os.path.join(outdir, "imputation.tsv"), sep="\t")
+    filepath = write_imputed_matrix_chunks(read_chunks(), os.path.join(outdir, "imputation"), output_format, n_cells=n_cells)
+    stage_metrics(telemetry, "merge", bytes_written=file_size(filepath))
 
     if not save_chunks:
         shutil.rmtree(chunkdir)
-    
-    return final_df
\ No newline at end of file
+
+    if not return_matrix:
+        return filepath
+    if merged_chunks:
+        return pd.concat(merged_chunks)
+    return pd.DataFrame()
+
+def list_chunk_files(
+    chunkdir
+):
+    """
+    Lists the imputation files in a folder in the order of their cells and checks that they cover a contiguous range of cells without gaps or overlaps.
+
+    Parameters
+    ----------
+    chunkdir : str or pathlib.Path, required
+        path to the directory containing the imputation files
+
+    Returns
+    -------
+    chunk_files : list of tuple
+        path, index of the first cell and index after the last cell of every imputation file
+    """
+
+    chunk_files = []
+    for file in os.listdir(chunkdir):
+        match = CHUNK_FILE_PATTERN.match(file)
+        if match:
+            chunk_files.append((os.path.join(chunkdir, file), int(match.group(2)), int(match.group(3))))
+    chunk_files = sorted(chunk_files, key=lambda chunk_file: (chunk_file[1], chunk_file[2]))
+
+    expected_start = 0
+    for file, start, stop in chunk_files:
+        if start < expected_start:
+            raise ValueError(f"Imputation file {file} overlaps with a previous imputation file.")
+        if start > expected_start:
+            raise ValueError(f"Imputation files for the cells {expected_start} to {start} are missing.")
+        expected_start = stop
+
+    return chunk_files
+
+def clear_chunk_files(
+    chunkdir
+):
+    """
+    Removes all complete and partially written imputation files from a folder.
+
+    Parameters
+    ----------
+    chunkdir : str or pathlib.Path, required
+        path to the directory containing the imputation files
+    """
+
+    if not os.path.isdir(chunkdir):
+        return
+    for file in os.listdir(chunkdir):
+        if CHUNK_FILE_PATTERN.match(file) or PARTIAL_CHUNK_FILE_PATTERN.match(file):
+            os.remove(os.path.join(chunkdir, file))
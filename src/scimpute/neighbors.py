@@ -0,0 +1,261 @@
+import numpy as np
+import pandas as pd
+
+
+def compact_neighbors(
+    cells,
+    reference_cells,
+    clusters,
+    indices,
+    distances
+):
+    """
+    Creates a compact table of the most similar cells: one row of fixed width per cell to impute for, holding the positions of its neighbors among the cells to impute from and their distances, so that no cell name is repeated.
+
+    Rows with fewer neighbors than the width of the table are padded with the position -1 and the distance NaN.
+
+    Parameters
+    ----------
+    cells : list-like, required
+        names of the cells to impute for, one per row
+    reference_cells : list-like, required
+        names of the cells to impute from, which the positions refer to
+    clusters : list-like, required
+        cluster identity of every row
+    indices : numpy.ndarray, required
+        positions of the neighbors of every row in reference_cells, ordered by descending similarity
+    distances : numpy.ndarray, required
+        cosine similarity of every neighbor shifted by +1 into the positive range, as in the long-form table
+
+    Returns
+    -------
+    neighbors : dict
+        compact table with the keys "cells", "reference_cells" (pandas.Index), "clusters", "indices" (int32, or int64 for more than 2**31 cells to impute from) and "distances" (numpy.ndarray)
+    """
+
+    reference_cells = pd.Index(reference_cells)
+    indices = np.asarray(indices)
+    # a cluster without cells to impute for has no rows, whose width cannot be inferred
+    shape = (len(indices), -1 if indices.size > 0 else 0)
+    return {
+        "cells": pd.Index(cells),
+        "reference_cells": reference_cells,
+        "clusters": np.asarray(clusters),
+        "indices": indices.astype(neighbor_index_dtype(len(reference_cells)), copy=False).reshape(shape),
+        "distances": np.asarray(distances).reshape(shape)
+    }
+
+def neighbor_index_dtype(
+    n_reference_cells
+):
+    """
+    Returns the smallest of int32 and int64 that can hold the positions of all cells to impute from.
+
+    Parameters
+    ----------
+    n_reference_cells : int, required
+        number of cells to impute from
+    """
+
+    return np.int32 if n_reference_cells < np.iinfo(np.int32).max else np.int64
+
+def concat_neighbors(
+    parts,
+    reference_cells
+):
+    """
+    Stacks the rows of compact tables that refer to the same cells to impute from, padding them to a common width.
+
+    Parameters
+    ----------
+    parts : list of dict, required
+        compact tables created by compact_neighbors
+    reference_cells : pandas.Index, required
+        names of the cells to impute from, used if there are no parts
+    """
+
+    if not parts:
+        return compact_neighbors([], reference_cells, np.array([]), np.empty((0, 0)), np.empty((0, 0)))
+
+    width = max(part["indices"].shape[1] for part in parts)
+    def padded(array, fill):
+        return np.pad(array, ((0, 0), (0, width - array.shape[1])), constant_values=fill)
+
+    return compact_neighbors(
+        cells = parts[0]["cells"].append([part["cells"] for part in parts[1:]]),
+        reference_cells = parts[0]["reference_cells"],
+        clusters = np.concatenate([part["clusters"] for part in parts]),
+        indices = np.vstack([padded(part["indices"], -1) for part in parts]),
+        distances = np.vstack([padded(part["distances"], np.nan) for part in parts])
+    )
+
+def select_neighbors(
+    neighbors,
+    rows
+):
+    """
+    Returns the rows of a compact table at the given positions or boolean mask.
+
+    Parameters
+    ----------
+    neighbors : dict, required
+        compact table created by compact_neighbors
+    rows : numpy.ndarray, required
+        positions or boolean mask of the rows to select
+    """
+
+    return compact_neighbors(
+        cells = neighbors["cells"][rows],
+        reference_cells = neighbors["reference_cells"],
+        clusters = neighbors["clusters"][rows],
+        indices = neighbors["indices"][rows],
+        distances = neighbors["distances"][rows]
+    )
+
+def merge_neighbors(
+    neighbors,
+    candidates,
+    k_neighbors
+):
+    """
+    Merges additional candidate neighbors into the rows of a compact table with the same cells and keeps the k most similar neighbors per cell.
+
+    Parameters
+    ----------
+    neighbors : dict, required
+        compact table created by compact_neighbors
+    candidates : dict, required
+        compact table of candidate neighbors of some of the cells of neighbors, referring to the same cells to impute from
+    k_neighbors : int, required
+        number of nearest neighbors to keep per cell
+    """
+
+    rows = neighbors["cells"].get_indexer(candidates["cells"])
+    if (rows == -1).any():
+        raise KeyError(f"Candidate neighbors of unknown cells: {list(candidates['cells'][rows == -1][:10])}")
+
+    width = candidates["indices"].shape[1]
+    candidate_indices = np.full((len(neighbors["cells"]), width), -1, dtype=neighbors["indices"].dtype)
+    candidate_distances = np.full((len(neighbors["cells"]), width), np.nan, dtype=neighbors["distances"].dtype)
+    candidate_indices[rows] = candidates["indices"]
+    candidate_distances[rows] = candidates["distances"]
+
+    indices = np.hstack([neighbors["indices"], candidate_indices])
+    distances = np.hstack([neighbors["distances"], candidate_distances])
+    # padding is sorted behind all neighbors
+    order = np.argsort(-np.where(indices == -1, -np.inf, distances), axis=1, kind="stable")[:, :k_neighbors]
+
+    return compact_neighbors(
+        cells = neighbors["cells"],
+        reference_cells = neighbors["reference_cells"],
+        clusters = neighbors["clusters"],
+        indices = np.take_along_axis(indices, order, axis=1),
+        distances = np.take_along_axis(distances, order, axis=1)
+    )
+
+def neighbor_table(
+    neighbors
+):
+    """
+    Converts a compact table of the most similar cells into the long-form table with one row per neighbor and the columns "cluster", "x", "y" and "distance".
+
+    Parameters
+    ----------
+    neighbors : dict, required
+        compact table created by compact_neighbors
+    """
+
+    valid = neighbors["indices"] != -1
+    rows, _ = np.nonzero(valid)
+
+    return pd.DataFrame({
+        "cluster": neighbors["clusters"][rows],
+        "x": neighbors["cells"].to_numpy()[rows],
+        "y": neighbors["reference_cells"].to_numpy()[neighbors["indices"][valid]],
+        "distance": neighbors["distances"][valid]
+    })
+
+def neighbors_from_table(
+    similarity_table,
+    reference_cells = None
+):
+    """
+    Converts a long-form table of the most similar cells into a compact table.
+
+    Neighbor pairs that occur more than once (e.g. when every cluster was compared against the full dataset) are kept once, which leaves the imputed weighted average unchanged.
+
+    Parameters
+    ----------
+    similarity_table : pandas.DataFrame, required
+        table with the columns "cluster", "x", "y" and "distance"
+    reference_cells : pandas.Index, optional
+        names of the cells to impute from, which the positions of the compact table refer to; default is the neighbors found in the table
+    """
+
+    similarity_table = similarity_table.drop_duplicates(subset=["x", "y"])
+    x_codes, cells = pd.factorize(similarity_table["x"])
+    if reference_cells is None:
+        y_codes, reference_cells = pd.factorize(similarity_table["y"])
+    else:
+        reference_cells = pd.Index(reference_cells)
+        y_codes = reference_cells.get_indexer(similarity_table["y"])
+        if (y_codes == -1).any():
+            missing = similarity_table["y"][y_codes == -1].unique()
+            raise KeyError(f"Neighboring cells not found in the matrix to impute from: {list(missing[:10])}")
+
+    # neighbors are placed in their row in the order of the table
+    counts = np.bincount(x_codes, minlength=len(cells))
+    width = counts.max() if len(counts) > 0 else 0
+    order = np.argsort(x_codes, kind="stable")
+    columns = np.arange(len(order)) - np.repeat(np.cumsum(counts) - counts, counts)
+    distances = similarity_table["distance"].to_numpy()
+    indices = np.full((len(cells), width), -1, dtype=neighbor_index_dtype(len(reference_cells)))
+    values = np.full((len(cells), width), np.nan, dtype=distances.dtype if np.issubdtype(distances.dtype, np.floating) else np.float64)
+    indices[x_codes[order], columns] = y_codes[order]
+    values[x_codes[order], columns] = distances[order]
+    first_rows = np.flatnonzero(np.r_[True, np.diff(x_codes[order]) != 0]) if len(order) > 0 else np.array([], dtype=np.intp)
+
+    return compact_neighbors(
+        cells = cells,
+        reference_cells = reference_cells,
+        clusters = similarity_table["cluster"].to_numpy()[order][first_rows],
+        indices = indices,
+        distances = values
+    )
+
+def count_neighbors(
+    neighbors
+):
+    """
+    Returns the number of neighbors in a compact table, not counting the padding.
+
+    Parameters
+    ----------
+    neighbors : dict, required
+        compact table created by compact_neighbors
+    """
+
+    return int(np.count_nonzero(neighbors["indices"] != -1))
+
+def shared_neighbors(
+    neighbors,
+    other
+):
+    """
+    Returns the fraction of the neighbors in a compact table that are also neighbors of the same cell in another compact table over the same reference cells, e.g. to compare the results of two runs.
+
+    Parameters
+    ----------
+    neighbors : dict, required
+        compact table created by compact_neighbors
+    other : dict, required
+        compact table created by compact_neighbors containing at least the cells of neighbors
+    """
+
+    other = select_neighbors(other, pd.Index(other["cells"]).get_indexer(neighbors["cells"]))
+    rows = np.arange(len(neighbors["cells"]))[:, np.newaxis]
+    keys = (rows * len(neighbors["reference_cells"]) + neighbors["indices"])[neighbors["indices"] != -1]
+    other_keys = (rows * len(other["reference_cells"]) + other["indices"])[other["indices"] != -1]
+    if keys.size == 0:
+        return 1.0
+    return float(np.isin(keys, other_keys).mean())
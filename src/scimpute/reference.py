@@ -0,0 +1,300 @@
+import hashlib
+import json
+import os
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from scipy import sparse
+from scimpute.io import read_matrix, sparse_expression_matrix, matrix_file_format
+from scimpute.utils import is_sparse, expression_values, OUT_OF_CORE_BLOCK_MEMORY
+
+INDEX_VERSION = 1
+
+
+def load_reference_index(
+    matrix_to_impute_from,
+    index_dir,
+    dtype = None
+):
+    """
+    Loads the reference index for a gene expression matrix from the disk, or builds it first if it does not exist yet or if the source file or the requested dtype have changed since it was built.
+
+    Parameters
+    ----------
+    matrix_to_impute_from : str or pathlib.Path, required
+        path to the tab-separated comprehensive gene expression matrix to perform gene expression imputation from; genes as rows, cells/spots as columns
+    index_dir : str or pathlib.Path, required
+        directory containing the reference index
+    dtype : str or numpy.dtype, optional
+        floating point type of the stored expression values; default is float64
+
+    Returns
+    -------
+    y : pandas.DataFrame
+        memory-mapped gene expression matrix; genes as columns, cells/spots as rows
+    """
+
+    if not reference_index_is_valid(matrix_to_impute_from, index_dir, dtype=dtype):
+        print(f"Building reference index in {index_dir}")
+        build_reference_index(matrix_to_impute_from, index_dir, dtype=dtype)
+    else:
+        print(f"Using reference index in {index_dir}")
+
+    return read_reference_index(index_dir)
+
+def build_reference_index(
+    matrix_to_impute_from,
+    index_dir,
+    dtype = None
+):
+    """
+    Parses a gene expression matrix once and stores it as a reference index: a binary expression matrix that can be memory-mapped, the gene order, the cell names and a fingerprint of the source file.
+
+    The cluster identities are not stored, because they are read from the cell identity table of every run, which also holds the identities of the cells to impute for and may change without the reference.
+
+    Tab-separated text matrices are converted block by block of genes into a dense matrix on the disk, so that they never need to fit into memory as a whole. Sparse matrices are stored as the data, indices and indptr arrays of their CSR representation.
+
+    Parameters
+    ----------
+    matrix_to_impute_from : str or pathlib.Path, required
+        path to the tab-separated comprehensive gene expression matrix to perform gene expression imputation from; genes as rows, cells/spots as columns
+    index_dir : str or pathlib.Path, required
+        directory to write the reference index to
+    dtype : str or numpy.dtype, optional
+        floating point type of the stored expression values; default is float64
+    """
+
+    dtype = np.dtype(dtype or np.float64)
+    Path(index_dir).mkdir(parents=True, exist_ok=True)
+    for filename in ("index.json", "expression.npy", "data.npy", "indices.npy", "indptr.npy"):
+        if os.path.exists(os.path.join(index_dir, filename)):
+            os.remove(os.path.join(index_dir, filename))
+    if matrix_file_format(matrix_to_impute_from) == "tsv":
+        cells, genes = write_dense_expression(matrix_to_impute_from, os.path.join(index_dir, "expression.npy"), dtype)
+    else:
+        y = read_matrix(matrix_to_impute_from)
+        cells, genes = y.index, y.columns
+        if is_sparse(y):
+            values = expression_values(y)
+            np.save(os.path.join(index_dir, "data.npy"), values.data.astype(dtype))
+            np.save(os.path.join(index_dir, "indices.npy"), values.indices)
+            np.save(os.path.join(index_dir, "indptr.npy"), values.indptr)
+        else:
+            np.save(os.path.join(index_dir, "expression.npy"), np.ascontiguousarray(y.to_numpy(dtype=dtype)))
+        del y
+    pd.Series(cells).to_csv(os.path.join(index_dir, "cells.tsv"), sep="\t", index=False, header=False)
+    pd.Series(genes).to_csv(os.path.join(index_dir, "genes.tsv"), sep="\t", index=False, header=False)
+
+    # the fingerprint is written last so that an interrupted build is never considered valid
+    with open(os.path.join(index_dir, "index.json"), "w") as f:
+        json.dump({"version": INDEX_VERSION, "dtype": dtype.name, **source_fingerprint(matrix_to_impute_from)}, f, indent=2)
+
+def write_dense_expression(
+    filepath,
+    expression_file,
+    dtype,
+    separator = "\t"
+):
+    """
+    Converts a tab-separated gene expression matrix with genes as rows and cells as columns into a binary matrix with cells as rows, holding only a block of the matrix in memory at a time.
+
+    The blocks of genes read from the text file are first appended to a temporary binary matrix with genes as rows, which is then transposed block by block of cells. Both files are written sequentially, and every row of the temporary matrix is read in runs of a whole block of cells, so that the conversion reads and writes each file about once, however many blocks it needs. The temporary matrix needs as much disk space as the result and is removed afterwards.
+
+    Parameters
+    ----------
+    filepath : str or pathlib.Path, required
+        path to the tab-separated gene expression matrix
+    expression_file : str or pathlib.Path, required
+        path of the .npy file to write
+    dtype : numpy.dtype, required
+        type of the stored values
+    separator : str or RegEx, optional
+        field separator of the gene expression file
+
+    Returns
+    -------
+    cells : pandas.Index
+        cell names in the row order of the binary matrix
+    genes : pandas.Index
+        gene names in the column order of the binary matrix
+    """
+
+    dtype = np.dtype(dtype)
+    block_bytes = int(OUT_OF_CORE_BLOCK_MEMORY * 1024 ** 2)
+    cells = pd.read_csv(filepath, sep=separator, index_col=0, nrows=0).columns
+    with open(filepath, "rb") as f:
+        n_genes = sum(1 for line in f if line.strip()) - 1
+    # a block of genes is parsed as float64 and then converted to dtype
+    genes_per_block = max(1, block_bytes // max(len(cells) * (np.dtype(np.float64).itemsize + dtype.itemsize), 1))
+
+    gene_major_file = f"{expression_file}.genes.npy"
+    gene_major = np.lib.format.open_memmap(gene_major_file, mode="w+", dtype=dtype, shape=(n_genes, len(cells)))
+    genes = []
+    try:
+        for block in pd.read_csv(filepath, sep=separator, index_col=0, chunksize=genes_per_block):
+            if len(genes) + len(block.index) > n_genes:
+                raise ValueError(f"Expected {n_genes} genes in {filepath}, but read more.")
+            gene_major[len(genes):len(genes) + len(block.index)] = block.to_numpy(dtype=dtype)
+            genes.extend(block.index)
+        if len(genes) != n_genes:
+            raise ValueError(f"Expected {n_genes} genes in {filepath}, but read {len(genes)}.")
+
+        expression = np.lib.format.open_memmap(expression_file, mode="w+", dtype=dtype, shape=(len(cells), n_genes))
+        cells_per_block = max(1, block_bytes // max(n_genes * dtype.itemsize, 1))
+        for start in range(0, len(cells), cells_per_block):
+            expression[start:start + cells_per_block] = gene_major[:, start:start + cells_per_block].T
+        expression.flush()
+        del expression
+    finally:
+        del gene_major
+        os.remove(gene_major_file)
+
+    return (cells, pd.Index(genes))
+
+def read_reference_index(
+    index_dir
+):
+    """
+    Reads a reference index with a memory-mapped gene expression matrix.
+
+    Parameters
+    ----------
+    index_dir : str or pathlib.Path, required
+        directory containing the reference index
+
+    Returns
+    -------
+    y : pandas.DataFrame
+        gene expression matrix, memory-mapped if it is dense; genes as columns, cells/spots as rows
+    """
+
+    cells = pd.read_csv(os.path.join(index_dir, "cells.tsv"), sep="\t", header=None, dtype=str)[0]
+    genes = pd.read_csv(os.path.join(index_dir, "genes.tsv"), sep="\t", header=None, dtype=str)[0]
+    if os.path.exists(os.path.join(index_dir, "expression.npy")):
+        expression = np.load(os.path.join(index_dir, "expression.npy"), mmap_mode="r")
+        y = pd.DataFrame(expression, index=pd.Index(cells.to_numpy()), columns=pd.Index(genes.to_numpy()), copy=False)
+        # marks the matrix for the steps that read it block by block instead of loading it
+        y.attrs["memory_mapped"] = True
+    else:
+        expression = sparse.csr_matrix(
+            tuple(np.load(os.path.join(index_dir, f"{part}.npy"), mmap_mode="r") for part in ("data", "indices", "indptr")),
+            shape=(len(cells), len(genes))
+        )
+        y = sparse_expression_matrix(expression, cells.to_numpy(), genes.to_numpy())
+
+    return y
+
+def reference_index_is_valid(
+    matrix_to_impute_from,
+    index_dir,
+    dtype = None
+):
+    """
+    Checks whether a reference index exists and was built from the current content of its source file with the requested dtype.
+
+    The content hash is only recomputed if the size or modification time of the source file differ from the ones stored in the index; if only the modification time changed and the content is unchanged, the stored modification time is updated.
+
+    Parameters
+    ----------
+    matrix_to_impute_from : str or pathlib.Path, required
+        path to the source gene expression matrix
+    index_dir : str or pathlib.Path, required
+        directory containing the reference index
+    dtype : str or numpy.dtype, optional
+        floating point type the stored expression values must have; default is float64
+    """
+
+    index_file = os.path.join(index_dir, "index.json")
+    if not os.path.exists(index_file):
+        return False
+    with open(index_file) as f:
+        stored = json.load(f)
+    if stored.get("version") != INDEX_VERSION or stored.get("dtype", "float64") != np.dtype(dtype or np.float64).name:
+        return False
+
+    size, mtime_ns = source_stat(matrix_to_impute_from)
+    if size == stored["size"] and mtime_ns == stored["mtime_ns"]:
+        return True
+    if size != stored["size"] or file_hash(matrix_to_impute_from) != stored["sha256"]:
+        return False
+
+    # the new modification time is stored so that later runs do not hash the unchanged content again
+    with open(f"{index_file}.tmp", "w") as f:
+        json.dump({**stored, "mtime_ns": mtime_ns}, f, indent=2)
+    os.replace(f"{index_file}.tmp", index_file)
+    return True
+
+def source_fingerprint(
+    filepath
+):
+    """
+    Describes a source file by its size, modification time and content hash.
+
+    Parameters
+    ----------
+    filepath : str or pathlib.Path, required
+        path to the source file, or to a directory of source files
+    """
+
+    size, mtime_ns = source_stat(filepath)
+    return {
+        "source": str(Path(filepath).resolve()),
+        "size": size,
+        "mtime_ns": mtime_ns,
+        "sha256": file_hash(filepath)
+    }
+
+def source_stat(
+    filepath
+):
+    """
+    Returns the total size and latest modification time of a source file or of all files in a source directory.
+
+    Parameters
+    ----------
+    filepath : str or pathlib.Path, required
+        path to the source file, or to a directory of source files
+    """
+
+    stats = [os.stat(file) for file in source_files(filepath)]
+    return (sum(stat.st_size for stat in stats), max((stat.st_mtime_ns for stat in stats), default=0))
+
+def source_files(
+    filepath
+):
+    """
+    Lists a source file, or all files in a source directory in sorted order.
+
+    Parameters
+    ----------
+    filepath : str or pathlib.Path, required
+        path to the source file, or to a directory of source files
+    """
+
+    if Path(filepath).is_dir():
+        return sorted(file for file in Path(filepath).iterdir() if file.is_file())
+    return [Path(filepath)]
+
+def file_hash(
+    filepath,
+    block_size = 2 ** 24
+):
+    """
+    Computes the SHA-256 hash of a file's content, or of the contents of all files in a directory.
+
+    Parameters
+    ----------
+    filepath : str or pathlib.Path, required
+        path to the file or directory
+    block_size : int, optional
+        number of bytes read at a time
+    """
+
+    digest = hashlib.sha256()
+    for file in source_files(filepath):
+        digest.update(file.name.encode("utf-8"))
+        with open(file, "rb") as f:
+            for block in iter(lambda: f.read(block_size), b""):
+                digest.update(block)
+
+    return digest.hexdigest()
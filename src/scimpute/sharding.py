@@ -0,0 +1,647 @@
+import argparse
+import json
+import os
+import shutil
+import socket
+from datetime import datetime, timezone
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from scimpute.io import read_inputs, read_matrix, read_cell_identities, read_gene_list, read_neighbors, write_neighbors, output_extension
+from scimpute.similarity import similarity_matrix
+from scimpute.imputation import impute_expression, selected_genes
+from scimpute.merge import merge_imputation_chunks, clear_chunk_files
+from scimpute.neighbors import concat_neighbors, neighbor_table, neighbors_from_table
+from scimpute.validation import validate_results
+from scimpute.reference import load_reference_index
+from scimpute.checkpoint import input_fingerprint, stage_key
+from scimpute.telemetry import new_report, stage_telemetry, write_report
+from scimpute.utils import checkformat, check_n_jobs
+
+SHARD_MANIFEST_FILE = "shards.json"
+SHARD_MANIFEST_VERSION = 1
+SHARDS_DIR = "shards"
+
+
+def plan_shards(
+    matrix_to_impute_for,
+    matrix_to_impute_from,
+    cell_identities,
+    cell_name_column_idx,
+    outdir,
+    n_shards,
+    by = "cells",
+    metric = "cosine_similarity",
+    k_neighbors = 25,
+    consider_clusters = True,
+    save_chunks = True,
+    chunk_size = 1000,
+    max_block_memory = None,
+    reference_index = None,
+    output_format = "tsv",
+    plot = True,
+    dtype = None,
+    genes = None
+):
+    """
+    Splits a gene expression imputation into shards of cells to impute for that can run independently, e.g. on separate nodes with a shared filesystem, and describes them in a manifest.
+
+    Every shard is run by run_shard against the full matrix to impute from and writes its imputation chunks into the common folder "imputations" of outdir, named by the positions of its cells in the final imputed gene expression matrix; reduce_shards then merges and validates them. Planning again with the same inputs and parameters keeps the completed shards; otherwise the shards and imputation chunks of the previous plan are removed.
+
+    Parameters
+    ----------
+    matrix_to_impute_for : str or pathlib.Path, required
+        path to the gene expression matrix to perform gene expression imputation for; it must be readable by all nodes under the same path
+    matrix_to_impute_from : str or pathlib.Path, required
+        path to the comprehensive gene expression matrix to perform gene expression imputation from; it must be readable by all nodes under the same path
+    cell_identities : str or pathlib.Path, required
+        path to the table containing identities for all cells from both datasets
+    cell_name_column_idx : int, required
+        index of the column containing the cell names (not the cell type clusters)
+    outdir : str or pathlib.Path, required
+        location of the output directory shared by all shards
+    n_shards : int, required
+        number of shards; fewer shards are planned if there are fewer cells (or clusters, with by="clusters")
+    by : {"cells", "clusters"}, optional
+        "cells" splits the cells to impute for into contiguous blocks of equal size; "clusters" keeps the cells of every cluster in the same shard and balances the number of cells per shard, so that each shard only compares against the reference cells of its own clusters
+    metric, k_neighbors, consider_clusters, save_chunks, chunk_size, max_block_memory, reference_index, output_format, plot, dtype, genes : optional
+        parameters of the gene expression imputation, as in scimpute.expression_imputation; they are stored in the manifest and used by all shards and the reducer. A reference index is built once while planning, so that the shards only memory-map it
+
+    Returns
+    -------
+    manifest : dict
+        contents of the manifest, as written to SHARD_MANIFEST_FILE in outdir
+    """
+
+    if by not in ("cells", "clusters"):
+        raise ValueError(f"by must be 'cells' or 'clusters', not {by!r}.")
+    if n_shards < 1:
+        raise ValueError(f"n_shards must be at least 1, not {n_shards}.")
+    for name, data in (("matrix_to_impute_for", matrix_to_impute_for), ("matrix_to_impute_from", matrix_to_impute_from), ("cell_identities", cell_identities)):
+        if checkformat(data) != "path":
+            raise ValueError(f"{name} must be given as a path, so that every shard can read it.")
+
+    outdir = Path(outdir).resolve()
+    inputs = {
+        "matrix_to_impute_for": str(Path(matrix_to_impute_for).resolve()),
+        "matrix_to_impute_from": str(Path(matrix_to_impute_from).resolve()),
+        "cell_identities": str(Path(cell_identities).resolve()),
+        "cell_name_column_idx": cell_name_column_idx
+    }
+    if isinstance(genes, (str, Path)):
+        genes = read_gene_list(genes)
+    parameters = {
+        "metric": metric,
+        "k_neighbors": k_neighbors,
+        "consider_clusters": consider_clusters,
+        "save_chunks": save_chunks,
+        "chunk_size": chunk_size,
+        "max_block_memory": max_block_memory,
+        "reference_index": None if reference_index is None else str(Path(reference_index).resolve()),
+        "output_format": output_format,
+        "plot": plot,
+        "dtype": None if dtype is None else str(dtype),
+        "genes": None if genes is None else list(genes)
+    }
+    key = stage_key(
+        fingerprints = [input_fingerprint(data) for data in (matrix_to_impute_for, matrix_to_impute_from, cell_identities)],
+        n_shards = n_shards,
+        by = by,
+        **inputs,
+        **parameters
+    )
+
+    manifest_file = outdir / SHARD_MANIFEST_FILE
+    if manifest_file.exists():
+        previous = read_shard_manifest(outdir)
+        if previous["key"] == key:
+            print(f"Using existing shard plan in {manifest_file}")
+            return previous
+        print(f"Inputs or parameters changed, removing the previous shard plan in {outdir}")
+        manifest_file.unlink()
+    outdir.mkdir(parents=True, exist_ok=True)
+    # shards and imputation chunks of a previous plan must not be merged with the new ones
+    shutil.rmtree(outdir / SHARDS_DIR, ignore_errors=True)
+    clear_chunk_files(outdir / "imputations")
+
+    if reference_index is not None:
+        load_reference_index(inputs["matrix_to_impute_from"], parameters["reference_index"], dtype=dtype)
+
+    cells = read_matrix(matrix_to_impute_for).index
+    if by == "cells":
+        groups = [cells[block] for block in np.array_split(np.arange(len(cells)), min(n_shards, len(cells))) if len(block) > 0]
+    else:
+        cluster_ids = read_cell_identities(cell_identities, index_column=cell_name_column_idx)["id"].reindex(cells)
+        groups = cluster_shards(cells, cluster_ids.to_numpy(), n_shards)
+
+    shards = []
+    offset = 0
+    for shard_id, shard_cells in enumerate(groups):
+        shard_dir = outdir / SHARDS_DIR / shard_name(shard_id)
+        shard_dir.mkdir(parents=True, exist_ok=True)
+        pd.Series(shard_cells).to_csv(shard_dir / "cells.txt", index=False, header=False)
+        shards.append({"shard": shard_id, "offset": offset, "n_cells": len(shard_cells), "cells": str(Path(SHARDS_DIR, shard_name(shard_id), "cells.txt"))})
+        offset += len(shard_cells)
+
+    manifest = {
+        "version": SHARD_MANIFEST_VERSION,
+        "key": key,
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "by": by,
+        "n_cells": offset,
+        "inputs": inputs,
+        "parameters": parameters,
+        "shards": shards
+    }
+    # the manifest is written last, so that shards only start on a complete plan
+    write_json(manifest, manifest_file)
+    print(f"Planned {len(shards)} shards of {offset} cells in {manifest_file}")
+
+    return manifest
+
+def cluster_shards(
+    cells,
+    cluster_ids,
+    n_shards
+):
+    """
+    Groups cells into shards that keep the cells of every cluster together, assigning the largest clusters first to the shard with the fewest cells.
+
+    Parameters
+    ----------
+    cells : pandas.Index, required
+        names of the cells to impute for
+    cluster_ids : numpy.ndarray, required
+        cluster identity of every cell; cells without an identity form a cluster of their own
+    n_shards : int, required
+        maximum number of shards
+
+    Returns
+    -------
+    groups : list of pandas.Index
+        cells of every non-empty shard, each in the order of cells
+    """
+
+    codes, _ = pd.factorize(cluster_ids, use_na_sentinel=False)
+    sizes = np.bincount(codes)
+    assignment = np.empty(len(sizes), dtype=np.intp)
+    loads = np.zeros(min(n_shards, len(sizes)), dtype=np.int64)
+    for cluster in np.argsort(-sizes, kind="stable"):
+        assignment[cluster] = np.argmin(loads)
+        loads[assignment[cluster]] += sizes[cluster]
+
+    shard_of_cell = assignment[codes]
+    return [cells[shard_of_cell == shard] for shard in range(len(loads)) if loads[shard] > 0]
+
+def run_shard(
+    outdir,
+    shard,
+    n_jobs = 1,
+    write_queue_size = None,
+    progress_callback = None
+):
+    """
+    Runs the similarity search and the imputation for the cells of one shard of a plan created by plan_shards.
+
+    The neighbors of the shard are written to its folder in outdir, and its imputation chunks to the common folder "imputations". Chunks completed by an interrupted run of the same shard are kept. Once all chunks are written, the shard is marked as done; a done shard is not run again.
+
+    Parameters
+    ----------
+    outdir : str or pathlib.Path, required
+        location of the output directory containing the manifest
+    shard : int, required
+        number of the shard in the manifest
+    n_jobs : int, optional
+        number of clusters and chunks to process in parallel threads on this node; -1 uses all CPU cores
+    write_queue_size : int, optional
+        number of imputed chunks that may wait to be written by a background thread while the next chunks are imputed
+    progress_callback : callable, optional
+        function that is called with a dict describing every event of the shard, as in scimpute.expression_imputation; the same metrics are written to "run_report.json" in the folder of the shard
+
+    Returns
+    -------
+    ran : bool
+        False if the shard was already done
+    """
+
+    outdir = Path(outdir).resolve()
+    manifest = read_shard_manifest(outdir)
+    entry = shard_entry(manifest, shard)
+    shard_dir = outdir / SHARDS_DIR / shard_name(shard)
+    if shard_is_done(outdir, manifest, shard):
+        print(f"Shard {shard} already completed")
+        return False
+
+    inputs, parameters = manifest["inputs"], manifest["parameters"]
+    report = new_report(outdir=shard_dir, callback=progress_callback, shard=shard, n_jobs=n_jobs, write_queue_size=write_queue_size, **parameters)
+
+    with stage_telemetry(report, "read_inputs") as stage:
+        matrix_to_impute_from = inputs["matrix_to_impute_from"]
+        if parameters["reference_index"] is not None:
+            matrix_to_impute_from = load_reference_index(matrix_to_impute_from, parameters["reference_index"], dtype=parameters["dtype"])
+        x, y, clusters, _ = read_inputs(
+            matrix_to_impute_for = inputs["matrix_to_impute_for"],
+            matrix_to_impute_from = matrix_to_impute_from,
+            cell_identities = inputs["cell_identities"],
+            cell_name_column_idx = inputs["cell_name_column_idx"],
+            outdir = None,
+            dtype = parameters["dtype"]
+        )
+        cells = pd.read_csv(outdir / entry["cells"], header=None, dtype=str, keep_default_na=False)[0]
+        x = x.loc[cells.to_numpy()]
+        genes = parameters["genes"]
+        if genes is not None:
+            genes = list(selected_genes(y.columns, genes))
+        stage.update(cells=len(x.index), genes=len(x.columns), reference_cells=len(y.index), reference_genes=len(y.columns))
+
+    print(f"Running shard {shard} for the cells {entry['offset']} to {entry['offset'] + entry['n_cells']}")
+    with stage_telemetry(report, "similarity"):
+        similarity_output = similarity_matrix(
+            x,
+            y,
+            clusters = clusters,
+            cell_name_column_idx = inputs["cell_name_column_idx"],
+            metric = parameters["metric"],
+            k_neighbors = parameters["k_neighbors"],
+            consider_clusters = parameters["consider_clusters"],
+            max_block_memory = parameters["max_block_memory"],
+            output_format = parameters["output_format"],
+            n_jobs = n_jobs,
+            outdir = shard_dir,
+            telemetry = report,
+            compact = True
+        )
+
+    with stage_telemetry(report, "imputation"):
+        impute_expression(
+            x,
+            y,
+            similarity_matrix = similarity_output,
+            chunk_size = parameters["chunk_size"],
+            output_format = parameters["output_format"],
+            n_jobs = n_jobs,
+            # chunks of an interrupted run of the same plan are complete and kept
+            resume = True,
+            outdir = outdir,
+            telemetry = report,
+            genes = genes,
+            write_queue_size = write_queue_size,
+            cell_offset = entry["offset"]
+        )
+
+    report["completed"] = True
+    write_report(report)
+    write_json({"key": manifest["key"], "finished": datetime.now(timezone.utc).isoformat(timespec="seconds"), "host": socket.gethostname()}, shard_dir / "done.json")
+
+    return True
+
+def run_shards(
+    outdir,
+    shards = None,
+    n_jobs = 1,
+    write_queue_size = None,
+    progress_callback = None
+):
+    """
+    Runs shards of a plan created by plan_shards one after another.
+
+    Without a list of shards, the worker claims every shard that is neither done nor claimed by another worker by creating a claim file in its folder, so that any number of workers can be started on the same output directory, on one or several nodes, without a scheduler. The claim is exclusive as long as the shared filesystem supports exclusive file creation (e.g. local filesystems and NFSv3 or later); it is released if the shard fails. A worker that was killed leaves its claim behind; its shard can be run again by removing the claim file or by passing the shard explicitly.
+
+    Parameters
+    ----------
+    outdir : str or pathlib.Path, required
+        location of the output directory containing the manifest
+    shards : list of int, optional
+        numbers of the shards to run regardless of claims; default claims and runs all available shards
+    n_jobs, write_queue_size, progress_callback : optional
+        parameters of run_shard
+
+    Returns
+    -------
+    completed : list of int
+        numbers of the shards run by this worker
+    """
+
+    check_n_jobs(n_jobs)
+    manifest = read_shard_manifest(outdir)
+    claim = shards is None
+    if shards is None:
+        shards = [entry["shard"] for entry in manifest["shards"]]
+
+    completed = []
+    for shard in shards:
+        if shard_is_done(outdir, manifest, shard):
+            continue
+        # explicitly requested shards are claimed as well if possible, so that other workers skip them
+        claimed = claim_shard(outdir, shard)
+        if claim and not claimed:
+            continue
+        try:
+            run_shard(outdir, shard, n_jobs=n_jobs, write_queue_size=write_queue_size, progress_callback=progress_callback)
+        except BaseException:
+            if claimed:
+                os.remove(claim_file(outdir, shard))
+            raise
+        completed.append(shard)
+
+    return completed
+
+def reduce_shards(
+    outdir,
+    progress_callback = None
+):
+    """
+    Checks that all shards of a plan created by plan_shards are done, merges their imputation chunks into the final imputed gene expression matrix and their neighbors into the final similarity table, and validates the result.
+
+    The cells of the final matrix are ordered by shard; with by="cells", this is the order of the matrix to impute for.
+
+    Parameters
+    ----------
+    outdir : str or pathlib.Path, required
+        location of the output directory containing the manifest
+    progress_callback : callable, optional
+        function that is called with a dict describing every event of the reduction; the same metrics are written to "run_report.json" in outdir
+
+    Returns
+    -------
+    final_df : str
+        path of the final imputed gene expression matrix
+    """
+
+    outdir = Path(outdir).resolve()
+    manifest = read_shard_manifest(outdir)
+    pending = [entry["shard"] for entry in manifest["shards"] if not shard_is_done(outdir, manifest, entry["shard"])]
+    if pending:
+        raise ValueError(f"{len(pending)} of {len(manifest['shards'])} shards are not completed yet: {pending[:10]}")
+
+    inputs, parameters = manifest["inputs"], manifest["parameters"]
+    output_format = parameters["output_format"]
+    report = new_report(outdir=outdir, callback=progress_callback, shards=len(manifest["shards"]), by=manifest["by"], **parameters)
+
+    with stage_telemetry(report, "merge"):
+        final_df = merge_imputation_chunks(
+            imputations_dir = outdir,
+            outdir = outdir,
+            save_chunks = parameters["save_chunks"],
+            output_format = output_format,
+            return_matrix = False,
+            n_cells = manifest["n_cells"],
+            telemetry = report
+        )
+        parts = [read_neighbors(outdir / SHARDS_DIR / shard_name(entry["shard"]) / f"sim_matrix{output_extension(output_format)}") for entry in manifest["shards"]]
+        write_neighbors(combine_neighbors(parts), outdir / "sim_matrix", output_format)
+
+    with stage_telemetry(report, "validation"):
+        x = read_matrix(inputs["matrix_to_impute_for"], dtype=parameters["dtype"])
+        validate_results(
+            x = x,
+            imputed_mtx = final_df,
+            outdir = outdir,
+            plot = parameters["plot"],
+            telemetry = report
+        )
+
+    report["completed"] = True
+    write_report(report)
+
+    return final_df
+
+def combine_neighbors(
+    parts
+):
+    """
+    Stacks the compact neighbor tables of all shards in their order.
+
+    Tables read from the long-form formats only refer to the reference cells they contain, and are combined through the long-form table if these differ.
+
+    Parameters
+    ----------
+    parts : list of dict, required
+        compact tables of the shards
+    """
+
+    reference_cells = parts[0]["reference_cells"]
+    if all(part["reference_cells"].equals(reference_cells) for part in parts):
+        return concat_neighbors(parts, reference_cells)
+    return neighbors_from_table(pd.concat([neighbor_table(part) for part in parts], ignore_index=True))
+
+def read_shard_manifest(
+    outdir
+):
+    """
+    Reads the manifest of a shard plan.
+
+    Parameters
+    ----------
+    outdir : str or pathlib.Path, required
+        location of the output directory containing the manifest
+    """
+
+    manifest_file = Path(outdir) / SHARD_MANIFEST_FILE
+    if not manifest_file.exists():
+        raise FileNotFoundError(f"Shard manifest not found: {manifest_file}")
+    with open(manifest_file) as f:
+        manifest = json.load(f)
+    if manifest.get("version") != SHARD_MANIFEST_VERSION:
+        raise ValueError(f"Unsupported shard manifest version {manifest.get('version')} in {manifest_file}.")
+    return manifest
+
+def shard_entry(
+    manifest,
+    shard
+):
+    """
+    Returns the description of a shard in a manifest.
+
+    Parameters
+    ----------
+    manifest : dict, required
+        contents of the manifest
+    shard : int, required
+        number of the shard
+    """
+
+    if not 0 <= shard < len(manifest["shards"]):
+        raise ValueError(f"Shard {shard} does not exist; the plan has {len(manifest['shards'])} shards.")
+    return manifest["shards"][shard]
+
+def shard_name(
+    shard
+):
+    """
+    Returns the name of the folder of a shard.
+
+    Parameters
+    ----------
+    shard : int, required
+        number of the shard
+    """
+
+    return f"shard_{shard:03}"
+
+def shard_is_done(
+    outdir,
+    manifest,
+    shard
+):
+    """
+    Checks whether a shard was completed for the current plan.
+
+    Parameters
+    ----------
+    outdir : str or pathlib.Path, required
+        location of the output directory containing the manifest
+    manifest : dict, required
+        contents of the manifest
+    shard : int, required
+        number of the shard
+    """
+
+    done_file = Path(outdir) / SHARDS_DIR / shard_name(shard) / "done.json"
+    if not done_file.exists():
+        return False
+    with open(done_file) as f:
+        return json.load(f)["key"] == manifest["key"]
+
+def claim_file(
+    outdir,
+    shard
+):
+    """
+    Returns the path of the claim file of a shard.
+
+    Parameters
+    ----------
+    outdir : str or pathlib.Path, required
+        location of the output directory containing the manifest
+    shard : int, required
+        number of the shard
+    """
+
+    return Path(outdir) / SHARDS_DIR / shard_name(shard) / "claim"
+
+def claim_shard(
+    outdir,
+    shard
+):
+    """
+    Claims a shard for this worker by creating its claim file, which fails if another worker created it first.
+
+    Parameters
+    ----------
+    outdir : str or pathlib.Path, required
+        location of the output directory containing the manifest
+    shard : int, required
+        number of the shard
+
+    Returns
+    -------
+    claimed : bool
+        False if the shard was already claimed
+    """
+
+    try:
+        fd = os.open(claim_file(outdir, shard), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    with os.fdopen(fd, "w") as f:
+        f.write(f"{socket.gethostname()}\t{os.getpid()}\n")
+    return True
+
+def write_json(
+    content,
+    filepath
+):
+    """
+    Writes a JSON file, replacing the previous version only once it is completely written.
+
+    Parameters
+    ----------
+    content : dict, required
+        content of the file
+    filepath : str or pathlib.Path, required
+        path of the file
+    """
+
+    with open(f"{filepath}.partial", "w") as f:
+        json.dump(content, f, indent=2)
+    os.replace(f"{filepath}.partial", filepath)
+
+def main(
+    argv = None
+):
+    """
+    Plans, runs or reduces a sharded gene expression imputation from the command line.
+
+    Parameters
+    ----------
+    argv : list of str, optional
+        command line arguments; default is sys.argv[1:]
+    """
+
+    parser = argparse.ArgumentParser(
+        prog="python -m scimpute.sharding",
+        description="Split a gene expression imputation into shards that run independently on nodes sharing a filesystem, and combine their results."
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    plan = commands.add_parser("plan", help="split the cells to impute for into shards and write the manifest")
+    plan.add_argument("matrix_to_impute_for", help="gene expression matrix to perform gene expression imputation for")
+    plan.add_argument("matrix_to_impute_from", help="comprehensive gene expression matrix to perform gene expression imputation from")
+    plan.add_argument("cell_identities", help="tab-separated table containing identities for all cells from both datasets")
+    plan.add_argument("cell_name_column_idx", type=int, help="index of the column containing the cell names (not the cell type clusters)")
+    plan.add_argument("-o", "--outdir", default="imputation_output", help="location of output directory shared by all shards; default is 'imputation_output'")
+    plan.add_argument("-n", "--shards", type=int, required=True, help="number of shards")
+    plan.add_argument("--by", default="cells", choices=["cells", "clusters"], help="split into contiguous blocks of cells, or into groups of whole clusters; default is 'cells'")
+    plan.add_argument("--metric", default="cosine_similarity", choices=["cosine_similarity", "approximate_cosine_similarity"], help="similarity metric; default is 'cosine_similarity'")
+    plan.add_argument("-k", "--k-neighbors", type=int, default=25, help="number of k nearest neighbors to find between datasets; default is 25")
+    plan.add_argument("--ignore-clusters", action="store_true", help="identify similar cells within the entire dataset instead of within the same annotated cluster")
+    plan.add_argument("--remove-chunks", action="store_true", help="remove the imputation chunks after merging")
+    plan.add_argument("--chunk-size", type=int, default=1000, help="number of cells per chunk to impute at a time; default is 1000")
+    plan.add_argument("--max-block-memory", type=float, default=None, help="maximum memory in megabytes for the blocks of the similarity search")
+    plan.add_argument("--reference-index", default=None, help="directory of a persistent index of matrix_to_impute_from, built while planning")
+    plan.add_argument("--output-format", default="tsv", choices=["tsv", "npz", "parquet"], help="file format of the similarity table and the imputed matrices; default is 'tsv'")
+    plan.add_argument("--no-plot", action="store_true", help="do not plot a histogram of the validation scores")
+    plan.add_argument("--genes", default=None, help="text file with one gene name per line; only these genes are imputed")
+    plan.add_argument("--dtype", default=None, choices=["float32", "float64"], help="floating point precision of the computation; default keeps the precision of the inputs")
+
+    run = commands.add_parser("run", help="run shards; without --shard, claim and run all shards not taken by other workers")
+    run.add_argument("outdir", help="location of output directory containing the manifest")
+    run.add_argument("-s", "--shard", type=int, action="append", default=None, help="number of a shard to run regardless of claims; can be repeated")
+    run.add_argument("-j", "--n-jobs", type=int, default=1, help="number of clusters and chunks to process in parallel; -1 uses all CPU cores; default is 1")
+    run.add_argument("--write-queue-size", type=int, default=None, help="number of imputed chunks that may wait to be written by a background thread")
+
+    reduce = commands.add_parser("reduce", help="merge and validate the results of all shards")
+    reduce.add_argument("outdir", help="location of output directory containing the manifest")
+    arguments = parser.parse_args(argv)
+
+    if arguments.command == "plan":
+        plan_shards(
+            matrix_to_impute_for = arguments.matrix_to_impute_for,
+            matrix_to_impute_from = arguments.matrix_to_impute_from,
+            cell_identities = arguments.cell_identities,
+            cell_name_column_idx = arguments.cell_name_column_idx,
+            outdir = arguments.outdir,
+            n_shards = arguments.shards,
+            by = arguments.by,
+            metric = arguments.metric,
+            k_neighbors = arguments.k_neighbors,
+            consider_clusters = not arguments.ignore_clusters,
+            save_chunks = not arguments.remove_chunks,
+            chunk_size = arguments.chunk_size,
+            max_block_memory = arguments.max_block_memory,
+            reference_index = arguments.reference_index,
+            output_format = arguments.output_format,
+            plot = not arguments.no_plot,
+            dtype = arguments.dtype,
+            genes = arguments.genes
+        )
+    elif arguments.command == "run":
+        completed = run_shards(arguments.outdir, shards=arguments.shard, n_jobs=arguments.n_jobs, write_queue_size=arguments.write_queue_size)
+        print(f"Completed shards: {completed}")
+    else:
+        reduce_shards(arguments.outdir)
+
+
+if __name__ == "__main__":
+    main()
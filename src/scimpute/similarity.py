@@ -1,9 +1,13 @@
-import pandas as pd
-from sklearn.metrics.pairwise import cosine_similarity
+import numpy as np
+from math import ceil, sqrt
 import os
 from pathlib import Path
-from scimpute.utils import intersection, checkformat
-from scimpute.io import read_matrix, read_cell_identities
+from functools import partial
+from scipy import sparse
+from scimpute.utils import checkformat, expression_values, parallel_map, cosine_similarity, normalize_rows, dense_dot, memory_mapped_values, OUT_OF_CORE_BLOCK_MEMORY
+from scimpute.io import read_matrix, read_cell_identities, write_neighbors, cast_matrix, sparse_expression_matrix
+from scimpute.neighbors import compact_neighbors, concat_neighbors, count_neighbors, neighbor_table
+from scimpute.telemetry import stage_metrics, task_telemetry, file_size
 
 def similarity_matrix(
     x,
@@ -13,11 +17,19 @@ def similarity_matrix(
     outdir,
     metric = "cosine_similarity",
     k_neighbors = 25,
-    consider_clusters = True
+    consider_clusters = True,
+    max_block_memory = None,
+    output_format = "tsv",
+    n_jobs = 1,
+    dtype = None,
+    telemetry = None,
+    compact = False
 ):
     """
     Calculates similarity matrix between the cells of two single cell transcriptomics datasets.
 
+    The most similar cells are returned as the long-form table with one row per neighbor; with compact=True they are returned as the compact table with one row of k neighbor positions and distances per cell (see scimpute.neighbors.compact_neighbors), which the pipeline passes between its stages and which scimpute.neighbors.neighbor_table converts into the long-form table.
+
     Parameters
     ----------
     x : str or pathlib.Path or pandas.DataFrame, required
@@ -28,14 +40,31 @@ def similarity_matrix(
         pandas.DataFrame or path to file containing the identities for all cells from both datasets
     cell_name_column_idx : int, required
         index of the column containing the cell names (not the cell type clusters)
-    outdir : str or pathlib.Path, required
-        Path to a directory where the similarity matrix determination output should be written on the disk.
-    metric : {"cosine_similarity"}
-        similarity metric (currently only supporting cosine similarity); default is 'cosine_similarity'
+    outdir : str or pathlib.Path or None, required
+        Path to a directory where the similarity matrix determination output should be written on the disk; if None, the table is only returned; the "npz" format stores the compact table, the other formats the long-form table
+    metric : {"cosine_similarity", "approximate_cosine_similarity"}
+        similarity metric; 'approximate_cosine_similarity' searches an inverted file index over the reference cells instead of comparing all pairs and reports the neighbor recall against the exact search on a sample of cells; default is 'cosine_similarity'
     k_neighbors : int, optional
         number of k nearest neighbors to find between datasets; default is '25'
     consider_clusters : bool, optional
         flag indicating whether to only identify similar cells between datasets within the same annotated cluster; default is 'True'
+    max_block_memory : int or float, optional
+        maximum memory in megabytes for the blocks of the similarity search, i.e. a tile of similarity values with its temporary copies and a block of cells read from y; if set, similarities are computed tile by tile and only the running top k neighbors per cell are kept, which are held in addition to the budget together with a normalized copy of x, otherwise the full similarity matrix of each cluster is held in memory; default is 'None'
+    output_format : {"tsv", "npz", "parquet"}, optional
+        file format of the similarity table written to outdir; default is 'tsv'
+    n_jobs : int, optional
+        number of clusters to process in parallel; -1 uses all CPU cores; default is '1'
+    dtype : str or numpy.dtype, optional
+        floating point type of the expression values and similarities, e.g. 'float32' to halve memory and speed up the similarity computation; default keeps the type of the inputs
+    telemetry : dict, optional
+        report created by scimpute.telemetry.new_report with a running "similarity" stage; the cells, clusters and neighbor table size of the stage and the wall and CPU time of every cluster are recorded in it
+    compact : bool, optional
+        flag indicating whether to return the compact table instead of the long-form table; default is 'False'
+
+    Returns
+    -------
+    similarity_table : pandas.DataFrame or dict
+        long-form table of the most similar cells with the columns "cluster", "x", "y" and "distance", or if compact is set the compact table with the keys "cells", "reference_cells", "clusters", "indices" and "distances"
     """
 
     xformat = checkformat(x)
@@ -43,40 +72,480 @@ def similarity_matrix(
     clustersformat = checkformat(clusters)
 
     if xformat == "path":
-        x = read_matrix(x)
+        x = read_matrix(x, dtype=dtype)
+    elif xformat == "sparse":
+        x = sparse_expression_matrix(*x)
     if yformat == "path":
-        y = read_matrix(y)
+        y = read_matrix(y, dtype=dtype)
+    elif yformat == "sparse":
+        y = sparse_expression_matrix(*y)
     if clustersformat == "path":
         clusters = read_cell_identities(clusters, cell_name_column_idx)
 
-    Path(outdir).mkdir(parents=True, exist_ok=True)
+    if metric not in ("cosine_similarity", "approximate_cosine_similarity"):
+        raise ValueError(f"The similarity metric {metric} is not supported. Use 'cosine_similarity' or 'approximate_cosine_similarity'.")
+
+    if outdir is not None:
+        Path(outdir).mkdir(parents=True, exist_ok=True)
+
+    if metric == "cosine_similarity" and memory_mapped_values(y) is not None:
+        # a memory-mapped reference is read block by block during the search instead of being reduced to the shared genes in memory
+        x = cast_matrix(x[y.columns.intersection(x.columns)], dtype)
+        y_red = y
+        reference_genes = y.columns.get_indexer(x.columns)
+    else:
+        y_red = cast_matrix(y[y.columns.intersection(x.columns)], dtype)
+        x = cast_matrix(x[y_red.columns], dtype)
+        y_red = y_red[x.columns]
+        reference_genes = None
 
-    y_red = y[y.columns.intersection(x.columns)]
-    x = x[y_red.columns]
-    y_red = y_red[x.columns]
+    # without clusters, all cells are compared once
+    unique_clusters = clusters["id"].unique() if consider_clusters else [None]
+    stage_metrics(telemetry, "similarity", cells=len(x.index), reference_cells=len(y_red.index), shared_genes=len(x.columns), tasks_total=len(unique_clusters))
 
-    unique_clusters = clusters["id"].unique()
-    result_tuples = []
+    cluster_results = parallel_map(
+        partial(
+            cluster_neighbors,
+            x=x,
+            y=y_red,
+            x_clusters=clusters["id"].reindex(x.index).to_numpy(),
+            y_clusters=clusters["id"].reindex(y_red.index).to_numpy(),
+            metric=metric,
+            k_neighbors=k_neighbors,
+            max_block_memory=max_block_memory,
+            reference_genes=reference_genes,
+            telemetry=telemetry
+        ),
+        unique_clusters,
+        n_jobs=n_jobs
+    )
+    neighbors = concat_neighbors([cluster_result for cluster_result, _, _ in cluster_results], y_red.index)
+    recall_hits = sum(hits for _, hits, _ in cluster_results)
+    recall_total = sum(total for _, _, total in cluster_results)
+    if recall_total > 0:
+        print(f"Approximate neighbor recall: {recall_hits / recall_total}")
+        if outdir is not None:
+            with open(os.path.join(outdir, "neighbor_recall.txt"), "w") as f:
+                f.write(f"Recall: {recall_hits / recall_total}\nSampled neighbors: {recall_total}")
+    stage_metrics(telemetry, "similarity", neighbors=count_neighbors(neighbors))
+    if outdir is not None:
+        filepath = write_neighbors(neighbors, os.path.join(outdir, "sim_matrix"), output_format)
+        stage_metrics(telemetry, "similarity", neighbor_table_bytes=file_size(filepath))
+    if compact:
+        return neighbors
+    return neighbor_table(neighbors)
 
+def cluster_neighbors(
+    cluster_id,
+    x,
+    y,
+    x_clusters,
+    y_clusters,
+    metric,
+    k_neighbors,
+    max_block_memory,
+    reference_genes = None,
+    telemetry = None
+):
+    """
+    Finds the most similar cells for the cells of one cluster, or for all cells.
+
+    Parameters
+    ----------
+    cluster_id : int or str or None, required
+        identity of the cluster; None compares all cells of x to all cells of y
+    x : pandas.DataFrame, required
+        gene expression matrix to perform gene expression imputation for, reduced to the genes shared with y; genes as columns, cells/spots as rows
+    y : pandas.DataFrame, required
+        gene expression matrix to perform gene expression imputation from, reduced to the genes shared with x; genes as columns, cells/spots as rows
+    x_clusters : numpy.ndarray, required
+        identity of every cell of x
+    y_clusters : numpy.ndarray, required
+        identity of every cell of y
+    metric : {"cosine_similarity", "approximate_cosine_similarity"}, required
+        similarity metric
+    k_neighbors : int, required
+        number of k nearest neighbors to find between datasets
+    max_block_memory : int or float or None, required
+        maximum memory in megabytes for the blocks of the similarity search
+    reference_genes : numpy.ndarray, optional
+        positions of the genes of x in the columns of y, if y is a memory-mapped matrix with all reference genes; its cells are then read block by block instead of being loaded at once
+    telemetry : dict, optional
+        report created by scimpute.telemetry.new_report to record the cluster in
+
+    Returns
+    -------
+    neighbors : dict
+        compact table of the most similar cells of the cluster, referring to all cells of y
+    hits : int
+        number of sampled approximate neighbors that are also exact neighbors
+    total : int
+        number of sampled exact neighbors
+    """
 
-    for cluster_id in unique_clusters:
-        if consider_clusters == True:
-            x_cluster = x[clusters["id"] == cluster_id]
-            y_cluster = y_red[clusters["id"] == cluster_id]
+    with task_telemetry(telemetry, "similarity", "all cells" if cluster_id is None else f"cluster {cluster_id}") as task:
+        y_rows = None
+        if cluster_id is not None:
+            x_cluster = x.iloc[np.flatnonzero(x_clusters == cluster_id)]
+            y_rows = np.flatnonzero(y_clusters == cluster_id)
+            cluster_ids = np.full(len(x_cluster.index), cluster_id)
+            if reference_genes is None:
+                y_cluster = y.iloc[y_rows]
         else:
             x_cluster = x
-            y_cluster = y_red
-        
-        if metric == "cosine_similarity":
-            cosine_sim_matrix = cosine_similarity(x_cluster, y_cluster)
-
-        distance_matrix_cluster_df = pd.DataFrame(cosine_sim_matrix, index=x_cluster.index, columns=y_cluster.index)
-
-        for row_name, row in distance_matrix_cluster_df.iterrows():
-            top_indices = (-row).argsort()[:k_neighbors] # from, to, -1 indicates descending order, getting the largest entries here
-            top_values = row.iloc[top_indices]
-            top_columns = top_values.index
-            result_tuples.extend([(cluster_id, row_name, col_name, value+1) for col_name, value in zip(top_columns, top_values)])
-    result_df = pd.DataFrame(result_tuples, columns=["cluster", "x", "y", "distance"])
-    result_df.to_csv(os.path.join(outdir, "sim_matrix.tsv"), sep="\t", index=False)
-    return result_df
\ No newline at end of file
+            y_cluster = y
+            cluster_ids = x_clusters
+
+        x_values = expression_values(x_cluster)
+        hits = 0
+        total = 0
+
+        if reference_genes is not None:
+            y_values = memory_mapped_values(y)
+            top_indices, top_values = tiled_top_k_neighbors(
+                x_values,
+                y_values,
+                k_neighbors,
+                max_block_memory or OUT_OF_CORE_BLOCK_MEMORY,
+                y_rows=y_rows,
+                y_columns=reference_genes
+            )
+        elif metric == "cosine_similarity":
+            y_values = expression_values(y_cluster)
+            if max_block_memory is None:
+                cosine_sim_matrix = cosine_similarity(x_values, y_values)
+                top_indices, top_values = top_k_neighbors(cosine_sim_matrix, k_neighbors)
+            else:
+                top_indices, top_values = tiled_top_k_neighbors(x_values, y_values, k_neighbors, max_block_memory)
+        elif metric == "approximate_cosine_similarity":
+            y_values = expression_values(y_cluster)
+            top_indices, top_values = approximate_top_k_neighbors(x_values, y_values, k_neighbors)
+            hits, total = neighbor_recall(x_values, y_values, top_indices, k_neighbors)
+
+        top_indices, top_values = rescore_neighbors(x_values, y_values, top_indices, y_rows=y_rows if reference_genes is not None else None, y_columns=reference_genes)
+
+        neighbors = compact_neighbors(
+            cells = x_cluster.index,
+            reference_cells = y.index,
+            clusters = cluster_ids,
+            indices = top_indices if y_rows is None else y_rows[top_indices],
+            distances = top_values + 1
+        )
+        task.update(cells=len(x_cluster.index), reference_cells=len(y.index) if y_rows is None else len(y_rows), neighbors=top_indices.size)
+
+    return (neighbors, hits, total)
+
+def top_k_neighbors(
+    similarities,
+    k_neighbors
+):
+    """
+    Selects the k most similar columns for every row of a similarity matrix.
+
+    Parameters
+    ----------
+    similarities : numpy.ndarray, required
+        similarity values with the cells to impute for as rows and the cells to impute from as columns
+    k_neighbors : int, required
+        number of nearest neighbors to select per row; all columns are returned if there are fewer than k_neighbors
+
+    Returns
+    -------
+    top_indices : numpy.ndarray
+        column indices of the nearest neighbors per row, ordered by descending similarity
+    top_values : numpy.ndarray
+        similarity values belonging to top_indices
+    """
+
+    n_cols = similarities.shape[1]
+    k = min(k_neighbors, n_cols)
+    if k == 0:
+        return (np.empty((similarities.shape[0], 0), dtype=np.intp), np.empty((similarities.shape[0], 0), dtype=similarities.dtype))
+
+    if k < n_cols:
+        candidates = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+    else:
+        candidates = np.broadcast_to(np.arange(n_cols), similarities.shape)
+    candidate_values = np.take_along_axis(similarities, candidates, axis=1)
+
+    # only the k winners per row are sorted, in descending order
+    order = np.argsort(-candidate_values, axis=1, kind="stable")
+    top_indices = np.take_along_axis(candidates, order, axis=1)
+    top_values = np.take_along_axis(candidate_values, order, axis=1)
+
+    return (top_indices, top_values)
+
+def tiled_top_k_neighbors(
+    x,
+    y,
+    k_neighbors,
+    max_block_memory,
+    y_rows = None,
+    y_columns = None
+):
+    """
+    Finds the k nearest neighbors by cosine similarity block by block, keeping only a running top k per cell so that memory follows max_block_memory and the number of cells of x instead of the size of both datasets.
+
+    The cells of y are read and normalized one block at a time, so that y can also be a memory-mapped matrix larger than the available memory.
+
+    Parameters
+    ----------
+    x : numpy.ndarray or scipy.sparse.csr_matrix, required
+        gene expression of the cells to impute for; cells as rows, genes as columns
+    y : numpy.ndarray or scipy.sparse.csr_matrix, required
+        gene expression of the cells to impute from; cells as rows, genes as columns
+    k_neighbors : int, required
+        number of nearest neighbors to select per cell
+    max_block_memory : int or float, required
+        maximum memory in megabytes for a tile of similarity values with its temporary copies and a block of cells read from y; a normalized copy of x and two copies of the running top k neighbors of all cells of x are held in addition
+    y_rows : numpy.ndarray, optional
+        positions of the rows of y to search; default is all rows
+    y_columns : numpy.ndarray, optional
+        positions of the columns of y that correspond to the columns of x; default is all columns
+
+    Returns
+    -------
+    top_indices : numpy.ndarray
+        indices into the searched rows of y of the nearest neighbors per cell of x, ordered by descending similarity
+    top_values : numpy.ndarray
+        cosine similarities belonging to top_indices
+    """
+
+    x_norm = normalize_rows(x)
+    n_x = x_norm.shape[0]
+    n_y = y.shape[0] if y_rows is None else len(y_rows)
+    k = min(k_neighbors, n_y)
+    if n_x == 0 or k == 0:
+        return (np.empty((n_x, k), dtype=np.intp), np.empty((n_x, k), dtype=x_norm.dtype))
+
+    # half of the budget goes to the similarity tiles and half to the block of y; a similarity is held four times (the tile, the tile next to the running top k, and their negation and its copy inside argpartition) and has two indices, while a cell of y is held as read, restricted to the genes of x and normalized
+    budget = int(max_block_memory * 1024 ** 2)
+    similarity_bytes = 4 * np.dtype(x_norm.dtype).itemsize + 2 * np.dtype(np.intp).itemsize
+    y_cell_bytes = y.shape[1] * np.dtype(y.dtype).itemsize + 2 * x_norm.shape[1] * np.dtype(x_norm.dtype).itemsize
+    tile_elements = max(1, budget // 2 // similarity_bytes)
+    rows_per_block = max(1, min(n_x, tile_elements // (n_y + k)))
+    if rows_per_block == 1:
+        rows_per_block = max(1, min(n_x, 256, tile_elements))
+    cols_per_block = max(1, min(n_y, tile_elements // rows_per_block - k, budget // 2 // max(y_cell_bytes, 1)))
+
+    top_indices = np.empty((n_x, 0), dtype=np.intp)
+    top_values = np.empty((n_x, 0), dtype=x_norm.dtype)
+
+    # every block of y is read once and compared against all cells of x
+    for col_start in range(0, n_y, cols_per_block):
+        col_stop = min(col_start + cols_per_block, n_y)
+        y_block = y[col_start:col_stop] if y_rows is None else y[y_rows[col_start:col_stop]]
+        if y_columns is not None:
+            y_block = y_block[:, y_columns]
+        y_norm = normalize_rows(y_block)
+
+        block_indices = []
+        block_values = []
+        for row_start in range(0, n_x, rows_per_block):
+            row_stop = min(row_start + rows_per_block, n_x)
+            block = dense_dot(x_norm[row_start:row_stop], y_norm.T)
+
+            candidates = np.hstack([top_values[row_start:row_stop], block])
+            candidate_indices = np.hstack([top_indices[row_start:row_stop], np.broadcast_to(np.arange(col_start, col_stop), block.shape)])
+            winners, best_values = top_k_neighbors(candidates, k)
+            block_indices.append(np.take_along_axis(candidate_indices, winners, axis=1))
+            block_values.append(best_values)
+
+        top_indices = np.vstack(block_indices)
+        top_values = np.vstack(block_values)
+
+    return (top_indices, top_values.astype(x_norm.dtype, copy=False))
+
+def rescore_neighbors(
+    x,
+    y,
+    top_indices,
+    y_rows = None,
+    y_columns = None,
+    max_block_memory = OUT_OF_CORE_BLOCK_MEMORY
+):
+    """
+    Computes the cosine similarity of every cell of x to each of its selected neighbors pair by pair and orders the neighbors by it.
+
+    The results of a matrix product depend on how many cells are multiplied at once, so the similarities found by the search can differ in the last digits between a run on all cells and a run on a subset of them, e.g. a shard. Scored pair by pair, a cell gets the same similarities in any batch of cells.
+
+    Parameters
+    ----------
+    x : numpy.ndarray or scipy.sparse.csr_matrix, required
+        gene expression of the cells to impute for; cells as rows, genes as columns
+    y : numpy.ndarray or scipy.sparse.csr_matrix, required
+        gene expression of the cells to impute from; cells as rows, genes as columns
+    top_indices : numpy.ndarray, required
+        indices into the searched rows of y of the nearest neighbors per cell of x
+    y_rows : numpy.ndarray, optional
+        positions of the searched rows of y; default is all rows
+    y_columns : numpy.ndarray, optional
+        positions of the columns of y that correspond to the columns of x; default is all columns
+    max_block_memory : int or float, optional
+        maximum memory in megabytes for the neighbors of a block of cells, which are held twice
+
+    Returns
+    -------
+    top_indices : numpy.ndarray
+        top_indices, ordered by descending similarity
+    top_values : numpy.ndarray
+        cosine similarities belonging to top_indices
+    """
+
+    n_x, k = top_indices.shape
+    n_genes = x.shape[1]
+    dtype = np.result_type(x.dtype, np.float32)
+    top_values = np.empty((n_x, k), dtype=dtype)
+    if n_x == 0 or k == 0:
+        return (top_indices, top_values)
+
+    rows_per_block = max(1, int(max_block_memory * 1024 ** 2) // (2 * k * max(n_genes, 1) * np.dtype(dtype).itemsize))
+    for start in range(0, n_x, rows_per_block):
+        stop = min(start + rows_per_block, n_x)
+        neighbors = top_indices[start:stop].ravel()
+        y_block = y[neighbors] if y_rows is None else y[y_rows[neighbors]]
+        if y_columns is not None:
+            y_block = y_block[:, y_columns]
+        x_block = x[start:stop]
+        # normalized and summed row by row, so that every value only depends on its own pair of cells
+        x_norm = normalize_rows(x_block.toarray() if sparse.issparse(x_block) else x_block)
+        y_norm = normalize_rows(y_block.toarray() if sparse.issparse(y_block) else y_block).reshape(stop - start, k, n_genes)
+        top_values[start:stop] = (x_norm[:, np.newaxis, :] * y_norm).sum(axis=2)
+
+    order = np.argsort(-top_values, axis=1, kind="stable")
+    return (np.take_along_axis(top_indices, order, axis=1), np.take_along_axis(top_values, order, axis=1))
+
+def approximate_top_k_neighbors(
+    x,
+    y,
+    k_neighbors,
+    n_lists = None,
+    n_probes = None,
+    random_state = 0
+):
+    """
+    Finds approximate k nearest neighbors by cosine similarity with an inverted file index: the L2-normalized reference cells are partitioned by k-means and every cell to impute for is only compared to the cells of its n_probes most similar partitions.
+
+    Parameters
+    ----------
+    x : numpy.ndarray or scipy.sparse.csr_matrix, required
+        gene expression of the cells to impute for; cells as rows, genes as columns
+    y : numpy.ndarray or scipy.sparse.csr_matrix, required
+        gene expression of the cells to impute from; cells as rows, genes as columns
+    k_neighbors : int, required
+        number of nearest neighbors to select per cell
+    n_lists : int, optional
+        number of partitions of the reference cells; default is the square root of the number of reference cells
+    n_probes : int, optional
+        number of partitions searched per cell; default is a fifth of n_lists
+    random_state : int, optional
+        seed of the k-means partitioning
+
+    Returns
+    -------
+    top_indices : numpy.ndarray
+        row indices into y of the nearest neighbors per cell of x, ordered by descending similarity
+    top_values : numpy.ndarray
+        cosine similarities belonging to top_indices
+    """
+
+    x_norm = normalize_rows(x)
+    y_norm = normalize_rows(y)
+    n_x = x_norm.shape[0]
+    n_y = y_norm.shape[0]
+    k = min(k_neighbors, n_y)
+
+    if n_lists is None:
+        n_lists = max(1, round(sqrt(n_y)))
+    n_lists = max(1, min(n_lists, n_y))
+    if n_probes is None:
+        n_probes = ceil(n_lists / 5)
+    n_probes = max(1, min(n_probes, n_lists))
+
+    if n_probes == n_lists or n_x == 0:
+        return top_k_neighbors(dense_dot(x_norm, y_norm.T), k)
+
+    # scikit-learn is only needed for the approximate search and therefore imported here
+    try:
+        from sklearn.cluster import MiniBatchKMeans
+    except ImportError:
+        raise ImportError("The approximate_cosine_similarity metric requires scikit-learn. Install it with 'pip install \"scimpute[approximate]\"'.")
+
+    kmeans = MiniBatchKMeans(n_clusters=n_lists, random_state=random_state, n_init=3).fit(y_norm)
+    centroids = normalize_rows(kmeans.cluster_centers_)
+    probes, _ = top_k_neighbors(dense_dot(x_norm, centroids.T), n_probes)
+
+    # queries grouped by the partitions they probe
+    probe_order = np.argsort(probes.ravel(), kind="stable")
+    probe_lists = probes.ravel()[probe_order]
+    probe_queries = probe_order // n_probes
+    list_starts = np.searchsorted(probe_lists, np.arange(n_lists + 1))
+    member_order = np.argsort(kmeans.labels_, kind="stable")
+    member_starts = np.searchsorted(kmeans.labels_[member_order], np.arange(n_lists + 1))
+
+    best_indices = np.full((n_x, k), -1, dtype=np.intp)
+    best_values = np.full((n_x, k), -np.inf, dtype=x_norm.dtype)
+
+    for partition in range(n_lists):
+        queries = probe_queries[list_starts[partition]:list_starts[partition + 1]]
+        members = member_order[member_starts[partition]:member_starts[partition + 1]]
+        if len(queries) == 0 or len(members) == 0:
+            continue
+        block = dense_dot(x_norm[queries], y_norm[members].T)
+
+        candidates = np.hstack([best_values[queries], block])
+        candidate_indices = np.hstack([best_indices[queries], np.broadcast_to(members, block.shape)])
+        winners, best_values[queries] = top_k_neighbors(candidates, k)
+        best_indices[queries] = np.take_along_axis(candidate_indices, winners, axis=1)
+
+    # cells whose probed partitions hold fewer than k reference cells fall back to the exact search
+    incomplete = (best_indices == -1).any(axis=1)
+    if incomplete.any():
+        best_indices[incomplete], best_values[incomplete] = top_k_neighbors(dense_dot(x_norm[incomplete], y_norm.T), k)
+
+    return (best_indices, best_values)
+
+def neighbor_recall(
+    x,
+    y,
+    top_indices,
+    k_neighbors,
+    sample_size = 256,
+    random_state = 0
+):
+    """
+    Compares approximate nearest neighbors to the exact cosine similarity neighbors on a random sample of cells.
+
+    Parameters
+    ----------
+    x : numpy.ndarray or scipy.sparse.csr_matrix, required
+        gene expression of the cells to impute for; cells as rows, genes as columns
+    y : numpy.ndarray or scipy.sparse.csr_matrix, required
+        gene expression of the cells to impute from; cells as rows, genes as columns
+    top_indices : numpy.ndarray, required
+        row indices into y of the approximate nearest neighbors per cell of x
+    k_neighbors : int, required
+        number of nearest neighbors per cell
+    sample_size : int, optional
+        number of cells of x to check
+    random_state : int, optional
+        seed of the random sample
+
+    Returns
+    -------
+    hits : int
+        number of sampled approximate neighbors that are also exact neighbors
+    total : int
+        number of sampled exact neighbors
+    """
+
+    n_x = x.shape[0]
+    if n_x == 0 or top_indices.shape[1] == 0:
+        return (0, 0)
+
+    sample = np.random.default_rng(random_state).choice(n_x, size=min(n_x, sample_size), replace=False)
+    exact_indices, _ = top_k_neighbors(cosine_similarity(x[sample], y), k_neighbors)
+
+    hits = sum(len(np.intersect1d(exact, approximate)) for exact, approximate in zip(exact_indices, top_indices[sample]))
+
+    return (hits, exact_indices.size)
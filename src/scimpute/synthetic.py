@@ -0,0 +1,152 @@
+import os
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from scipy import sparse
+from scimpute.io import sparse_expression_matrix
+
+
+def synthetic_dataset(
+    n_cells = 1000,
+    n_reference_cells = 5000,
+    n_genes = 2000,
+    n_measured_genes = 100,
+    n_clusters = 10,
+    sparsity = 0.9,
+    sparse_output = False,
+    random_state = 0
+):
+    """
+    Generates a paired synthetic dataset: a comprehensive reference gene expression matrix (e.g. from single cell/nucleus RNA sequencing), a gene expression matrix measuring only a subset of its genes (e.g. from a spatial experiment) and the cluster identities of the cells of both.
+
+    The cells of every cluster share a gene expression profile, so that the cells of the two matrices that belong to the same cluster are similar to each other. Counts are drawn from a Poisson distribution around the profile of their cluster, scaled by a per-cell library size, and additional values are set to zero (dropout) until the requested fraction of zeros is reached.
+
+    Parameters
+    ----------
+    n_cells : int, optional
+        number of cells/spots of the matrix to impute gene expression for
+    n_reference_cells : int, optional
+        number of cells of the matrix to impute gene expression from
+    n_genes : int, optional
+        number of genes of the matrix to impute gene expression from
+    n_measured_genes : int, optional
+        number of genes of the matrix to impute gene expression for, randomly selected from all genes
+    n_clusters : int, optional
+        number of cell type clusters
+    sparsity : float, optional
+        fraction of zeros in both matrices, between 0 and 1; matrices can contain more zeros if the sampled counts already do
+    sparse_output : bool, optional
+        flag indicating whether to return the matrices with sparse columns instead of dense ones
+    random_state : int, optional
+        seed of the random number generator
+
+    Returns
+    -------
+    matrix_to_impute_for : pandas.DataFrame
+        gene expression matrix to perform gene expression imputation for; genes as columns, cells/spots as rows
+    matrix_to_impute_from : pandas.DataFrame
+        comprehensive gene expression matrix to perform gene expression imputation from; genes as columns, cells/spots as rows
+    cell_identities : pandas.DataFrame
+        identities for all cells from both datasets in the column "id", indexed by cell name
+    cell_name_column_idx : int
+        index of the column containing the cell names (not the cell type clusters)
+    """
+
+    if not 0 <= sparsity < 1:
+        raise ValueError(f"sparsity must be between 0 and 1, not {sparsity}.")
+    if n_measured_genes > n_genes:
+        raise ValueError(f"n_measured_genes ({n_measured_genes}) cannot be larger than n_genes ({n_genes}).")
+
+    rng = np.random.default_rng(random_state)
+    genes = np.array([f"gene_{i}" for i in range(n_genes)], dtype=object)
+    measured_genes = np.sort(rng.choice(n_genes, size=n_measured_genes, replace=False))
+    profiles = rng.gamma(shape=0.5, scale=2.0, size=(n_clusters, n_genes))
+
+    reference_clusters = rng.integers(0, n_clusters, size=n_reference_cells)
+    spatial_clusters = rng.integers(0, n_clusters, size=n_cells)
+    reference_values = synthetic_counts(profiles[reference_clusters], sparsity, rng)
+    spatial_values = synthetic_counts(profiles[spatial_clusters][:, measured_genes], sparsity, rng)
+
+    reference_cells = [f"reference_{i}" for i in range(n_reference_cells)]
+    spatial_cells = [f"spot_{i}" for i in range(n_cells)]
+    if sparse_output:
+        matrix_to_impute_from = sparse_expression_matrix(sparse.csr_matrix(reference_values), reference_cells, genes)
+        matrix_to_impute_for = sparse_expression_matrix(sparse.csr_matrix(spatial_values), spatial_cells, genes[measured_genes])
+    else:
+        matrix_to_impute_from = pd.DataFrame(reference_values, index=reference_cells, columns=genes)
+        matrix_to_impute_for = pd.DataFrame(spatial_values, index=spatial_cells, columns=genes[measured_genes])
+
+    cell_name_column_idx = 0
+    cell_identities = pd.DataFrame(
+        {"id": np.concatenate([spatial_clusters, reference_clusters])},
+        index=pd.Index(spatial_cells + reference_cells, name="cell")
+    )
+
+    return (matrix_to_impute_for, matrix_to_impute_from, cell_identities, cell_name_column_idx)
+
+def synthetic_counts(
+    means,
+    sparsity,
+    rng
+):
+    """
+    Draws gene expression counts around expected values and applies dropout until a fraction of the values are zero.
+
+    Parameters
+    ----------
+    means : numpy.ndarray, required
+        expected expression of every gene (columns) in every cell (rows)
+    sparsity : float, required
+        target fraction of zeros
+    rng : numpy.random.Generator, required
+        random number generator
+    """
+
+    library_sizes = rng.lognormal(mean=0.0, sigma=0.3, size=(means.shape[0], 1))
+    counts = rng.poisson(means * library_sizes).astype(np.float64)
+
+    zeros = np.mean(counts == 0) if counts.size > 0 else 1.0
+    if zeros < sparsity:
+        dropout = (sparsity - zeros) / (1 - zeros)
+        counts[rng.random(counts.shape) < dropout] = 0
+
+    return counts
+
+def write_synthetic_dataset(
+    outdir,
+    **kwargs
+):
+    """
+    Generates a paired synthetic dataset and writes it as tab-separated input files for the gene expression imputation.
+
+    Parameters
+    ----------
+    outdir : str or pathlib.Path, required
+        location of output directory
+    **kwargs
+        parameters of synthetic_dataset
+
+    Returns
+    -------
+    matrix_to_impute_for : str
+        path to the gene expression matrix to perform gene expression imputation for; genes as rows, cells/spots as columns
+    matrix_to_impute_from : str
+        path to the gene expression matrix to perform gene expression imputation from; genes as rows, cells/spots as columns
+    cell_identities : str
+        path to the table containing the identities for all cells from both datasets
+    cell_name_column_idx : int
+        index of the column containing the cell names (not the cell type clusters)
+    """
+
+    kwargs["sparse_output"] = False
+    x, y, clusters, cell_name_column_idx = synthetic_dataset(**kwargs)
+
+    Path(outdir).mkdir(parents=True, exist_ok=True)
+    x_path = os.path.join(outdir, "matrix_to_impute_for.tsv")
+    y_path = os.path.join(outdir, "matrix_to_impute_from.tsv")
+    clusters_path = os.path.join(outdir, "cell_identities.tsv")
+    x.transpose().to_csv(x_path, sep="\t")
+    y.transpose().to_csv(y_path, sep="\t")
+    clusters.to_csv(clusters_path, sep="\t")
+
+    return (x_path, y_path, clusters_path, cell_name_column_idx)
@@ -0,0 +1,329 @@
+import json
+import os
+import platform
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from importlib import metadata
+from pathlib import Path
+
+REPORT_FILE = "run_report.json"
+REPORT_VERSION = 1
+
+# serializes the updates of a report and the callback calls from parallel clusters and chunks
+_lock = threading.RLock()
+
+
+def new_report(
+    outdir = None,
+    callback = None,
+    **parameters
+):
+    """
+    Creates an empty telemetry report for a run of the gene expression imputation.
+
+    Parameters
+    ----------
+    outdir : str or pathlib.Path, optional
+        location of the output directory; if given, the report is written to REPORT_FILE in it after every stage, so that the stages completed before a failure are reported as well
+    callback : callable, optional
+        function that is called with a dict describing every event of the run: the start ("stage_started") and end ("stage_finished") of every stage and the end of every cluster or chunk ("task_finished"), including the number of completed and total tasks of the stage
+    **parameters
+        parameters of the run to store in the report
+
+    Returns
+    -------
+    report : dict
+        report to pass to the steps of the gene expression imputation
+    """
+
+    return {
+        "version": REPORT_VERSION,
+        "started": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "environment": run_environment(),
+        "parameters": parameters,
+        "stages": [],
+        "_outdir": outdir,
+        "_callback": callback
+    }
+
+@contextmanager
+def stage_telemetry(
+    report,
+    stage,
+    **metrics
+):
+    """
+    Records the wall time, CPU time, peak resident memory and I/O volume of a stage of the gene expression imputation.
+
+    The recorded entry is yielded, so that the stage can add its own metrics, such as the number of cells it processed.
+
+    Parameters
+    ----------
+    report : dict or None, required
+        report created by new_report; if None, nothing is recorded
+    stage : str, required
+        name of the stage
+    **metrics
+        initial metrics of the stage
+    """
+
+    if report is None:
+        yield {}
+        return
+
+    entry = {"stage": stage, **metrics, "tasks": []}
+    with _lock:
+        report["stages"].append(entry)
+        emit(report, {"event": "stage_started", "stage": stage})
+
+    reset_peak_rss()
+    io_start = process_io()
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    try:
+        yield entry
+    finally:
+        entry["wall_seconds"] = time.perf_counter() - wall_start
+        entry["cpu_seconds"] = time.process_time() - cpu_start
+        entry["peak_rss_mb"] = peak_rss()
+        io_end = process_io()
+        for key in ("read_bytes", "write_bytes"):
+            entry[key] = io_end[key] - io_start[key] if io_start and io_end else None
+        with _lock:
+            emit(report, {"event": "stage_finished", **{key: value for key, value in entry.items() if key != "tasks"}})
+        write_report(report)
+
+def skip_stage(
+    report,
+    stage
+):
+    """
+    Records that a stage was skipped because it was completed by a previous run.
+
+    Parameters
+    ----------
+    report : dict or None, required
+        report created by new_report; if None, nothing is recorded
+    stage : str, required
+        name of the stage
+    """
+
+    if report is None:
+        return
+    with _lock:
+        report["stages"].append({"stage": stage, "skipped": True})
+        emit(report, {"event": "stage_finished", "stage": stage, "skipped": True})
+    write_report(report)
+
+def stage_metrics(
+    report,
+    stage,
+    **metrics
+):
+    """
+    Adds metrics to the most recent entry of a stage, e.g. the number of tasks ("tasks_total") it is going to run.
+
+    Parameters
+    ----------
+    report : dict or None, required
+        report created by new_report; if None, nothing is recorded
+    stage : str, required
+        name of the stage
+    **metrics
+        metrics of the stage
+    """
+
+    entry = current_stage(report, stage)
+    if entry is not None:
+        with _lock:
+            entry.update(metrics)
+
+@contextmanager
+def task_telemetry(
+    report,
+    stage,
+    task,
+    **metrics
+):
+    """
+    Records the wall time and the CPU time of the current thread for one cluster or chunk of a stage.
+
+    The recorded entry is yielded, so that the task can add its own metrics. Tasks run in parallel threads, so their resident memory cannot be told apart and is only reported per stage.
+
+    Parameters
+    ----------
+    report : dict or None, required
+        report created by new_report; if None, or if the stage is not being recorded, nothing is recorded
+    stage : str, required
+        name of the stage the task belongs to
+    task : str, required
+        name of the task
+    **metrics
+        initial metrics of the task
+    """
+
+    entry = current_stage(report, stage)
+    if entry is None:
+        yield {}
+        return
+
+    task_entry = {"task": task, **metrics}
+    wall_start = time.perf_counter()
+    cpu_start = time.thread_time()
+    try:
+        yield task_entry
+    finally:
+        task_entry["wall_seconds"] = time.perf_counter() - wall_start
+        task_entry["cpu_seconds"] = time.thread_time() - cpu_start
+        with _lock:
+            entry["tasks"].append(task_entry)
+            emit(report, {"event": "task_finished", "stage": stage, "completed": len(entry["tasks"]), "total": entry.get("tasks_total"), **task_entry})
+
+def current_stage(
+    report,
+    stage
+):
+    """
+    Returns the most recent entry of a stage in a report, or None if the stage is not recorded.
+
+    Parameters
+    ----------
+    report : dict or None, required
+        report created by new_report
+    stage : str, required
+        name of the stage
+    """
+
+    if report is None:
+        return None
+    for entry in reversed(report["stages"]):
+        if entry["stage"] == stage and not entry.get("skipped"):
+            return entry
+    return None
+
+def emit(
+    report,
+    event
+):
+    """
+    Passes an event to the callback of a report, if it has one.
+
+    Parameters
+    ----------
+    report : dict, required
+        report created by new_report
+    event : dict, required
+        description of the event
+    """
+
+    if report["_callback"] is not None:
+        report["_callback"](event)
+
+def write_report(
+    report,
+    outdir = None
+):
+    """
+    Writes a report as JSON to REPORT_FILE, replacing the previous version only once it is completely written.
+
+    Parameters
+    ----------
+    report : dict, required
+        report created by new_report
+    outdir : str or pathlib.Path, optional
+        location of the output directory; default is the one the report was created with, and nothing is written if neither is given
+    """
+
+    outdir = outdir or report["_outdir"]
+    if outdir is None:
+        return
+
+    with _lock:
+        content = {key: value for key, value in report.items() if not key.startswith("_")}
+        content["updated"] = datetime.now(timezone.utc).isoformat(timespec="seconds")
+        content = json.dumps(content, indent=2, default=str)
+    Path(outdir).mkdir(parents=True, exist_ok=True)
+    filepath = os.path.join(outdir, REPORT_FILE)
+    with open(f"{filepath}.partial", "w") as f:
+        f.write(content)
+    os.replace(f"{filepath}.partial", filepath)
+
+def file_size(
+    filepath
+):
+    """
+    Returns the size of a file in bytes, or the total size of all files in a directory.
+
+    Parameters
+    ----------
+    filepath : str or pathlib.Path, required
+        path to the file or directory
+    """
+
+    if os.path.isdir(filepath):
+        return sum(file.stat().st_size for file in Path(filepath).rglob("*") if file.is_file())
+    return os.path.getsize(filepath)
+
+def reset_peak_rss():
+    """
+    Resets the peak resident memory of the process, so that the peak of the next stage can be measured; only supported on Linux.
+    """
+
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+def peak_rss():
+    """
+    Returns the peak resident memory of the process in megabytes since the last reset, or since the start of the process where resetting is not supported; None if it cannot be determined.
+    """
+
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is given in bytes on macOS and in kilobytes elsewhere
+    return maxrss / 1024 ** 2 if platform.system() == "Darwin" else maxrss / 1024
+
+def process_io():
+    """
+    Returns the number of bytes the process has read and written so far, including reads served from the page cache; None if it cannot be determined (only supported on Linux).
+    """
+
+    try:
+        with open("/proc/self/io") as f:
+            counters = dict(line.split(":") for line in f if ":" in line)
+    except OSError:
+        return None
+    return {"read_bytes": int(counters["rchar"]), "write_bytes": int(counters["wchar"])}
+
+def run_environment():
+    """
+    Describes the software and hardware a run was executed on.
+    """
+
+    def version(package):
+        try:
+            return metadata.version(package)
+        except metadata.PackageNotFoundError:
+            return None
+
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        **{package: version(package) for package in ("scimpute", "numpy", "pandas", "scipy", "scikit-learn")}
+    }
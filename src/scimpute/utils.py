@@ -1,6 +1,16 @@
 from scimpute.io import read_matrix
+import os
+import numpy as np
 import pandas as pd
+from scipy import sparse
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
+from queue import Queue
+from threading import Thread
+
+# block size in megabytes for reading memory-mapped reference matrices
+OUT_OF_CORE_BLOCK_MEMORY = 256
 
 def intersection(lst1, lst2):
     """
@@ -18,20 +28,22 @@ def intersection(lst1, lst2):
 
 def checkformat(x):
     """
-    Checks if input is string, pathlib.Path or pandas.DataFrame and handles file reading accordingly.
+    Checks if input is string, pathlib.Path, pandas.DataFrame or a scipy.sparse matrix with its cell and gene names and handles file reading accordingly.
 
     Parameters
     ----------
-    x : str or pathlib.Path or pandas.DataFrame
-        the input object that should be checked for data type
+    x : str or pathlib.Path or pandas.DataFrame or tuple
+        the input object that should be checked for data type; a tuple of a scipy.sparse matrix (cells/spots as rows, genes as columns), its cell names and its gene names is reported as "sparse"
     """
 
     if isinstance(x, (Path, str)):
         return "path"
     elif isinstance(x, pd.DataFrame):
         return "dataframe"
+    elif isinstance(x, tuple) and len(x) == 3 and sparse.issparse(x[0]):
+        return "sparse"
     else:
-        raise ValueError(f"The input format for {x} is invalid. {x} must be of format str or pathlib.Path or pandas.DataFrame.")
+        raise ValueError(f"The input format for {x} is invalid. {x} must be of format str or pathlib.Path or pandas.DataFrame, or a tuple (matrix, cells, genes) of a scipy.sparse matrix and its cell and gene names.")
 
 def download_demo():
     """
@@ -54,4 +66,252 @@ def download_demo():
     cell_identities = pd.read_csv("https://git.nfdi4plants.org/usadellab/Barvista_ARC/-/raw/main/runs/r_clustering/resolve_D2-1/D2-1_clusters_1.3.tsv", sep="\t", index_col=cell_name_column_idx)
     cell_identities.index = cell_identities.index.str.replace("edgar", "vSAM")
     
-    return (matrix_to_impute_for, matrix_to_impute_from, cell_identities, cell_name_column_idx)
\ No newline at end of file
+    return (matrix_to_impute_for, matrix_to_impute_from, cell_identities, cell_name_column_idx)
+
+def is_sparse(mtx):
+    """
+    Checks if all columns of a gene expression matrix are stored as sparse columns.
+
+    Parameters
+    ----------
+    mtx : pandas.DataFrame
+        gene expression matrix; genes as columns, cells/spots as rows
+    """
+
+    return len(mtx.columns) > 0 and all(isinstance(dtype, pd.SparseDtype) for dtype in mtx.dtypes)
+
+def expression_values(mtx):
+    """
+    Returns the values of a gene expression matrix without densifying sparse matrices.
+
+    Parameters
+    ----------
+    mtx : pandas.DataFrame
+        gene expression matrix; genes as columns, cells/spots as rows
+
+    Returns
+    -------
+    values : numpy.ndarray or scipy.sparse.csr_matrix
+        scipy.sparse.csr_matrix if all columns of mtx are sparse, numpy.ndarray otherwise
+    """
+
+    if is_sparse(mtx):
+        return mtx.sparse.to_coo().tocsr()
+    return mtx.to_numpy()
+
+def parallel_map(function, items, n_jobs=1):
+    """
+    Applies a function to every item, using a pool of threads if more than one job is requested. The threads share all data without copying it, and the results keep the order of the items.
+
+    Parameters
+    ----------
+    function : callable
+        function to apply to each item
+    items : iterable
+        items to apply the function to
+    n_jobs : int or None
+        number of parallel jobs; -1 uses all available CPU cores, None and 1 run serially
+    """
+
+    check_n_jobs(n_jobs)
+    if n_jobs is None or n_jobs == 1:
+        return list(map(function, items))
+    if n_jobs < 0:
+        n_jobs = max(1, (os.cpu_count() or 1) + 1 + n_jobs)
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        return list(executor.map(function, items))
+
+def check_n_jobs(n_jobs):
+    """
+    Checks that a number of parallel jobs is a positive integer, -1 or another negative integer counting back from the number of CPU cores, or None.
+
+    Parameters
+    ----------
+    n_jobs : int or None
+        number of parallel jobs
+    """
+
+    if n_jobs is not None and (isinstance(n_jobs, bool) or not isinstance(n_jobs, (int, np.integer)) or n_jobs == 0):
+        raise ValueError(f"n_jobs must be a positive integer or a negative integer counting back from the number of CPU cores (-1 uses all of them), not {n_jobs!r}.")
+
+@contextmanager
+def background_writer(max_pending=None):
+    """
+    Runs write functions in a background thread, so that the next results can be computed while the previous ones are written. Yields a function that takes a write function without arguments and queues it; it blocks while max_pending writes are waiting, which caps the memory held by results that are not written yet.
+
+    All queued writes are completed when the context is left. An exception of a write is raised by the next queued write or when the context is left, and later writes are skipped.
+
+    Parameters
+    ----------
+    max_pending : int or None
+        maximum number of queued writes besides the one being written; None and 0 run every write immediately in the calling thread
+    """
+
+    if not max_pending:
+        yield lambda write: write()
+        return
+
+    queue = Queue(maxsize=max_pending)
+    errors = []
+    def run_writes():
+        while True:
+            write = queue.get()
+            if write is None:
+                return
+            if errors:
+                continue
+            try:
+                write()
+            except BaseException as error:
+                errors.append(error)
+
+    def submit(write):
+        if errors:
+            raise errors[0]
+        queue.put(write)
+
+    thread = Thread(target=run_writes, name="scimpute-writer", daemon=True)
+    thread.start()
+    try:
+        yield submit
+    finally:
+        queue.put(None)
+        thread.join()
+    if errors:
+        raise errors[0]
+
+def normalize_rows(values):
+    """
+    Scales every row of a matrix to unit L2 norm; rows without any values are left as zeros. Floating point matrices keep their precision, all others are converted to float64.
+
+    Parameters
+    ----------
+    values : numpy.ndarray or scipy.sparse matrix
+        matrix to normalize; cells as rows, genes as columns
+
+    Returns
+    -------
+    normalized : numpy.ndarray or scipy.sparse.csr_matrix
+        normalized copy of values
+    """
+
+    dtype = values.dtype if np.issubdtype(values.dtype, np.floating) else np.float64
+    if sparse.issparse(values):
+        normalized = sparse.csr_matrix(values, dtype=dtype, copy=True)
+        norms = np.sqrt(np.asarray(normalized.multiply(normalized).sum(axis=1)).ravel())
+        norms[norms == 0] = 1
+        normalized.data /= np.repeat(norms, np.diff(normalized.indptr))
+        return normalized
+
+    normalized = np.array(values, dtype=dtype)
+    norms = np.sqrt(np.einsum("ij,ij->i", normalized, normalized))
+    norms[norms == 0] = 1
+    normalized /= norms[:, np.newaxis]
+    return normalized
+
+def dense_dot(a, b):
+    """
+    Multiplies two dense or sparse matrices and returns the result as a dense array.
+
+    Parameters
+    ----------
+    a : numpy.ndarray or scipy.sparse matrix
+        left matrix
+    b : numpy.ndarray or scipy.sparse matrix
+        right matrix
+    """
+
+    product = a @ b
+    if sparse.issparse(product):
+        return product.toarray()
+    return np.asarray(product)
+
+def memory_mapped_values(mtx):
+    """
+    Returns the values of a dense gene expression matrix that are memory-mapped from a file, such as a matrix read from a reference index, without reading them.
+
+    Only matrices marked with mtx.attrs["memory_mapped"] = True are considered, so that matrices held in memory are never copied for the check.
+
+    Parameters
+    ----------
+    mtx : pandas.DataFrame
+        gene expression matrix; genes as columns, cells/spots as rows
+
+    Returns
+    -------
+    values : numpy.ndarray or None
+        view of the memory-mapped values; cells as rows, genes as columns; None if the values are held in memory
+    """
+
+    if not mtx.attrs.get("memory_mapped") or is_sparse(mtx):
+        return None
+    values = mtx.to_numpy()
+    if is_memory_mapped(values):
+        return values
+    return None
+
+def is_memory_mapped(values):
+    """
+    Checks whether an array is a view of a numpy.memmap.
+
+    Parameters
+    ----------
+    values : numpy.ndarray or scipy.sparse matrix
+        array to check
+    """
+
+    base = values
+    while isinstance(base, np.ndarray):
+        if isinstance(base, np.memmap):
+            return True
+        base = base.base
+    return False
+
+def gathered_dot(weights, values, columns=None, max_block_memory=OUT_OF_CORE_BLOCK_MEMORY):
+    """
+    Multiplies a sparse weight matrix with a memory-mapped matrix, reading only the rows of values that have a nonzero weight, in blocks of at most max_block_memory megabytes.
+
+    Parameters
+    ----------
+    weights : scipy.sparse.csr_matrix
+        sparse weight matrix; its columns correspond to the rows of values
+    values : numpy.ndarray
+        memory-mapped matrix; cells as rows, genes as columns
+    columns : numpy.ndarray, optional
+        positions of the columns of values to multiply with; default is all columns
+    max_block_memory : int or float, optional
+        maximum memory in megabytes for a single block of rows read from values
+    """
+
+    neighbors = np.unique(weights.indices)
+    n_columns = values.shape[1] if columns is None else len(columns)
+    rows_per_block = max(1, int(max_block_memory * 1024 ** 2) // max(values.shape[1] * values.itemsize, 1))
+
+    product = np.zeros((weights.shape[0], n_columns), dtype=np.result_type(weights.dtype, values.dtype))
+    for start in range(0, len(neighbors), rows_per_block):
+        rows = neighbors[start:start + rows_per_block]
+        block = values[rows]
+        if columns is not None:
+            block = block[:, columns]
+        product += dense_dot(weights[:, rows], block)
+
+    return product
+
+def cosine_similarity(x, y):
+    """
+    Computes the cosine similarity between every row of x and every row of y.
+
+    Parameters
+    ----------
+    x : numpy.ndarray or scipy.sparse matrix
+        first matrix; cells as rows, genes as columns
+    y : numpy.ndarray or scipy.sparse matrix
+        second matrix with the same genes as columns
+
+    Returns
+    -------
+    similarities : numpy.ndarray
+        cosine similarities with the rows of x as rows and the rows of y as columns
+    """
+
+    return dense_dot(normalize_rows(x), normalize_rows(y).T)
@@ -1,29 +1,46 @@
 import pandas as pd
-import matplotlib.pyplot as plt
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
+from scipy import sparse
 import os
+import warnings
 from pathlib import Path
-from scimpute.utils import intersection, checkformat
-from scimpute.io import read_matrix, read_matrix_basic
+from scimpute.utils import checkformat, expression_values
+from scimpute.io import read_matrix, read_imputed_matrix, read_imputed_genes, sparse_expression_matrix
+from scimpute.merge import list_chunk_files
+from scimpute.telemetry import stage_metrics
 
 
 def validate_results(
     x,
     imputed_mtx,
-    outdir
+    outdir,
+    plot = True,
+    telemetry = None
 ):
     """
     Quality check of the gene expression imputation results by comparing experimentally measured values to imputed values.
 
+    For every cell, the cosine similarity between its measured and imputed gene expression is computed; for every gene, the Pearson and Spearman correlations between its measured and imputed expression across all cells are written to "gene_correlations.tsv".
+
     Parameters
     ----------
     x : str or pathlib.Path or pandas.DataFrame, required
         pandas.DataFrame or path to the gene expression matrix to perform gene expression imputation for (e.g. from a spatial experiment); genes as columns, cells/spots as rows
     imputed_mtx : str or pathlib.Path or pandas.DataFrame, required
-        pandas.DataFrame or path to the imputed gene expression matrix
-    outdir : str or pathlib.Path, required
-        location of the output directory
+        pandas.DataFrame or path to the imputed gene expression matrix in any of the output formats ("tsv", "npz" or "parquet"), or path to a folder containing imputation chunk files; from files, only the genes that were also measured are read
+    outdir : str or pathlib.Path or None, required
+        location of the output directory; if None, no files are written and the results are only returned
+    plot : bool, optional
+        flag indicating whether to plot a histogram of the cosine similarities; requires matplotlib, without which the plot is skipped with a warning
+    telemetry : dict, optional
+        report created by scimpute.telemetry.new_report with a running "validation" stage; the number of validated cells and genes are recorded in it
+
+    Returns
+    -------
+    scores : pandas.Series
+        cosine similarity between the measured and imputed gene expression of every cell
+    gene_correlations : pandas.DataFrame
+        Pearson and Spearman correlation between the measured and imputed gene expression of every gene
     """
 
     xformat = checkformat(x)
@@ -31,36 +48,32 @@ def validate_results(
 
     if xformat == "path":
         x = read_matrix(x)
+    elif xformat == "sparse":
+        x = sparse_expression_matrix(*x)
     if imputed_mtxformat == "path":
-        imputed_mtx = read_matrix_basic(imputed_mtx)
-
-
-
-    x_true = imputed_mtx[imputed_mtx.columns.intersection(x.columns)]
-    x_sorted = x[x_true.columns]
-
-
-    qualities = []
-    for i in range(len(x_true.index)):
-        X = x_true.iloc[i].values
-        Y = x_sorted.iloc[i].values
-        X1 = X.reshape(1, -1)
-        Y1 = Y.reshape(1, -1)
-
-        cs = cosine_similarity(X1, Y1)
-        qualities.append(cs[0,0])    
-    plt.hist(qualities)
-
-
-    fig, ax = plt.subplots(figsize=(15, 15))
-    plt.rcParams["font.size"] = 18
-    ax.spines["top"].set_visible(False)
-    ax.spines["right"].set_visible(False)
-    plt.hist(x=qualities, bins=40, range=(0,1))
-    plt.xlabel("cosine similarity")
-    plt.ylabel("frequency")
-    plt.savefig(os.path.join(outdir, "cosine_similarities.png"), bbox_inches="tight")
-
+        imputed_mtx = read_imputed_genes_of(imputed_mtx, x.columns)
+    else:
+        if "cell" in imputed_mtx.columns:
+            imputed_mtx = imputed_mtx.set_index("cell")
+        imputed_mtx = imputed_mtx[imputed_mtx.columns.intersection(x.columns)]
+
+    x_true = imputed_mtx
+    cell_positions = x.index.get_indexer(x_true.index)
+    if (cell_positions == -1).any():
+        raise ValueError(f"Imputed cells not found in the gene expression matrix to impute for: {list(x_true.index[cell_positions == -1][:10])}")
+    x_values = expression_values(x[x_true.columns])[cell_positions]
+    stage_metrics(telemetry, "validation", cells=len(x_true.index), genes=len(x_true.columns))
+    if len(x_true.columns) == 0:
+        print("None of the imputed genes were measured in the gene expression matrix to impute for, so the imputation cannot be validated")
+    if sparse.issparse(x_values):
+        x_values = x_values.toarray()
+
+    imputed_values = x_true.to_numpy(dtype=np.float64)
+    qualities = cell_cosine_similarities(imputed_values, x_values)
+    gene_correlations = pd.DataFrame({
+        "pearson": gene_pearson_correlations(imputed_values, x_values),
+        "spearman": gene_spearman_correlations(imputed_values, x_values)
+    }, index=pd.Index(x_true.columns, name="gene"))
 
     scores = np.array(qualities)
     mean = np.mean(scores)
@@ -69,16 +82,157 @@ def validate_results(
     upper_quantile = np.percentile(scores, 75)
     stdev = np.std(scores)
 
-    f = open(os.path.join(outdir, "stats.txt"), "w+")
-    f.write(f"Mean: {mean}\nMedian: {median}\nLower quantile: {lower_quantile}\nUpper quantile: {upper_quantile}\nStandard deviation: {stdev}")
-    f.close()
+    if outdir is not None:
+        Path(outdir).mkdir(parents=True, exist_ok=True)
+        gene_correlations.to_csv(os.path.join(outdir, "gene_correlations.tsv"), sep="\t")
+
+        f = open(os.path.join(outdir, "stats.txt"), "w+")
+        f.write(f"Mean: {mean}\nMedian: {median}\nLower quantile: {lower_quantile}\nUpper quantile: {upper_quantile}\nStandard deviation: {stdev}")
+        f.close()
 
-    print_str = " ".join(map(str, qualities))
-    with open(os.path.join(outdir, "scores.txt"), "w") as f:
-        f.write(print_str)
+        print_str = " ".join(map(str, qualities))
+        with open(os.path.join(outdir, "scores.txt"), "w") as f:
+            f.write(print_str)
+
+        if plot:
+            plot_scores(qualities, outdir)
 
     print("Mean:", mean)
     print("Median:", median)
     print("Lower quantile:", lower_quantile)
     print("Upper quantile:", upper_quantile)
     print("Standard deviation:", stdev)
+    print("Median gene Pearson correlation:", gene_correlations["pearson"].median())
+    print("Median gene Spearman correlation:", gene_correlations["spearman"].median())
+
+    return (pd.Series(qualities, index=x_true.index, name="cosine_similarity"), gene_correlations)
+
+def plot_scores(
+    qualities,
+    outdir
+):
+    """
+    Plots a histogram of the cosine similarities between measured and imputed gene expression to "cosine_similarities.png".
+
+    matplotlib is only imported here, and the figure is drawn without pyplot, so that no GUI backend is needed. If matplotlib is not installed, the plot is skipped with a warning, so that the run still completes.
+
+    Parameters
+    ----------
+    qualities : numpy.ndarray, required
+        cosine similarity of every cell
+    outdir : str or pathlib.Path, required
+        location of the output directory
+
+    Returns
+    -------
+    plotted : bool
+        whether the histogram was written
+    """
+
+    try:
+        import matplotlib
+        from matplotlib.figure import Figure
+    except ImportError:
+        warnings.warn("Plotting the validation scores requires matplotlib, so cosine_similarities.png is not written. Install it with 'pip install \"scimpute[plot]\"', or run with plot=False.")
+        return False
+
+    with matplotlib.rc_context({"font.size": 18}):
+        fig = Figure(figsize=(15, 15))
+        ax = fig.subplots()
+        ax.spines["top"].set_visible(False)
+        ax.spines["right"].set_visible(False)
+        ax.hist(x=qualities, bins=40, range=(0,1))
+        ax.set_xlabel("cosine similarity")
+        ax.set_ylabel("frequency")
+        fig.savefig(os.path.join(outdir, "cosine_similarities.png"), bbox_inches="tight")
+
+    return True
+
+def read_imputed_genes_of(
+    imputed_mtx,
+    genes
+):
+    """
+    Reads the imputed values of the genes that were also measured, from an imputed gene expression matrix file or from a folder of imputation chunk files.
+
+    Parameters
+    ----------
+    imputed_mtx : str or pathlib.Path, required
+        path to the imputed gene expression matrix in any of the output formats ("tsv", "npz" or "parquet"), or to a folder containing imputation chunk files
+    genes : pandas.Index, required
+        measured genes
+    """
+
+    if os.path.isdir(imputed_mtx):
+        files = [file for file, _, _ in list_chunk_files(imputed_mtx)]
+    else:
+        files = [imputed_mtx]
+    if not files:
+        return pd.DataFrame(index=pd.Index([], name="cell"))
+
+    shared_genes = read_imputed_genes(files[0]).intersection(genes)
+    return pd.concat([read_imputed_matrix(file, genes=shared_genes) for file in files])
+
+def cell_cosine_similarities(
+    imputed_values,
+    measured_values
+):
+    """
+    Computes the cosine similarity between the imputed and the measured gene expression of every cell. Cells without any expression in one of the two matrices have a similarity of 0.
+
+    Parameters
+    ----------
+    imputed_values : numpy.ndarray, required
+        imputed gene expression; cells as rows, genes as columns
+    measured_values : numpy.ndarray, required
+        measured gene expression of the same cells and genes
+    """
+
+    norms = np.linalg.norm(imputed_values, axis=1) * np.linalg.norm(measured_values, axis=1)
+    dot_products = np.einsum("ij,ij->i", imputed_values, measured_values)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(norms > 0, dot_products / norms, 0.0)
+
+def gene_pearson_correlations(
+    imputed_values,
+    measured_values
+):
+    """
+    Computes the Pearson correlation between the imputed and the measured gene expression of every gene across all cells. Genes with constant expression in one of the two matrices have a correlation of NaN.
+
+    Parameters
+    ----------
+    imputed_values : numpy.ndarray, required
+        imputed gene expression; cells as rows, genes as columns
+    measured_values : numpy.ndarray, required
+        measured gene expression of the same cells and genes
+    """
+
+    imputed_centered = imputed_values - imputed_values.mean(axis=0)
+    measured_centered = measured_values - measured_values.mean(axis=0)
+    covariances = np.einsum("ij,ij->j", imputed_centered, measured_centered)
+    norms = np.sqrt(np.einsum("ij,ij->j", imputed_centered, imputed_centered) * np.einsum("ij,ij->j", measured_centered, measured_centered))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(norms > 0, covariances / norms, np.nan)
+
+def gene_spearman_correlations(
+    imputed_values,
+    measured_values
+):
+    """
+    Computes the Spearman rank correlation between the imputed and the measured gene expression of every gene across all cells. Genes with constant expression in one of the two matrices have a correlation of NaN.
+
+    Parameters
+    ----------
+    imputed_values : numpy.ndarray, required
+        imputed gene expression; cells as rows, genes as columns
+    measured_values : numpy.ndarray, required
+        measured gene expression of the same cells and genes
+    """
+
+    # scipy.stats takes long to import and is therefore only imported here
+    from scipy.stats import rankdata
+
+    if imputed_values.shape[0] == 0:
+        return np.full(imputed_values.shape[1], np.nan)
+    return gene_pearson_correlations(rankdata(imputed_values, axis=0), rankdata(measured_values, axis=0))
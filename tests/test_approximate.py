@@ -0,0 +1,58 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scimpute.similarity import approximate_top_k_neighbors, neighbor_recall, similarity_matrix, top_k_neighbors
+from scimpute.utils import cosine_similarity
+
+pytest.importorskip("sklearn")
+
+
+@pytest.fixture(scope="module")
+def clustered():
+    # reference cells scattered around a few distinct profiles, as found by the partitioning
+    rng = np.random.default_rng(0)
+    centers = rng.gamma(shape=0.5, scale=2.0, size=(8, 30))
+    y = centers[rng.integers(0, 8, size=1200)] * rng.uniform(0.8, 1.2, (1200, 30)) + rng.uniform(0, 0.2, (1200, 30))
+    x = centers[rng.integers(0, 8, size=150)] * rng.uniform(0.8, 1.2, (150, 30)) + rng.uniform(0, 0.2, (150, 30))
+    return (x, y)
+
+def recall(top_indices, exact_indices):
+    return sum(len(np.intersect1d(exact, approximate)) for exact, approximate in zip(exact_indices, top_indices)) / exact_indices.size
+
+def test_approximate_search_recalls_most_exact_neighbors(clustered):
+    x, y = clustered
+    top_indices, top_values = approximate_top_k_neighbors(x, y, 10)
+    exact_indices, _ = top_k_neighbors(cosine_similarity(x, y), 10)
+
+    assert top_indices.shape == (150, 10)
+    assert (top_indices != -1).all()
+    assert recall(top_indices, exact_indices) > 0.9
+    np.testing.assert_allclose(top_values, np.take_along_axis(cosine_similarity(x, y), top_indices, axis=1), rtol=1e-6)
+
+def test_probing_every_partition_is_exact(clustered):
+    x, y = clustered
+    top_indices, _ = approximate_top_k_neighbors(x, y, 10, n_lists=20, n_probes=20)
+    exact_indices, _ = top_k_neighbors(cosine_similarity(x, y), 10)
+    np.testing.assert_array_equal(top_indices, exact_indices)
+
+def test_neighbor_recall_counts_the_sampled_exact_neighbors(clustered):
+    x, y = clustered
+    exact_indices, _ = top_k_neighbors(cosine_similarity(x, y), 10)
+    assert neighbor_recall(x, y, exact_indices, 10, sample_size=50) == (500, 500)
+
+    # the last neighbor of every cell is missed
+    top_indices = exact_indices.copy()
+    top_indices[:, -1] = -1
+    hits, total = neighbor_recall(x, y, top_indices, 10, sample_size=50)
+    assert (hits, total) == (450, 500)
+
+def test_similarity_matrix_reports_the_recall(clustered, tmp_path):
+    x, y = clustered
+    x = pd.DataFrame(x, index=[f"spot_{i}" for i in range(len(x))], columns=[f"gene_{i}" for i in range(x.shape[1])])
+    y = pd.DataFrame(y, index=[f"reference_{i}" for i in range(len(y))], columns=x.columns)
+    clusters = pd.DataFrame({"id": 0}, index=pd.Index(list(x.index) + list(y.index), name="cell"))
+
+    similarity_matrix(x, y, clusters, 0, outdir=str(tmp_path), metric="approximate_cosine_similarity", k_neighbors=10)
+    lines = (tmp_path / "neighbor_recall.txt").read_text().splitlines()
+    assert float(lines[0].split(": ")[1]) > 0.9
+    assert lines[1] == "Sampled neighbors: 1500"
@@ -0,0 +1,87 @@
+import os
+import threading
+import time
+import pytest
+import scimpute.imputation
+from scimpute.imputation import impute_expression
+from scimpute.io import read_imputed_matrix
+from scimpute.similarity import similarity_matrix
+from scimpute.synthetic import synthetic_dataset
+from scimpute.utils import background_writer
+
+
+@pytest.mark.parametrize("max_pending", [None, 0])
+def test_writes_run_immediately_without_a_queue(max_pending):
+    threads = []
+    with background_writer(max_pending) as writer:
+        writer(lambda: threads.append(threading.current_thread()))
+        assert threads == [threading.current_thread()]
+
+def test_queued_writes_run_in_order_before_the_context_is_left():
+    written = []
+    with background_writer(2) as writer:
+        for i in range(20):
+            writer(lambda i=i: written.append((i, threading.current_thread().name)))
+    assert [i for i, _ in written] == list(range(20))
+    assert {name for _, name in written} == {"scimpute-writer"}
+
+def test_write_error_is_raised_when_the_context_is_left():
+    written = []
+    def fail():
+        raise OSError("disk full")
+    with pytest.raises(OSError, match="disk full"):
+        with background_writer(4) as writer:
+            writer(lambda: written.append(0))
+            writer(fail)
+            writer(lambda: written.append(2))
+    # writes queued after the failed one are skipped
+    assert written == [0]
+
+def test_write_error_is_raised_by_a_later_write():
+    def fail():
+        raise OSError("disk full")
+    raised_by_write = False
+    with pytest.raises(OSError, match="disk full"):
+        with background_writer(1) as writer:
+            writer(fail)
+            # the error is raised by the first write queued after the failed write has finished
+            for _ in range(500):
+                try:
+                    writer(lambda: None)
+                except OSError:
+                    raised_by_write = True
+                    raise
+                time.sleep(0.01)
+    assert raised_by_write
+
+@pytest.fixture(scope="module")
+def dataset():
+    x, y, clusters, cell_name_column_idx = synthetic_dataset(n_cells=120, n_reference_cells=400, n_genes=60, n_measured_genes=20, n_clusters=3)
+    neighbors = similarity_matrix(x, y, clusters, cell_name_column_idx, outdir=None, compact=True)
+    return (x, y, neighbors)
+
+@pytest.mark.parametrize("output_format", ["tsv", "npz"])
+def test_pipelined_imputation_writes_the_same_chunks(dataset, tmp_path, output_format):
+    x, y, neighbors = dataset
+    impute_expression(x, y, neighbors, outdir=str(tmp_path / "direct"), chunk_size=25, output_format=output_format)
+    impute_expression(x, y, neighbors, outdir=str(tmp_path / "pipelined"), chunk_size=25, output_format=output_format, write_queue_size=2)
+    files = sorted(os.listdir(tmp_path / "direct" / "imputations"))
+    assert len(files) == 5
+    assert sorted(os.listdir(tmp_path / "pipelined" / "imputations")) == files
+    for file in files:
+        assert read_imputed_matrix(tmp_path / "pipelined" / "imputations" / file).equals(read_imputed_matrix(tmp_path / "direct" / "imputations" / file))
+
+def test_pipelined_imputation_raises_a_write_error(dataset, tmp_path, monkeypatch):
+    x, y, neighbors = dataset
+    write_imputed_matrix = scimpute.imputation.write_imputed_matrix
+    def failing_write(imputed_mtx, filepath, output_format="tsv"):
+        if "_50_75" in str(filepath):
+            raise OSError("disk full")
+        return write_imputed_matrix(imputed_mtx, filepath, output_format)
+    monkeypatch.setattr(scimpute.imputation, "write_imputed_matrix", failing_write)
+    with pytest.raises(OSError, match="disk full"):
+        impute_expression(x, y, neighbors, outdir=str(tmp_path), chunk_size=25, write_queue_size=1)
+    files = os.listdir(tmp_path / "imputations")
+    # the failed chunk is not given its final name, and the chunks after it are not written
+    assert "CPM_imputation_000_0_25.tsv" in files
+    assert not any("_50_75" in file or "_75_100" in file or "_100_120" in file for file in files)
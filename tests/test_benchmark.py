@@ -0,0 +1,85 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from scimpute.benchmark import compare_benchmarks, parse_grid, run_benchmarks
+from scimpute.io import read_inputs
+from scimpute.synthetic import synthetic_dataset, write_synthetic_dataset
+from scimpute.utils import is_sparse
+
+
+def test_synthetic_dataset_shapes_and_sparsity():
+    x, y, clusters, cell_name_column_idx = synthetic_dataset(n_cells=200, n_reference_cells=500, n_genes=80, n_measured_genes=30, n_clusters=4, sparsity=0.8)
+    assert x.shape == (200, 30)
+    assert y.shape == (500, 80)
+    assert x.columns.isin(y.columns).all()
+    assert list(clusters.index) == list(x.index) + list(y.index)
+    assert clusters["id"].nunique() == 4
+    assert cell_name_column_idx == 0
+    assert (y.to_numpy() == 0).mean() == pytest.approx(0.8, abs=0.02)
+    assert (x.to_numpy() == 0).mean() == pytest.approx(0.8, abs=0.02)
+
+def test_synthetic_dataset_is_reproducible():
+    first = synthetic_dataset(n_cells=50, n_reference_cells=100, n_genes=20, n_measured_genes=5, random_state=4)
+    second = synthetic_dataset(n_cells=50, n_reference_cells=100, n_genes=20, n_measured_genes=5, random_state=4)
+    other = synthetic_dataset(n_cells=50, n_reference_cells=100, n_genes=20, n_measured_genes=5, random_state=5)
+    for a, b in zip(first[:3], second[:3]):
+        pd.testing.assert_frame_equal(a, b)
+    assert not first[1].equals(other[1])
+
+def test_sparse_synthetic_dataset_matches_the_dense_one():
+    dense = synthetic_dataset(n_cells=50, n_reference_cells=100, n_genes=20, n_measured_genes=5)
+    x, y, _, _ = synthetic_dataset(n_cells=50, n_reference_cells=100, n_genes=20, n_measured_genes=5, sparse_output=True)
+    assert is_sparse(x) and is_sparse(y)
+    np.testing.assert_array_equal(y.sparse.to_dense().to_numpy(), dense[1].to_numpy())
+
+@pytest.mark.parametrize("parameters, message", [
+    (dict(sparsity=1.0), "sparsity"),
+    (dict(n_genes=10, n_measured_genes=20), "n_measured_genes")
+])
+def test_invalid_synthetic_parameters_are_rejected(parameters, message):
+    with pytest.raises(ValueError, match=message):
+        synthetic_dataset(**parameters)
+
+def test_written_synthetic_dataset_can_be_read_as_inputs(tmp_path):
+    paths = write_synthetic_dataset(tmp_path / "inputs", n_cells=40, n_reference_cells=80, n_genes=15, n_measured_genes=5, n_clusters=2)
+    x, y, clusters, _ = read_inputs(*paths, outdir=str(tmp_path / "output"))
+    expected_x, expected_y, _, _ = synthetic_dataset(n_cells=40, n_reference_cells=80, n_genes=15, n_measured_genes=5, n_clusters=2)
+    np.testing.assert_array_equal(x.to_numpy(), expected_x.to_numpy())
+    np.testing.assert_array_equal(y.to_numpy(), expected_y.to_numpy())
+
+def test_run_benchmarks_writes_a_baseline(tmp_path):
+    results = run_benchmarks(tmp_path, grid={"n_cells": [60, 120]}, n_reference_cells=200, n_genes=40, n_measured_genes=10, n_clusters=3, chunk_size=50)
+
+    stages = ["similarity_matrix", "impute_expression", "merge_imputation_chunks", "validate_results"]
+    assert list(results["stage"]) == stages * 2
+    assert list(results["n_cells"]) == [60] * 4 + [120] * 4
+    assert (results["seconds"] > 0).all() and (results["peak_memory_mb"] > 0).all()
+    with open(tmp_path / "benchmark.json") as f:
+        baseline = json.load(f)
+    assert set(baseline) == {"version", "environment", "repeats", "random_state", "results"}
+    assert len(baseline["results"]) == 8
+    pd.testing.assert_frame_equal(pd.read_csv(tmp_path / "benchmark.tsv", sep="\t")[["stage", "n_cells"]], results[["stage", "n_cells"]])
+    assert not os.path.exists(tmp_path / "runs")
+
+def test_unknown_benchmark_parameters_are_rejected(tmp_path):
+    with pytest.raises(ValueError, match="n_spots"):
+        run_benchmarks(tmp_path, grid={"n_spots": [10]})
+
+def test_compare_benchmarks_flags_regressions(tmp_path):
+    def write(filepath, seconds, memory):
+        records = [{"n_cells": 100, "stage": stage, "seconds": s, "all_seconds": [s], "peak_memory_mb": m} for stage, s, m in zip(["a", "b", "c"], seconds, memory)]
+        with open(filepath, "w") as f:
+            json.dump({"results": records}, f)
+    write(tmp_path / "baseline.json", [1.0, 1.0, 1.0], [10, 10, 10])
+    write(tmp_path / "current.json", [1.1, 1.5, 1.0], [10, 10, 13])
+
+    comparison = compare_benchmarks(tmp_path / "baseline.json", tmp_path / "current.json", tolerance=0.2)
+    assert list(comparison["regression"]) == [False, True, True]
+    assert list(comparison["time_ratio"]) == pytest.approx([1.1, 1.5, 1.0])
+
+def test_parse_grid_reads_literals():
+    assert parse_grid(["n_cells=100, 200", "dtype=float32,None", "consider_clusters=True"]) == {"n_cells": [100, 200], "dtype": ["float32", None], "consider_clusters": [True]}
+    with pytest.raises(ValueError, match="name=value1,value2"):
+        parse_grid(["n_cells"])
@@ -0,0 +1,52 @@
+import pandas as pd
+import pytest
+from scimpute import expression_imputation
+from scimpute.imputation import impute_expression, selected_genes
+from scimpute.io import read_imputed_matrix
+from scimpute.similarity import similarity_matrix
+from scimpute.synthetic import synthetic_dataset
+
+
+@pytest.fixture(scope="module")
+def dataset():
+    return synthetic_dataset(n_cells=80, n_reference_cells=300, n_genes=50, n_measured_genes=20, n_clusters=3)
+
+@pytest.fixture(scope="module")
+def genes(dataset):
+    # two measured and two unmeasured genes, out of the order of the reference
+    x, y, _, _ = dataset
+    unmeasured = y.columns.difference(x.columns)
+    return [x.columns[5], unmeasured[3], x.columns[0], unmeasured[0]]
+
+def test_selected_genes_keep_the_given_order(tmp_path):
+    available = pd.Index(["a", "b", "c", "d"])
+    assert selected_genes(available, None) is available
+    assert list(selected_genes(available, ["c", "a", "c"])) == ["c", "a"]
+    (tmp_path / "genes.txt").write_text("d\nb\n")
+    assert list(selected_genes(available, tmp_path / "genes.txt")) == ["d", "b"]
+
+@pytest.mark.parametrize("genes, message", [(["a", "e"], "Genes not found.*'e'"), ([], "No genes")])
+def test_invalid_gene_selections_are_rejected(genes, message):
+    with pytest.raises(ValueError, match=message):
+        selected_genes(pd.Index(["a", "b"]), genes)
+
+@pytest.mark.parametrize("sparse_output", [False, True])
+def test_gene_subset_matches_the_columns_of_a_full_imputation(genes, sparse_output):
+    x, y, clusters, cell_name_column_idx = synthetic_dataset(n_cells=80, n_reference_cells=300, n_genes=50, n_measured_genes=20, n_clusters=3, sparse_output=sparse_output)
+    neighbors = similarity_matrix(x, y, clusters, cell_name_column_idx, outdir=None, k_neighbors=5, compact=True)
+    full = impute_expression(x, y, neighbors, outdir=None, chunk_size=30)
+    subset = impute_expression(x, y, neighbors, outdir=None, chunk_size=30, genes=genes)
+    pd.testing.assert_frame_equal(subset, full[genes])
+
+def test_run_imputes_and_validates_only_the_selected_genes(dataset, genes, tmp_path):
+    x, y, clusters, cell_name_column_idx = dataset
+    expression_imputation(x, y, clusters, cell_name_column_idx, outdir=str(tmp_path / "full"), k_neighbors=5, chunk_size=30, plot=False)
+    (tmp_path / "genes.txt").write_text("\n".join(genes))
+    expression_imputation(x, y, clusters, cell_name_column_idx, outdir=str(tmp_path / "subset"), k_neighbors=5, chunk_size=30, plot=False, genes=str(tmp_path / "genes.txt"))
+
+    full = read_imputed_matrix(tmp_path / "full" / "imputation.tsv")
+    subset = read_imputed_matrix(tmp_path / "subset" / "imputation.tsv")
+    assert list(subset.columns) == genes
+    pd.testing.assert_frame_equal(subset, full[genes])
+    gene_correlations = pd.read_csv(tmp_path / "subset" / "gene_correlations.tsv", sep="\t", index_col=0)
+    assert sorted(gene_correlations.index) == sorted(genes[0::2])
@@ -0,0 +1,57 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import sparse
+from scimpute.imputation import impute_expression, impute_chunk, weight_matrix
+from scimpute.neighbors import neighbors_from_table
+
+
+@pytest.fixture
+def dataset():
+    rng = np.random.default_rng(0)
+    x = pd.DataFrame(rng.random((6, 3)), index=[f"spot_{i}" for i in range(6)], columns=["g0", "g1", "g2"])
+    y = pd.DataFrame(rng.random((10, 5)) * 10, index=[f"reference_{i}" for i in range(10)], columns=["g0", "g1", "g2", "g3", "g4"])
+    table = pd.DataFrame({
+        "cluster": 0,
+        "x": ["spot_0", "spot_0", "spot_0", "spot_1", "spot_1", "spot_2", "spot_3", "spot_3", "spot_3", "spot_4", "other"],
+        "y": ["reference_0", "reference_3", "reference_0", "reference_9", "reference_2", "reference_5", "reference_1", "reference_4", "reference_1", "reference_8", "reference_7"],
+        "distance": [1.9, 1.5, 1.9, 1.2, 1.7, 1.4, 1.1, 1.8, 1.1, 1.6, 1.3]
+    })
+    # spot_0 and spot_3 have a duplicate neighbor pair, spot_5 has no neighbors and "other" is not part of x
+    return (x, y, table)
+
+def dense_imputation(x, y, table):
+    table = table.drop_duplicates(["x", "y"])
+    imputed = pd.DataFrame(np.nan, index=x.index, columns=y.columns)
+    for cell in x.index:
+        neighbors = table[table["x"] == cell]
+        if len(neighbors) > 0:
+            weights = neighbors["distance"].to_numpy()
+            imputed.loc[cell] = weights @ y.loc[neighbors["y"]].to_numpy() / weights.sum()
+    return imputed.round(2)
+
+def test_weight_matrix_counts_duplicate_pairs_once(dataset):
+    x, y, table = dataset
+    weights = weight_matrix(table, x.index, y.index)
+    expected = np.zeros((len(x.index), len(y.index)))
+    for _, row in table.drop_duplicates(["x", "y"]).iterrows():
+        if row["x"] in x.index:
+            expected[x.index.get_loc(row["x"]), y.index.get_loc(row["y"])] = row["distance"]
+    np.testing.assert_array_equal(weights.toarray(), expected)
+
+@pytest.mark.parametrize("y_format", ["dense", "sparse"])
+def test_impute_chunk_matches_dense_reference(dataset, y_format):
+    x, y, table = dataset
+    weights = weight_matrix(table, x.index, y.index)
+    y_values = y.to_numpy() if y_format == "dense" else sparse.csr_matrix(y.to_numpy())
+    imputed = impute_chunk(weights, y_values)
+    expected = dense_imputation(x, y, table)
+    np.testing.assert_allclose(imputed, expected.to_numpy(), rtol=0, atol=0.01)
+    assert np.isnan(imputed[x.index.get_loc("spot_5")]).all()
+
+@pytest.mark.parametrize("table_format", ["long", "compact"])
+def test_impute_expression_matches_dense_reference(dataset, table_format):
+    x, y, table = dataset
+    similarity = table if table_format == "long" else neighbors_from_table(table, y.index)
+    imputed = impute_expression(x, y, similarity, outdir=None, chunk_size=4)
+    pd.testing.assert_frame_equal(imputed, dense_imputation(x, y, table), check_names=False, atol=0.01, rtol=0)
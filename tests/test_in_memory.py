@@ -0,0 +1,53 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from scimpute import expression_imputation
+from scimpute.io import read_imputed_matrix, read_neighbors
+from scimpute.synthetic import synthetic_dataset
+
+
+@pytest.fixture(scope="module")
+def dataset():
+    return synthetic_dataset(n_cells=90, n_reference_cells=300, n_genes=50, n_measured_genes=20, n_clusters=3)
+
+@pytest.fixture(scope="module")
+def disk_run(dataset, tmp_path_factory):
+    x, y, clusters, cell_name_column_idx = dataset
+    outdir = tmp_path_factory.mktemp("disk")
+    expression_imputation(x, y, clusters, cell_name_column_idx, outdir=str(outdir), k_neighbors=5, chunk_size=40, plot=False)
+    return outdir
+
+def test_in_memory_results_match_a_run_on_the_disk(dataset, disk_run, tmp_path, monkeypatch):
+    x, y, clusters, cell_name_column_idx = dataset
+    monkeypatch.chdir(tmp_path)
+    imputed_mtx, neighbors, scores, gene_correlations = expression_imputation(x, y, clusters, cell_name_column_idx, outdir=None, k_neighbors=5, chunk_size=40, in_memory=True)
+
+    pd.testing.assert_frame_equal(imputed_mtx, read_imputed_matrix(disk_run / "imputation.tsv"), check_names=False)
+    stored = read_neighbors(disk_run / "sim_matrix.tsv")
+    assert list(neighbors["cells"]) == list(stored["cells"])
+    np.testing.assert_array_equal(neighbors["reference_cells"].to_numpy()[neighbors["indices"]], stored["reference_cells"].to_numpy()[stored["indices"]])
+    assert list(scores.index) == list(x.index)
+    np.testing.assert_allclose(scores.to_numpy(), np.loadtxt(disk_run / "scores.txt"))
+    pd.testing.assert_frame_equal(gene_correlations, pd.read_csv(disk_run / "gene_correlations.tsv", sep="\t", index_col=0))
+    # outdir=None writes no files at all
+    assert os.listdir(tmp_path) == []
+
+def test_in_memory_run_writes_only_the_final_outputs(dataset, disk_run, tmp_path):
+    x, y, clusters, cell_name_column_idx = dataset
+    imputed_mtx, _, _, _ = expression_imputation(x, y, clusters, cell_name_column_idx, outdir=str(tmp_path), k_neighbors=5, chunk_size=40, in_memory=True, plot=False, output_format="npz")
+
+    pd.testing.assert_frame_equal(read_imputed_matrix(tmp_path / "imputation.npz"), imputed_mtx, check_names=False)
+    assert (tmp_path / "sim_matrix.npz").exists()
+    np.testing.assert_allclose(np.loadtxt(tmp_path / "scores.txt"), np.loadtxt(disk_run / "scores.txt"))
+    assert not (tmp_path / "imputations").exists()
+
+@pytest.mark.parametrize("parameters, message", [
+    (dict(outdir=None), "outdir can only be None"),
+    (dict(in_memory=True, resume=True), "resume cannot be combined with in_memory"),
+    (dict(in_memory=True, incremental=True), "incremental cannot be combined")
+])
+def test_invalid_in_memory_combinations_are_rejected(dataset, tmp_path, parameters, message):
+    x, y, clusters, cell_name_column_idx = dataset
+    with pytest.raises(ValueError, match=message):
+        expression_imputation(x, y, clusters, cell_name_column_idx, **{"outdir": str(tmp_path), **parameters})
@@ -0,0 +1,110 @@
+import json
+import numpy as np
+import pandas as pd
+import pytest
+from scimpute import expression_imputation
+from scimpute.checkpoint import MANIFEST_FILE
+from scimpute.incremental import REFERENCE_CELLS_FILE, read_reference_cells
+from scimpute.io import output_extension, read_imputed_matrix, read_neighbors
+from scimpute.neighbors import compact_neighbors, merge_neighbors, neighbor_table
+from scimpute.synthetic import synthetic_dataset
+
+FORMATS = ["tsv", "npz", "parquet"]
+
+
+@pytest.fixture(scope="module")
+def dataset():
+    # the counts of synthetic_dataset are integers, so that many cells have equally similar neighbors, of which a full and an incremental search may select different ones; continuous values avoid these ties
+    x, y, clusters, cell_name_column_idx = synthetic_dataset(n_cells=200, n_reference_cells=800, n_genes=150, n_measured_genes=40, n_clusters=4, sparsity=0.0)
+    rng = np.random.default_rng(1)
+    x = x * rng.uniform(0.5, 1.5, x.shape) + rng.uniform(0, 0.1, x.shape)
+    y = y * rng.uniform(0.5, 1.5, y.shape) + rng.uniform(0, 0.1, y.shape)
+    return (x, y, clusters, cell_name_column_idx)
+
+def run(x, y, clusters, cell_name_column_idx, outdir, output_format):
+    expression_imputation(x, y, clusters, cell_name_column_idx, outdir=str(outdir), chunk_size=50, output_format=output_format, plot=False, incremental=True)
+
+def read_results(outdir, output_format):
+    extension = output_extension(output_format)
+    # long-form tables store the reference cells in the order of their first use, so the neighbors are compared by name
+    table = neighbor_table(read_neighbors(outdir / f"sim_matrix{extension}"))
+    table = table.sort_values("x", kind="stable").reset_index(drop=True)
+    return (read_imputed_matrix(outdir / f"imputation{extension}"), table)
+
+def assert_same_results(outdir, expected_dir, output_format):
+    imputed_mtx, table = read_results(outdir, output_format)
+    expected_mtx, expected_table = read_results(expected_dir, output_format)
+    pd.testing.assert_frame_equal(imputed_mtx, expected_mtx, check_exact=True)
+    pd.testing.assert_frame_equal(table, expected_table, check_exact=True)
+
+@pytest.mark.parametrize("output_format", FORMATS)
+def test_adding_cells_matches_full_run(dataset, tmp_path, output_format):
+    x, y, clusters, cell_name_column_idx = dataset
+    run(x.iloc[:120], y.iloc[:600], clusters, cell_name_column_idx, tmp_path / "incremental", output_format)
+    run(x, y, clusters, cell_name_column_idx, tmp_path / "incremental", output_format)
+    run(x, y, clusters, cell_name_column_idx, tmp_path / "full", output_format)
+    assert_same_results(tmp_path / "incremental", tmp_path / "full", output_format)
+
+@pytest.mark.parametrize("output_format", FORMATS)
+def test_removing_reference_cells_matches_full_run(dataset, tmp_path, output_format):
+    x, y, clusters, cell_name_column_idx = dataset
+    y_removed = y.drop(y.index[::7])
+    run(x, y, clusters, cell_name_column_idx, tmp_path / "incremental", output_format)
+    run(x, y_removed, clusters, cell_name_column_idx, tmp_path / "incremental", output_format)
+    run(x, y_removed, clusters, cell_name_column_idx, tmp_path / "full", output_format)
+    assert_same_results(tmp_path / "incremental", tmp_path / "full", output_format)
+
+def test_reordered_cells_keep_their_stored_imputation(dataset, tmp_path):
+    x, y, clusters, cell_name_column_idx = dataset
+    run(x, y, clusters, cell_name_column_idx, tmp_path, "tsv")
+    stored_mtx = read_imputed_matrix(tmp_path / "imputation.tsv")
+    reordered = x.iloc[::-1].iloc[10:]
+    run(reordered, y, clusters, cell_name_column_idx, tmp_path, "tsv")
+    imputed_mtx = read_imputed_matrix(tmp_path / "imputation.tsv")
+    assert list(imputed_mtx.index) == list(reordered.index)
+    pd.testing.assert_frame_equal(imputed_mtx, stored_mtx.iloc[stored_mtx.index.get_indexer(reordered.index)], check_exact=True)
+
+def test_manifest_records_incremental_results(dataset, tmp_path):
+    x, y, clusters, cell_name_column_idx = dataset
+    run(x.iloc[:50], y, clusters, cell_name_column_idx, tmp_path, "npz")
+    with open(tmp_path / MANIFEST_FILE) as f:
+        manifest = json.load(f)
+    assert list(manifest) == ["incremental"]
+    assert set(manifest["incremental"]) == {"key", "files"}
+    assert manifest["incremental"]["files"] == ["sim_matrix.npz", "imputation.npz", REFERENCE_CELLS_FILE]
+    assert list(read_reference_cells(tmp_path)) == list(y.index)
+
+def test_changed_parameters_impute_all_cells(dataset, tmp_path):
+    x, y, clusters, cell_name_column_idx = dataset
+    run(x.iloc[:50], y, clusters, cell_name_column_idx, tmp_path, "npz")
+    key = json.loads((tmp_path / MANIFEST_FILE).read_text())["incremental"]["key"]
+    expression_imputation(x, y, clusters, cell_name_column_idx, outdir=str(tmp_path), chunk_size=50, output_format="npz", plot=False, incremental=True, k_neighbors=10)
+    assert json.loads((tmp_path / MANIFEST_FILE).read_text())["incremental"]["key"] != key
+    assert read_neighbors(tmp_path / "sim_matrix.npz")["indices"].shape == (len(x.index), 10)
+
+def test_merge_neighbors_keeps_the_k_most_similar():
+    neighbors = compact_neighbors(
+        cells = ["a", "b", "c"],
+        reference_cells = ["r0", "r1", "r2", "r3", "r4"],
+        clusters = [0, 0, 1],
+        indices = np.array([[0, 1, 2], [1, -1, -1], [3, 4, -1]]),
+        distances = np.array([[1.9, 1.5, 1.2], [1.8, np.nan, np.nan], [1.7, 1.1, np.nan]])
+    )
+    candidates = compact_neighbors(
+        cells = ["c", "a"],
+        reference_cells = neighbors["reference_cells"],
+        clusters = [1, 0],
+        indices = np.array([[2, 1], [3, 4]]),
+        distances = np.array([[1.95, 1.0], [1.6, 1.1]])
+    )
+    merged = merge_neighbors(neighbors, candidates, 3)
+    assert list(merged["cells"]) == ["a", "b", "c"]
+    np.testing.assert_array_equal(merged["indices"], [[0, 3, 1], [1, -1, -1], [2, 3, 4]])
+    np.testing.assert_array_equal(merged["distances"], [[1.9, 1.6, 1.5], [1.8, np.nan, np.nan], [1.95, 1.7, 1.1]])
+    assert merged["indices"].dtype == neighbors["indices"].dtype
+
+def test_merge_neighbors_rejects_unknown_cells():
+    neighbors = compact_neighbors(["a"], ["r0"], [0], np.array([[0]]), np.array([[2.0]]))
+    candidates = compact_neighbors(["z"], ["r0"], [0], np.array([[0]]), np.array([[1.5]]))
+    with pytest.raises(KeyError):
+        merge_neighbors(neighbors, candidates, 1)
@@ -0,0 +1,24 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scimpute.io import write_imputed_matrix, read_imputed_matrix
+
+
+@pytest.fixture
+def imputed_mtx():
+    return pd.DataFrame(
+        np.arange(12, dtype=np.float64).reshape(3, 4),
+        index = pd.Index(["a", "b", "c"], name="cell"),
+        columns = ["g1", "g2", "g3", "g4"]
+    )
+
+@pytest.mark.parametrize("output_format", ["tsv", "npz", "parquet"])
+def test_imputed_matrix_round_trip(imputed_mtx, output_format, tmp_path):
+    filepath = write_imputed_matrix(imputed_mtx, tmp_path / "imputation", output_format)
+    pd.testing.assert_frame_equal(read_imputed_matrix(filepath), imputed_mtx, check_names=False)
+    pd.testing.assert_frame_equal(read_imputed_matrix(filepath, genes=["g3", "g1"]), imputed_mtx[["g3", "g1"]], check_names=False)
+
+def test_npz_gene_subset_names_missing_genes(imputed_mtx, tmp_path):
+    filepath = write_imputed_matrix(imputed_mtx, tmp_path / "imputation", "npz")
+    with pytest.raises(KeyError, match="'g5'"):
+        read_imputed_matrix(filepath, genes=["g1", "g5"])
@@ -0,0 +1,64 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from scimpute.io import read_imputed_matrix, write_imputed_matrix
+from scimpute.merge import merge_imputation_chunks
+
+
+@pytest.fixture
+def imputed_mtx():
+    rng = np.random.default_rng(0)
+    return pd.DataFrame(rng.random((23, 4)).round(2), index=[f"spot_{i}" for i in range(23)], columns=["g0", "g1", "g2", "g3"])
+
+def write_chunks(imputed_mtx, chunkdir, bounds, output_format="tsv"):
+    os.makedirs(chunkdir, exist_ok=True)
+    for i, (start, stop) in enumerate(bounds):
+        write_imputed_matrix(imputed_mtx.iloc[start:stop], os.path.join(chunkdir, f"CPM_imputation_{i:03}_{start}_{stop}"), output_format)
+
+@pytest.mark.parametrize("output_format", ["tsv", "npz", "parquet"])
+def test_merge_streams_the_chunks_in_cell_order(imputed_mtx, tmp_path, output_format):
+    # the eleventh chunk starts at cell 20, which sorts before cell 4 as a string
+    bounds = [(start, min(start + 2, 23)) for start in range(0, 23, 2)]
+    write_chunks(imputed_mtx, tmp_path / "imputations", bounds, output_format)
+
+    filepath = merge_imputation_chunks(str(tmp_path / "imputations"), str(tmp_path), output_format=output_format, return_matrix=False, n_cells=23)
+    pd.testing.assert_frame_equal(read_imputed_matrix(filepath), imputed_mtx, check_names=False)
+    assert not os.path.exists(tmp_path / "imputations")
+
+def test_merge_returns_the_matrix_and_keeps_the_chunks(imputed_mtx, tmp_path):
+    write_chunks(imputed_mtx, tmp_path / "imputations", [(0, 10), (10, 20), (20, 23)])
+    merged = merge_imputation_chunks(str(tmp_path / "imputations"), str(tmp_path), save_chunks=True)
+    pd.testing.assert_frame_equal(merged, imputed_mtx, check_names=False)
+    assert len(os.listdir(tmp_path / "imputations")) == 3
+
+@pytest.mark.parametrize("bounds, n_cells, message", [
+    ([(0, 10), (15, 23)], None, "cells 10 to 15 are missing"),
+    ([(5, 10), (10, 23)], None, "cells 0 to 5 are missing"),
+    ([(0, 10), (10, 20)], 23, "cells 20 to 23 are missing"),
+    ([(0, 12), (10, 23)], None, "overlaps")
+])
+def test_gaps_and_overlaps_are_rejected(imputed_mtx, tmp_path, bounds, n_cells, message):
+    write_chunks(imputed_mtx, tmp_path / "imputations", bounds)
+    with pytest.raises(ValueError, match=message):
+        merge_imputation_chunks(str(tmp_path / "imputations"), str(tmp_path), n_cells=n_cells)
+
+def test_duplicate_cells_are_rejected(imputed_mtx, tmp_path):
+    duplicated = imputed_mtx.rename(index={"spot_15": "spot_3"})
+    write_chunks(duplicated, tmp_path / "imputations", [(0, 10), (10, 23)])
+    with pytest.raises(ValueError, match="already imputed: \\['spot_3'\\]"):
+        merge_imputation_chunks(str(tmp_path / "imputations"), str(tmp_path))
+    # the chunks are kept if the merge fails
+    assert len(os.listdir(tmp_path / "imputations")) == 2
+
+def test_chunks_with_the_wrong_number_of_cells_are_rejected(imputed_mtx, tmp_path):
+    os.makedirs(tmp_path / "imputations")
+    write_imputed_matrix(imputed_mtx.iloc[0:8], tmp_path / "imputations" / "CPM_imputation_000_0_10", "tsv")
+    with pytest.raises(ValueError, match="contains 8 cells instead of 10"):
+        merge_imputation_chunks(str(tmp_path / "imputations"), str(tmp_path))
+
+def test_chunks_with_different_genes_are_rejected(imputed_mtx, tmp_path):
+    write_chunks(imputed_mtx, tmp_path / "imputations", [(0, 10)])
+    write_imputed_matrix(imputed_mtx.iloc[10:23, ::-1], tmp_path / "imputations" / "CPM_imputation_001_10_23", "tsv")
+    with pytest.raises(ValueError, match="different genes"):
+        merge_imputation_chunks(str(tmp_path / "imputations"), str(tmp_path))
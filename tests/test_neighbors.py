@@ -0,0 +1,103 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scimpute.io import read_neighbors, read_similarity_table, write_neighbors, write_similarity_table
+from scimpute.neighbors import compact_neighbors, concat_neighbors, count_neighbors, neighbor_table, neighbors_from_table
+from scimpute.similarity import similarity_matrix
+from scimpute.synthetic import synthetic_dataset
+
+
+@pytest.fixture
+def neighbors():
+    return compact_neighbors(
+        cells = ["a", "b", "c"],
+        reference_cells = ["r0", "r1", "r2", "r3"],
+        clusters = np.array(["t1", "t1", "t2"]),
+        indices = np.array([[2, 0, 1], [3, -1, -1], [-1, -1, -1]]),
+        distances = np.array([[1.9, 1.25, 1.125], [1.5, np.nan, np.nan], [np.nan, np.nan, np.nan]], dtype=np.float32)
+    )
+
+def assert_same_neighbors(neighbors, expected):
+    assert list(neighbors) == list(expected)
+    assert neighbors["cells"].equals(expected["cells"])
+    assert neighbors["reference_cells"].equals(expected["reference_cells"])
+    np.testing.assert_array_equal(neighbors["clusters"], expected["clusters"])
+    for name in ("indices", "distances"):
+        assert neighbors[name].dtype == expected[name].dtype
+        np.testing.assert_array_equal(neighbors[name], expected[name])
+
+def test_npz_round_trip_keeps_the_compact_table(neighbors, tmp_path):
+    filepath = write_neighbors(neighbors, tmp_path / "sim_matrix", "npz")
+    assert filepath.endswith("sim_matrix.npz")
+    with np.load(filepath) as data:
+        assert set(data.files) == {"cells", "reference_cells", "cluster", "indices", "distances"}
+        assert data["indices"].dtype == np.int32
+    assert_same_neighbors(read_neighbors(filepath), neighbors)
+
+def test_npz_round_trip_of_a_computed_table(tmp_path):
+    x, y, clusters, cell_name_column_idx = synthetic_dataset(n_cells=100, n_reference_cells=300, n_genes=80, n_measured_genes=30, n_clusters=3)
+    neighbors = similarity_matrix(x, y, clusters, cell_name_column_idx, outdir=str(tmp_path), output_format="npz", dtype="float32", compact=True)
+    stored = read_neighbors(tmp_path / "sim_matrix.npz")
+    assert_same_neighbors(stored, neighbors)
+    assert stored["distances"].dtype == np.float32
+    pd.testing.assert_frame_equal(read_similarity_table(tmp_path / "sim_matrix.npz"), neighbor_table(neighbors))
+
+@pytest.mark.parametrize("output_format", ["tsv", "parquet"])
+def test_long_form_round_trip_keeps_the_neighbors(neighbors, tmp_path, output_format):
+    neighbors = compact_neighbors(neighbors["cells"], neighbors["reference_cells"], neighbors["clusters"], neighbors["indices"], neighbors["distances"].astype(np.float64))
+    filepath = write_neighbors(neighbors, tmp_path / "sim_matrix", output_format)
+    table = read_similarity_table(filepath)
+    pd.testing.assert_frame_equal(table, neighbor_table(neighbors))
+    stored = read_neighbors(filepath)
+    # cells without neighbors have no rows in the long-form table
+    assert list(stored["cells"]) == ["a", "b"]
+    pd.testing.assert_frame_equal(neighbor_table(stored), neighbor_table(neighbors))
+
+def test_long_form_npz_tables_are_read_as_written(tmp_path):
+    table = pd.DataFrame({"cluster": [1, 1, 2], "x": ["a", "a", "b"], "y": ["r1", "r0", "r1"], "distance": [1.5, 1.25, 1.75]})
+    filepath = write_similarity_table(table, tmp_path / "sim_matrix", "npz")
+    pd.testing.assert_frame_equal(read_similarity_table(filepath), table)
+    neighbors = read_neighbors(filepath)
+    np.testing.assert_array_equal(neighbors["indices"], [[0, 1], [0, -1]])
+    assert list(neighbors["reference_cells"]) == ["r1", "r0"]
+
+def test_neighbors_from_table_drops_duplicate_pairs():
+    table = pd.DataFrame({"cluster": [1, 1, 1], "x": ["a", "a", "a"], "y": ["r0", "r1", "r0"], "distance": [1.5, 1.25, 1.5]})
+    neighbors = neighbors_from_table(table, reference_cells=["r1", "r0"])
+    np.testing.assert_array_equal(neighbors["indices"], [[1, 0]])
+    assert count_neighbors(neighbors) == 2
+    with pytest.raises(KeyError):
+        neighbors_from_table(table, reference_cells=["r0"])
+
+def test_compact_neighbors_of_an_empty_cluster():
+    empty = compact_neighbors([], ["r0", "r1"], np.array([]), np.empty((0, 25), dtype=np.intp), np.empty((0, 25)))
+    assert empty["indices"].shape == (0, 0)
+    assert empty["distances"].shape == (0, 0)
+    assert empty["indices"].dtype == np.int32
+    other = compact_neighbors(["a"], ["r0", "r1"], [1], np.array([[1, 0]]), np.array([[1.5, 1.25]]))
+    stacked = concat_neighbors([empty, other], other["reference_cells"])
+    assert list(stacked["cells"]) == ["a"]
+    np.testing.assert_array_equal(stacked["indices"], [[1, 0]])
+    assert concat_neighbors([], other["reference_cells"])["indices"].shape == (0, 0)
+
+def test_similarity_matrix_with_clusters_missing_from_one_dataset(tmp_path):
+    x, y, clusters, cell_name_column_idx = synthetic_dataset(n_cells=100, n_reference_cells=300, n_genes=80, n_measured_genes=30, n_clusters=3)
+    clusters = clusters.copy()
+    # a cluster with cells to impute for only, and one with cells to impute from only
+    clusters.loc[x.index[clusters.loc[x.index, "id"] == 0], "id"] = 10
+    clusters.loc[y.index[clusters.loc[y.index, "id"] == 1][::2], "id"] = 11
+    neighbors = similarity_matrix(x, y, clusters, cell_name_column_idx, outdir=str(tmp_path), output_format="npz", compact=True)
+    assert sorted(neighbors["cells"]) == sorted(x.index)
+    without_reference = neighbors["clusters"] == 10
+    assert without_reference.any()
+    assert (neighbors["indices"][without_reference] == -1).all()
+    assert (neighbors["indices"][~without_reference] != -1).all()
+    assert 11 not in neighbors["clusters"]
+    assert_same_neighbors(read_neighbors(tmp_path / "sim_matrix.npz"), neighbors)
+
+def test_similarity_matrix_returns_the_long_form_table_by_default():
+    x, y, clusters, cell_name_column_idx = synthetic_dataset(n_cells=60, n_reference_cells=200, n_genes=50, n_measured_genes=20, n_clusters=3)
+    table = similarity_matrix(x, y, clusters, cell_name_column_idx, outdir=None, k_neighbors=5)
+    neighbors = similarity_matrix(x, y, clusters, cell_name_column_idx, outdir=None, k_neighbors=5, compact=True)
+    assert list(table.columns) == ["cluster", "x", "y", "distance"]
+    pd.testing.assert_frame_equal(table, neighbor_table(neighbors))
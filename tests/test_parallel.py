@@ -0,0 +1,35 @@
+import time
+import pandas as pd
+import pytest
+from scimpute import expression_imputation
+from scimpute.io import read_imputed_matrix, read_similarity_table
+from scimpute.synthetic import synthetic_dataset
+from scimpute.utils import parallel_map
+
+
+@pytest.fixture(scope="module")
+def dataset():
+    return synthetic_dataset(n_cells=120, n_reference_cells=400, n_genes=60, n_measured_genes=20, n_clusters=4)
+
+def test_parallel_map_keeps_the_order_of_the_items():
+    # later items finish first
+    results = parallel_map(lambda i: time.sleep((10 - i) / 1000) or i * i, range(10), n_jobs=4)
+    assert results == [i * i for i in range(10)]
+
+@pytest.mark.parametrize("n_jobs", [0, 1.5, True, "2"])
+def test_invalid_n_jobs_are_rejected(n_jobs):
+    with pytest.raises(ValueError, match="n_jobs"):
+        parallel_map(abs, [1], n_jobs=n_jobs)
+
+@pytest.mark.parametrize("output_format", ["tsv", "npz"])
+def test_parallel_runs_match_a_serial_run(dataset, tmp_path, output_format):
+    x, y, clusters, cell_name_column_idx = dataset
+    for n_jobs in (1, 4, -1):
+        expression_imputation(x, y, clusters, cell_name_column_idx, outdir=str(tmp_path / str(n_jobs)), k_neighbors=5, chunk_size=25, output_format=output_format, n_jobs=n_jobs, plot=False)
+
+    for n_jobs in ("4", "-1"):
+        # npz archives hold the time they were written, so they are compared by their content
+        pd.testing.assert_frame_equal(read_imputed_matrix(tmp_path / n_jobs / f"imputation.{output_format}"), read_imputed_matrix(tmp_path / "1" / f"imputation.{output_format}"))
+        pd.testing.assert_frame_equal(read_similarity_table(tmp_path / n_jobs / f"sim_matrix.{output_format}"), read_similarity_table(tmp_path / "1" / f"sim_matrix.{output_format}"))
+        for filename in ("scores.txt", "gene_correlations.tsv"):
+            assert (tmp_path / n_jobs / filename).read_bytes() == (tmp_path / "1" / filename).read_bytes()
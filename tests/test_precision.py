@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+from scimpute.benchmark import compare_precision, main
+from scimpute.neighbors import compact_neighbors, shared_neighbors
+
+
+def test_float32_results_match_float64():
+    comparison = compare_precision("float32", n_cells=300, n_reference_cells=2000, n_genes=200, n_measured_genes=50)
+    results = comparison["results"]
+    assert comparison["parameters"]["dtype"] == "float32"
+    assert results["shared_neighbors"] > 0.99
+    assert results["equal_values"] > 0.99
+    assert results["mean_absolute_difference"] < 0.001
+    assert results["mean_score_difference"] < 0.001
+
+def test_float64_results_are_identical():
+    results = compare_precision("float64", n_cells=100, n_reference_cells=500, n_genes=100, n_measured_genes=30)["results"]
+    assert results["shared_neighbors"] == 1.0
+    assert results["equal_values"] == 1.0
+    assert results["max_absolute_difference"] == 0.0
+
+def test_shared_neighbors_aligns_cells_and_ignores_padding():
+    reference_cells = np.array(["r0", "r1", "r2"])
+    neighbors = compact_neighbors(
+        cells = np.array(["a", "b"]),
+        reference_cells = reference_cells,
+        clusters = np.array([0, 1]),
+        indices = np.array([[0, 1], [2, -1]]),
+        distances = np.array([[2.0, 1.5], [1.9, np.nan]])
+    )
+    other = compact_neighbors(
+        cells = np.array(["b", "a"]),
+        reference_cells = reference_cells,
+        clusters = np.array([1, 0]),
+        indices = np.array([[2, 0], [0, 2]]),
+        distances = np.array([[1.9, 1.0], [2.0, 1.4]])
+    )
+    assert shared_neighbors(neighbors, other) == pytest.approx(2 / 3)
+
+def test_precision_rejects_several_values(tmp_path):
+    with pytest.raises(ValueError, match="n_cells"):
+        main(["--precision", "float32", "n_cells=100,200", "--outdir", str(tmp_path)])
+
+def test_precision_rejects_output_parameters():
+    with pytest.raises(ValueError, match="output_format"):
+        compare_precision("float32", output_format="npz")
@@ -0,0 +1,143 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import sparse
+import scimpute.reference
+from scimpute import expression_imputation
+from scimpute.io import read_imputed_matrix, read_matrix
+from scimpute.reference import build_reference_index, load_reference_index, read_reference_index, reference_index_is_valid
+from scimpute.similarity import tiled_top_k_neighbors, top_k_neighbors
+from scimpute.utils import cosine_similarity, gathered_dot, memory_mapped_values
+from scimpute.synthetic import synthetic_dataset
+
+
+@pytest.fixture(scope="module")
+def inputs(tmp_path_factory):
+    # continuous values avoid ties between equally similar neighbors, as in test_sharding
+    x, y, clusters, cell_name_column_idx = synthetic_dataset(n_cells=80, n_reference_cells=300, n_genes=60, n_measured_genes=20, n_clusters=3, sparsity=0.0)
+    rng = np.random.default_rng(3)
+    x = x * rng.uniform(0.5, 1.5, x.shape) + rng.uniform(0, 0.1, x.shape)
+    y = y * rng.uniform(0.5, 1.5, y.shape) + rng.uniform(0, 0.1, y.shape)
+    outdir = tmp_path_factory.mktemp("inputs")
+    paths = (str(outdir / "matrix_to_impute_for.tsv"), str(outdir / "matrix_to_impute_from.tsv"), str(outdir / "cell_identities.tsv"))
+    x.transpose().to_csv(paths[0], sep="\t")
+    y.transpose().to_csv(paths[1], sep="\t")
+    clusters.to_csv(paths[2], sep="\t")
+    return (*paths, cell_name_column_idx)
+
+@pytest.fixture
+def source(inputs, tmp_path):
+    # a copy of the reference matrix that the tests may change
+    filepath = tmp_path / "matrix_to_impute_from.tsv"
+    filepath.write_bytes(open(inputs[1], "rb").read())
+    return filepath
+
+def stored_fingerprint(index_dir):
+    with open(index_dir / "index.json") as f:
+        return json.load(f)
+
+def test_index_matches_the_parsed_matrix(source, tmp_path, monkeypatch):
+    # a tiny block budget converts the text matrix in many blocks of genes and cells
+    monkeypatch.setattr(scimpute.reference, "OUT_OF_CORE_BLOCK_MEMORY", 0.01)
+    build_reference_index(source, tmp_path / "index")
+    y = read_reference_index(tmp_path / "index")
+    assert memory_mapped_values(y) is not None
+    assert not os.path.exists(tmp_path / "index" / "expression.npy.genes.npy")
+    pd.testing.assert_frame_equal(pd.DataFrame(np.asarray(y), index=y.index, columns=y.columns), read_matrix(source), check_names=False)
+
+def test_changed_modification_time_keeps_the_index(source, tmp_path):
+    index_dir = tmp_path / "index"
+    build_reference_index(source, index_dir)
+    expression_mtime = os.stat(index_dir / "expression.npy").st_mtime_ns
+    os.utime(source, ns=(os.stat(source).st_atime_ns, os.stat(source).st_mtime_ns + 10 ** 9))
+
+    assert reference_index_is_valid(source, index_dir)
+    assert stored_fingerprint(index_dir)["mtime_ns"] == os.stat(source).st_mtime_ns
+    load_reference_index(source, index_dir)
+    assert os.stat(index_dir / "expression.npy").st_mtime_ns == expression_mtime
+
+def test_changed_content_rebuilds_the_index(source, tmp_path):
+    index_dir = tmp_path / "index"
+    build_reference_index(source, index_dir)
+    y = read_matrix(source)
+    y.iloc[0, 0] += 1
+    y.transpose().to_csv(source, sep="\t")
+
+    assert not reference_index_is_valid(source, index_dir)
+    rebuilt = load_reference_index(source, index_dir)
+    assert rebuilt.iloc[0, 0] == y.iloc[0, 0]
+    assert reference_index_is_valid(source, index_dir)
+
+def test_changed_dtype_rebuilds_the_index(source, tmp_path):
+    index_dir = tmp_path / "index"
+    build_reference_index(source, index_dir)
+
+    assert reference_index_is_valid(source, index_dir, dtype="float64")
+    assert not reference_index_is_valid(source, index_dir, dtype="float32")
+    y = load_reference_index(source, index_dir, dtype="float32")
+    assert memory_mapped_values(y).dtype == np.float32
+    assert stored_fingerprint(index_dir)["dtype"] == "float32"
+
+def test_interrupted_build_is_not_valid(source, tmp_path, monkeypatch):
+    index_dir = tmp_path / "index"
+    build_reference_index(source, index_dir)
+
+    def interrupt(*args, **kwargs):
+        raise KeyboardInterrupt
+    monkeypatch.setattr(scimpute.reference, "write_dense_expression", interrupt)
+    with pytest.raises(KeyboardInterrupt):
+        build_reference_index(source, index_dir)
+    assert not reference_index_is_valid(source, index_dir)
+
+def test_gathered_dot_reads_the_memory_mapped_rows_in_blocks(tmp_path):
+    rng = np.random.default_rng(0)
+    values = rng.random((50, 8))
+    np.save(tmp_path / "values.npy", values)
+    mapped = np.load(tmp_path / "values.npy", mmap_mode="r")
+    weights = sparse.random(10, 50, density=0.2, format="csr", random_state=0)
+    columns = np.array([6, 1, 3])
+
+    # one row of values per block
+    product = gathered_dot(weights, mapped, columns=columns, max_block_memory=1e-6)
+    np.testing.assert_allclose(product, weights.toarray() @ values[:, columns])
+
+def test_tiled_search_of_a_memory_mapped_matrix(tmp_path):
+    rng = np.random.default_rng(0)
+    x = rng.random((30, 6))
+    y = rng.random((200, 10))
+    np.save(tmp_path / "y.npy", y)
+    mapped = np.load(tmp_path / "y.npy", mmap_mode="r")
+    rows = np.sort(rng.choice(200, size=120, replace=False))
+    columns = np.array([9, 0, 4, 2, 7, 5])
+
+    top_indices, top_values = tiled_top_k_neighbors(x, mapped, 5, 0.005, y_rows=rows, y_columns=columns)
+    expected_indices, expected_values = top_k_neighbors(cosine_similarity(x, y[rows][:, columns]), 5)
+    np.testing.assert_array_equal(top_indices, expected_indices)
+    np.testing.assert_allclose(top_values, expected_values)
+
+@pytest.mark.parametrize("consider_clusters", [True, False])
+def test_run_from_the_index_matches_a_plain_run(inputs, tmp_path, consider_clusters):
+    parameters = dict(k_neighbors=5, chunk_size=30, consider_clusters=consider_clusters, plot=False)
+    expression_imputation(*inputs, outdir=str(tmp_path / "plain"), **parameters)
+    # the tiny block budget streams the memory-mapped reference in many blocks
+    expression_imputation(*inputs, outdir=str(tmp_path / "indexed"), reference_index=str(tmp_path / "index"), max_block_memory=0.01, **parameters)
+
+    pd.testing.assert_frame_equal(read_imputed_matrix(tmp_path / "indexed" / "imputation.tsv"), read_imputed_matrix(tmp_path / "plain" / "imputation.tsv"))
+    assert (tmp_path / "indexed" / "scores.txt").read_text() == (tmp_path / "plain" / "scores.txt").read_text()
+
+def test_changed_source_file_rebuilds_the_index_of_a_run(inputs, source, tmp_path):
+    x_path, _, clusters_path, cell_name_column_idx = inputs
+    index_dir = tmp_path / "index"
+    parameters = dict(k_neighbors=5, chunk_size=30, plot=False, reference_index=str(index_dir))
+    expression_imputation(x_path, str(source), clusters_path, cell_name_column_idx, outdir=str(tmp_path / "first"), **parameters)
+
+    y = read_matrix(source)
+    y.transpose().mul(2).to_csv(source, sep="\t")
+    expression_imputation(x_path, str(source), clusters_path, cell_name_column_idx, outdir=str(tmp_path / "second"), **parameters)
+
+    assert stored_fingerprint(index_dir)["size"] == os.path.getsize(source)
+    first = read_imputed_matrix(tmp_path / "first" / "imputation.tsv")
+    second = read_imputed_matrix(tmp_path / "second" / "imputation.tsv")
+    np.testing.assert_allclose(second.to_numpy(), 2 * first.to_numpy(), atol=0.02)
@@ -0,0 +1,40 @@
+import json
+import pytest
+from scimpute import expression_imputation
+from scimpute.checkpoint import MANIFEST_FILE
+from scimpute.io import read_neighbors
+from scimpute.synthetic import synthetic_dataset
+
+
+@pytest.fixture(scope="module")
+def dataset():
+    return synthetic_dataset(n_cells=60, n_reference_cells=200, n_genes=50, n_measured_genes=20, n_clusters=3)
+
+def run(dataset, outdir, **kwargs):
+    x, y, clusters, cell_name_column_idx = dataset
+    expression_imputation(x, y, clusters, cell_name_column_idx, outdir=str(outdir), chunk_size=25, plot=False, **kwargs)
+
+def skipped_stages(outdir):
+    with open(outdir / "run_report.json") as f:
+        return {stage["stage"] for stage in json.load(f)["stages"] if stage.get("skipped")}
+
+def test_resume_skips_completed_stages(dataset, tmp_path):
+    run(dataset, tmp_path, k_neighbors=5, resume=True)
+    run(dataset, tmp_path, k_neighbors=5, resume=True)
+
+    assert skipped_stages(tmp_path) == {"similarity", "imputation", "merge", "validation"}
+
+def test_run_without_resume_clears_the_manifest(dataset, tmp_path):
+    run(dataset, tmp_path, k_neighbors=5, resume=True)
+    run(dataset, tmp_path, k_neighbors=10)
+
+    with open(tmp_path / MANIFEST_FILE) as f:
+        assert json.load(f) == {}
+
+def test_resume_after_parameter_change_recomputes(dataset, tmp_path):
+    run(dataset, tmp_path, k_neighbors=5, resume=True)
+    run(dataset, tmp_path, k_neighbors=10)
+    run(dataset, tmp_path, k_neighbors=5, resume=True)
+
+    assert skipped_stages(tmp_path) == set()
+    assert read_neighbors(tmp_path / "sim_matrix.tsv")["indices"].shape == (60, 5)
@@ -0,0 +1,129 @@
+import ast
+import json
+import os
+import subprocess
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+import scimpute.sharding
+from scimpute import expression_imputation
+from scimpute.io import read_imputed_matrix, read_neighbors
+from scimpute.neighbors import neighbor_table
+from scimpute.sharding import SHARD_MANIFEST_FILE, SHARDS_DIR, claim_file, claim_shard, cluster_shards, plan_shards, reduce_shards, run_shards, shard_is_done, shard_name
+from scimpute.synthetic import synthetic_dataset
+
+
+@pytest.fixture(scope="module")
+def inputs(tmp_path_factory):
+    # continuous values avoid ties between equally similar neighbors, as in test_incremental
+    x, y, clusters, cell_name_column_idx = synthetic_dataset(n_cells=160, n_reference_cells=600, n_genes=120, n_measured_genes=40, n_clusters=4, sparsity=0.0)
+    rng = np.random.default_rng(2)
+    x = x * rng.uniform(0.5, 1.5, x.shape) + rng.uniform(0, 0.1, x.shape)
+    y = y * rng.uniform(0.5, 1.5, y.shape) + rng.uniform(0, 0.1, y.shape)
+    outdir = tmp_path_factory.mktemp("inputs")
+    paths = (str(outdir / "matrix_to_impute_for.tsv"), str(outdir / "matrix_to_impute_from.tsv"), str(outdir / "cell_identities.tsv"))
+    x.transpose().to_csv(paths[0], sep="\t")
+    y.transpose().to_csv(paths[1], sep="\t")
+    clusters.to_csv(paths[2], sep="\t")
+    return (*paths, cell_name_column_idx)
+
+def plan(inputs, outdir, n_shards=4, **kwargs):
+    return plan_shards(*inputs, outdir=outdir, n_shards=n_shards, chunk_size=30, plot=False, **kwargs)
+
+def read_results(outdir):
+    # the similarity table stores the reference cells in the order of their first use, so the neighbors are compared by name
+    table = neighbor_table(read_neighbors(outdir / "sim_matrix.tsv"))
+    table = table.sort_values("x", kind="stable").reset_index(drop=True)
+    return (read_imputed_matrix(outdir / "imputation.tsv"), table)
+
+def test_manifest_describes_the_shards(inputs, tmp_path):
+    manifest = plan(inputs, tmp_path)
+    assert json.loads((tmp_path / SHARD_MANIFEST_FILE).read_text()) == manifest
+    assert list(manifest) == ["version", "key", "created", "by", "n_cells", "inputs", "parameters", "shards"]
+    assert manifest["by"] == "cells"
+    assert manifest["n_cells"] == 160
+    shards = manifest["shards"]
+    assert [entry["shard"] for entry in shards] == [0, 1, 2, 3]
+    assert [entry["offset"] for entry in shards] == [0, 40, 80, 120]
+    for entry in shards:
+        assert set(entry) == {"shard", "offset", "n_cells", "cells"}
+        assert len((tmp_path / entry["cells"]).read_text().split()) == entry["n_cells"]
+    # planning again with the same inputs and parameters keeps the plan
+    assert plan(inputs, tmp_path)["key"] == manifest["key"]
+    assert plan(inputs, tmp_path, k_neighbors=10)["key"] != manifest["key"]
+
+def test_concurrent_workers_reproduce_a_single_run(inputs, tmp_path):
+    expression_imputation(*inputs, outdir=str(tmp_path / "single"), chunk_size=30, plot=False)
+    plan(inputs, tmp_path / "sharded")
+    workers = [subprocess.Popen([sys.executable, "-m", "scimpute.sharding", "run", str(tmp_path / "sharded")], stdout=subprocess.PIPE, text=True) for _ in range(2)]
+    completed = []
+    for worker in workers:
+        stdout, _ = worker.communicate(timeout=600)
+        assert worker.returncode == 0
+        completed += ast.literal_eval(stdout.strip().splitlines()[-1].removeprefix("Completed shards: "))
+    # every shard was claimed by exactly one worker
+    assert sorted(completed) == [0, 1, 2, 3]
+    for shard in completed:
+        done = json.loads((tmp_path / "sharded" / SHARDS_DIR / shard_name(shard) / "done.json").read_text())
+        assert set(done) == {"key", "finished", "host"}
+        assert claim_file(tmp_path / "sharded", shard).exists()
+    reduce_shards(tmp_path / "sharded")
+    imputed_mtx, table = read_results(tmp_path / "sharded")
+    expected_mtx, expected_table = read_results(tmp_path / "single")
+    pd.testing.assert_frame_equal(imputed_mtx, expected_mtx, check_exact=True)
+    pd.testing.assert_frame_equal(table, expected_table, check_exact=True)
+
+def test_workers_skip_claimed_shards(inputs, tmp_path):
+    manifest = plan(inputs, tmp_path)
+    assert claim_shard(tmp_path, 1)
+    assert not claim_shard(tmp_path, 1)
+    host, pid = claim_file(tmp_path, 1).read_text().split()
+    assert int(pid) == os.getpid()
+    assert run_shards(tmp_path) == [0, 2, 3]
+    assert not shard_is_done(tmp_path, manifest, 1)
+    with pytest.raises(ValueError, match="1 of 4 shards are not completed yet"):
+        reduce_shards(tmp_path)
+    # an explicitly requested shard runs regardless of its claim
+    assert run_shards(tmp_path, shards=[1]) == [1]
+    assert shard_is_done(tmp_path, manifest, 1)
+    assert run_shards(tmp_path) == []
+    reduce_shards(tmp_path)
+    assert read_imputed_matrix(tmp_path / "imputation.tsv").shape[0] == 160
+
+def test_failed_shard_releases_its_claim(inputs, tmp_path, monkeypatch):
+    plan(inputs, tmp_path)
+    def failing_run(outdir, shard, **kwargs):
+        raise OSError("node lost")
+    monkeypatch.setattr(scimpute.sharding, "run_shard", failing_run)
+    with pytest.raises(OSError, match="node lost"):
+        run_shards(tmp_path)
+    assert not claim_file(tmp_path, 0).exists()
+    assert claim_shard(tmp_path, 0)
+
+def test_done_shards_of_a_previous_plan_are_run_again(inputs, tmp_path):
+    plan(inputs, tmp_path, n_shards=2)
+    assert run_shards(tmp_path, shards=[0]) == [0]
+    manifest = plan(inputs, tmp_path, n_shards=2, k_neighbors=10)
+    # the folders of the previous plan are removed with their done and claim files
+    assert not shard_is_done(tmp_path, manifest, 0)
+    assert not claim_file(tmp_path, 0).exists()
+
+def test_cluster_shards_keep_clusters_together():
+    cells = pd.Index([f"c{i}" for i in range(10)])
+    cluster_ids = np.array([0, 1, 1, 2, 0, 1, 1, 2, np.nan, 1])
+    groups = cluster_shards(cells, cluster_ids, 3)
+    assert [list(group) for group in groups] == [["c1", "c2", "c5", "c6", "c9"], ["c0", "c4", "c8"], ["c3", "c7"]]
+    assert len(cluster_shards(cells, cluster_ids, 10)) == 4
+
+def test_sharding_by_clusters_reproduces_a_single_run(inputs, tmp_path):
+    expression_imputation(*inputs, outdir=str(tmp_path / "single"), chunk_size=30, plot=False)
+    manifest = plan(inputs, tmp_path / "sharded", n_shards=3, by="clusters")
+    assert manifest["by"] == "clusters"
+    assert run_shards(tmp_path / "sharded") == [0, 1, 2]
+    reduce_shards(tmp_path / "sharded")
+    imputed_mtx, table = read_results(tmp_path / "sharded")
+    expected_mtx, expected_table = read_results(tmp_path / "single")
+    # the cells are ordered by shard, so they are compared in the order of the single run
+    pd.testing.assert_frame_equal(imputed_mtx.loc[expected_mtx.index], expected_mtx, check_exact=True)
+    pd.testing.assert_frame_equal(table, expected_table, check_exact=True)
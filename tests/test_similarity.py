@@ -0,0 +1,62 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import sparse
+from scimpute.similarity import similarity_matrix, tiled_top_k_neighbors, top_k_neighbors
+from scimpute.synthetic import synthetic_dataset
+from scimpute.utils import cosine_similarity
+
+
+@pytest.fixture(scope="module")
+def dataset():
+    # continuous values avoid ties between equally similar neighbors, as in test_sharding
+    x, y, clusters, cell_name_column_idx = synthetic_dataset(n_cells=60, n_reference_cells=250, n_genes=50, n_measured_genes=20, n_clusters=3, sparsity=0.0)
+    rng = np.random.default_rng(1)
+    x = x * rng.uniform(0.5, 1.5, x.shape) + rng.uniform(0, 0.1, x.shape)
+    y = y * rng.uniform(0.5, 1.5, y.shape) + rng.uniform(0, 0.1, y.shape)
+    return (x, y, clusters, cell_name_column_idx)
+
+@pytest.mark.parametrize("k_neighbors", [0, 1, 7, 40, 50])
+def test_top_k_neighbors_matches_a_full_sort(k_neighbors):
+    similarities = np.random.default_rng(0).random((30, 40))
+    top_indices, top_values = top_k_neighbors(similarities, k_neighbors)
+
+    expected = np.argsort(-similarities, axis=1)[:, :k_neighbors]
+    np.testing.assert_array_equal(top_indices, expected)
+    np.testing.assert_array_equal(top_values, np.take_along_axis(similarities, expected, axis=1))
+
+def test_similarity_matrix_matches_a_full_sort_per_cluster(dataset):
+    x, y, clusters, cell_name_column_idx = dataset
+    table = similarity_matrix(x, y, clusters, cell_name_column_idx, outdir=None, k_neighbors=5)
+
+    genes = x.columns
+    identities = clusters["id"]
+    for cell in x.index:
+        reference = y.index[identities[y.index].to_numpy() == identities[cell]]
+        similarities = cosine_similarity(x.loc[[cell], genes].to_numpy(), y.loc[reference, genes].to_numpy())[0]
+        order = np.argsort(-similarities)[:5]
+        neighbors = table[table["x"] == cell]
+        assert list(neighbors["y"]) == list(reference[order])
+        np.testing.assert_allclose(neighbors["distance"], similarities[order] + 1)
+        assert (neighbors["cluster"] == identities[cell]).all()
+
+@pytest.mark.parametrize("max_block_memory", [0.001, 0.01, 1])
+@pytest.mark.parametrize("sparse_input", [False, True])
+def test_tiled_search_matches_the_full_matrix(max_block_memory, sparse_input):
+    rng = np.random.default_rng(0)
+    x = rng.random((70, 12))
+    y = rng.random((300, 12))
+    expected_indices, expected_values = top_k_neighbors(cosine_similarity(x, y), 6)
+    if sparse_input:
+        x, y = sparse.csr_matrix(x), sparse.csr_matrix(y)
+
+    top_indices, top_values = tiled_top_k_neighbors(x, y, 6, max_block_memory)
+    np.testing.assert_array_equal(top_indices, expected_indices)
+    np.testing.assert_allclose(top_values, expected_values)
+
+@pytest.mark.parametrize("consider_clusters", [True, False])
+def test_similarity_matrix_under_max_block_memory_matches_the_untiled_search(dataset, consider_clusters):
+    x, y, clusters, cell_name_column_idx = dataset
+    untiled = similarity_matrix(x, y, clusters, cell_name_column_idx, outdir=None, k_neighbors=5, consider_clusters=consider_clusters)
+    tiled = similarity_matrix(x, y, clusters, cell_name_column_idx, outdir=None, k_neighbors=5, consider_clusters=consider_clusters, max_block_memory=0.005)
+    pd.testing.assert_frame_equal(tiled, untiled)
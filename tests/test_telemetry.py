@@ -0,0 +1,83 @@
+import json
+import pytest
+from scimpute import expression_imputation
+from scimpute.synthetic import synthetic_dataset
+from scimpute.telemetry import REPORT_FILE, REPORT_VERSION, new_report, stage_metrics, stage_telemetry, task_telemetry
+
+STAGES = ["read_inputs", "similarity", "imputation", "merge", "validation"]
+STAGE_KEYS = {"stage", "tasks", "wall_seconds", "cpu_seconds", "peak_rss_mb", "read_bytes", "write_bytes"}
+TASK_KEYS = {"task", "wall_seconds", "cpu_seconds"}
+
+
+@pytest.fixture(scope="module")
+def dataset():
+    return synthetic_dataset(n_cells=100, n_reference_cells=300, n_genes=50, n_measured_genes=20, n_clusters=3)
+
+@pytest.fixture(scope="module")
+def run(dataset, tmp_path_factory):
+    x, y, clusters, cell_name_column_idx = dataset
+    outdir = tmp_path_factory.mktemp("run")
+    events = []
+    expression_imputation(x, y, clusters, cell_name_column_idx, outdir=str(outdir), k_neighbors=5, chunk_size=40, n_jobs=2, plot=False, progress_callback=events.append)
+    with open(outdir / REPORT_FILE) as f:
+        return (json.load(f), events)
+
+def test_report_schema(run):
+    report, _ = run
+    assert set(report) == {"version", "started", "updated", "completed", "environment", "parameters", "stages"}
+    assert report["version"] == REPORT_VERSION
+    assert report["completed"] is True
+    assert {"python", "platform", "cpu_count", "numpy", "pandas", "scipy"} <= set(report["environment"])
+    assert report["parameters"]["k_neighbors"] == 5
+    assert report["parameters"]["chunk_size"] == 40
+    assert [stage["stage"] for stage in report["stages"]] == STAGES
+    for stage in report["stages"]:
+        assert STAGE_KEYS <= set(stage)
+        assert stage["wall_seconds"] >= 0 and stage["cpu_seconds"] >= 0
+        for task in stage["tasks"]:
+            assert TASK_KEYS <= set(task)
+
+def test_report_counts_the_work_of_every_stage(run):
+    stages = {stage["stage"]: stage for stage in run[0]["stages"]}
+    assert stages["read_inputs"]["cells"] == 100
+    assert stages["similarity"]["cells"] == 100
+    assert stages["similarity"]["neighbors"] == 500
+    assert stages["similarity"]["neighbor_table_bytes"] > 0
+    assert sorted(task["task"] for task in stages["similarity"]["tasks"]) == ["cluster 0", "cluster 1", "cluster 2"]
+    assert sum(task["cells"] for task in stages["similarity"]["tasks"]) == 100
+    assert stages["imputation"]["tasks_total"] == 3
+    assert len(stages["imputation"]["tasks"]) == 3
+    assert stages["merge"]["cells"] == 100
+    assert stages["validation"]["genes"] == 20
+
+def test_progress_callback_receives_every_event(run):
+    report, events = run
+    stage_events = [(event["event"], event["stage"]) for event in events if event["event"] != "task_finished"]
+    assert stage_events == [(event, stage) for stage in STAGES for event in ("stage_started", "stage_finished")]
+    chunks = [event for event in events if event["event"] == "task_finished" and event["stage"] == "imputation"]
+    assert sorted(event["completed"] for event in chunks) == [1, 2, 3]
+    assert {event["total"] for event in chunks} == {3}
+
+def test_report_of_a_failed_run_lists_the_completed_stages(dataset, tmp_path):
+    x, y, clusters, cell_name_column_idx = dataset
+    with pytest.raises(ValueError, match="Genes not found"):
+        expression_imputation(x, y, clusters, cell_name_column_idx, outdir=str(tmp_path), k_neighbors=5, plot=False, genes=["unknown_gene"])
+    with open(tmp_path / REPORT_FILE) as f:
+        report = json.load(f)
+    # the genes are checked right after the inputs were read
+    assert [stage["stage"] for stage in report["stages"]] == ["read_inputs"]
+    assert "completed" not in report
+
+def test_nothing_is_recorded_without_a_report():
+    with stage_telemetry(None, "similarity") as entry:
+        stage_metrics(None, "similarity", cells=10)
+        with task_telemetry(None, "similarity", "cluster 0") as task:
+            task["cells"] = 10
+    assert entry == {}
+
+def test_tasks_of_a_stage_that_is_not_recorded_are_ignored():
+    report = new_report()
+    with stage_telemetry(report, "similarity"):
+        with task_telemetry(report, "imputation", "chunk 0") as task:
+            task["cells"] = 10
+    assert report["stages"][0]["tasks"] == []
@@ -0,0 +1,76 @@
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import sparse
+from scipy import stats
+from scimpute.validation import cell_cosine_similarities, gene_pearson_correlations, gene_spearman_correlations, validate_results
+
+
+def test_validate_results_accepts_sparse_tuple(tmp_path):
+    rng = np.random.default_rng(0)
+    values = rng.poisson(1.0, (30, 8)).astype(np.float64)
+    cells = [f"cell{i}" for i in range(30)]
+    genes = [f"gene{i}" for i in range(8)]
+    x = pd.DataFrame(values, index=cells, columns=genes)
+    imputed_mtx = x.iloc[:, :5] * rng.uniform(0.5, 1.5, (30, 5))
+
+    (tmp_path / "dense").mkdir()
+    (tmp_path / "sparse").mkdir()
+    validate_results(x, imputed_mtx, tmp_path / "dense")
+    validate_results((sparse.csr_matrix(values), cells, genes), imputed_mtx, tmp_path / "sparse")
+
+    expected = np.loadtxt(tmp_path / "dense" / "scores.txt")
+    np.testing.assert_allclose(np.loadtxt(tmp_path / "sparse" / "scores.txt"), expected)
+
+def test_validate_results_skips_plot_without_matplotlib(tmp_path, monkeypatch):
+    monkeypatch.setitem(sys.modules, "matplotlib", None)
+    monkeypatch.setitem(sys.modules, "matplotlib.figure", None)
+    rng = np.random.default_rng(0)
+    x = pd.DataFrame(rng.poisson(1.0, (20, 6)).astype(np.float64), index=[f"cell{i}" for i in range(20)], columns=[f"gene{i}" for i in range(6)])
+
+    with pytest.warns(UserWarning, match="matplotlib"):
+        validate_results(x, x * 0.5, tmp_path)
+
+    assert (tmp_path / "stats.txt").exists()
+    assert (tmp_path / "scores.txt").exists()
+    assert not (tmp_path / "cosine_similarities.png").exists()
+
+@pytest.fixture
+def values():
+    # counts with many ties, a constant gene and a cell without expression
+    rng = np.random.default_rng(1)
+    measured = rng.poisson(1.5, (40, 6)).astype(np.float64)
+    imputed = (measured * rng.uniform(0.5, 1.5, measured.shape) + rng.poisson(0.5, measured.shape)).round(2)
+    imputed[:, 5] = 2.0
+    measured[7] = 0.0
+    return (imputed, measured)
+
+def test_cell_cosine_similarities_match_a_loop(values):
+    imputed, measured = values
+    expected = [0.0 if not (a.any() and b.any()) else a @ b / np.linalg.norm(a) / np.linalg.norm(b) for a, b in zip(imputed, measured)]
+    np.testing.assert_allclose(cell_cosine_similarities(imputed, measured), expected)
+
+def test_gene_correlations_match_scipy(values):
+    imputed, measured = values
+    pearson = gene_pearson_correlations(imputed, measured)
+    spearman = gene_spearman_correlations(imputed, measured)
+    for gene in range(5):
+        np.testing.assert_allclose(pearson[gene], stats.pearsonr(imputed[:, gene], measured[:, gene])[0])
+        np.testing.assert_allclose(spearman[gene], stats.spearmanr(imputed[:, gene], measured[:, gene])[0])
+    # the constant gene has no correlation
+    assert np.isnan(pearson[5]) and np.isnan(spearman[5])
+
+def test_validate_results_writes_the_returned_gene_correlations(values, tmp_path):
+    imputed, measured = values
+    cells = [f"cell{i}" for i in range(40)]
+    genes = [f"gene{i}" for i in range(6)]
+    x = pd.DataFrame(measured, index=cells, columns=genes)
+    # the imputed matrix holds more genes than were measured and its cells in a different order
+    imputed_mtx = pd.DataFrame(imputed, index=cells, columns=genes).assign(gene9=1.0).iloc[::-1]
+
+    scores, gene_correlations = validate_results(x, imputed_mtx, tmp_path, plot=False)
+    assert list(scores.index) == cells[::-1]
+    np.testing.assert_allclose(scores.to_numpy(), cell_cosine_similarities(imputed, measured)[::-1])
+    assert list(gene_correlations.index) == genes
+    pd.testing.assert_frame_equal(pd.read_csv(tmp_path / "gene_correlations.tsv", sep="\t", index_col=0), gene_correlations)